@@ -0,0 +1,5 @@
+import sys
+
+from cloudcam.cli import main
+
+sys.exit(main())
@@ -0,0 +1,223 @@
+"""cloudcam command line tools
+
+Usage: python -m cloudcam provision [options] MANIFEST
+       python -m cloudcam deprovision [--manifest MANIFEST] [THING ...]
+
+Provisions the things listed in a CSV (with a header row) or JSONL manifest, using the same columns/keys as the
+IoTProvisionThing lambda: thingName, clientId (optional) and thingTypeName (optional). Rows are streamed from
+the manifest and provisioned concurrently, and each finished thing gets its config written to
+OUT_DIR/{thingName}.json (the format script/config_to_certs.sh expects, readable by the owner only since it
+contains the private key) before it is recorded in the journal. Rerunning with the same journal skips things
+which were already provisioned, so an interrupted run can simply be restarted. Certificates are journaled as soon
+as they are created, so the ones of things which didn't finish are deleted on the rerun instead of being orphaned.
+
+deprovision deletes things along with their certificates and per-thing identity policies, taking thing names
+from the command line and/or a manifest (e.g. the one the things were provisioned from)."""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import threading
+from time import time
+from typing import Any, Dict, Iterator, List, Set, Tuple
+
+from cloudcam import tools
+
+log = logging.getLogger("cloudcam")
+
+# print a progress line every this many things
+progress_interval = 100
+
+
+def iter_manifest(path: str, fmt: str = None) -> Iterator[Dict[str, Any]]:
+    """Yields thing specs from a CSV or JSONL manifest, one row at a time"""
+    if not fmt:
+        fmt = 'csv' if path.lower().endswith('.csv') else 'jsonl'
+    with open(path, newline='') as f:
+        if fmt == 'csv':
+            for row in csv.DictReader(f):
+                yield {k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()}
+        else:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def load_journal(path: str) -> Tuple[Set[str], Dict[str, List[str]]]:
+    """Returns names of things recorded as provisioned in a journal file, and the certificate ARNs of things
+    which were started but not finished"""
+    done = set()
+    certificates = {}
+    if not os.path.exists(path):
+        return done, certificates
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line may be truncated if we were killed while writing it
+                continue
+            if entry.get('status') == 'certificate':
+                certificates.setdefault(entry['thingName'], []).append(entry['certificateArn'])
+            elif entry.get('status') == 'certificate-deleted':
+                if entry['certificateArn'] in certificates.get(entry['thingName'], []):
+                    certificates[entry['thingName']].remove(entry['certificateArn'])
+                    if not certificates[entry['thingName']]:
+                        del certificates[entry['thingName']]
+            elif entry.get('status') == 'done':
+                done.add(entry['thingName'])
+                certificates.pop(entry['thingName'], None)
+    return done, certificates
+
+
+def write_json_atomic(path: str, data: Any, mode: int = 0o600):
+    tmp_path = f'{path}.tmp'
+    # create the file with its final permissions rather than chmod-ing it after the secrets are written
+    if os.path.exists(tmp_path):
+        os.unlink(tmp_path)
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode), 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def provision(args) -> int:
+    if args.policy_name:
+        os.environ['CAMERA_IOT_POLICY_NAME'] = args.policy_name
+    # imported here because the module reads its configuration from the environment on import
+    from cloudcam.iot_provision_thing import iter_provision_things, thing_spec
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    journal_path = args.journal or os.path.join(args.out_dir, 'journal.jsonl')
+    done, unfinished = load_journal(journal_path)
+    if done:
+        log.info(f'{len(done)} things already provisioned according to {journal_path}, skipping them')
+
+    skipped = 0
+
+    def pending_specs():
+        nonlocal skipped
+        for spec in iter_manifest(args.manifest, args.format):
+            try:
+                thing_name = thing_spec(spec)['thing_name']
+            except Exception:
+                # let the provisioner report invalid rows
+                yield spec
+                continue
+            if thing_name in done:
+                skipped += 1
+                continue
+            # don't provision duplicate rows twice within a run either
+            done.add(thing_name)
+            yield spec
+
+    provisioned = 0
+    failed = 0
+    start = time()
+    with open(journal_path, 'a') as journal:
+        journal_lock = threading.Lock()
+
+        def write_entry(entry):
+            with journal_lock:
+                journal.write(json.dumps(entry) + '\n')
+                journal.flush()
+
+        def on_certificate(thing_name, certificate_arn):
+            write_entry({'thingName': thing_name, 'status': 'certificate', 'certificateArn': certificate_arn})
+
+        if unfinished:
+            for thing_name, certificate_arn in delete_unfinished_certificates(unfinished):
+                write_entry({'thingName': thing_name, 'status': 'certificate-deleted',
+                             'certificateArn': certificate_arn})
+
+        for spec, result, error in iter_provision_things(pending_specs(), args.identity_id, args.concurrency,
+                                                         on_certificate=on_certificate):
+            thing_name = result['thingName'] if result else spec.get('thingName')
+            if error is not None:
+                failed += 1
+                log.error(f'failed to provision {thing_name}: {error}')
+                entry = {'thingName': thing_name, 'status': 'error', 'error': str(error)}
+            else:
+                provisioned += 1
+                write_json_atomic(os.path.join(args.out_dir, f'{thing_name}.json'), result['thingConfig'])
+                entry = {'thingName': thing_name, 'status': 'done'}
+            write_entry(entry)
+            if (provisioned + failed) % progress_interval == 0:
+                log.info(f'{provisioned} provisioned, {failed} failed ({(provisioned + failed) / (time() - start):.1f}/s)')
+
+    log.info(f'done: {provisioned} provisioned, {failed} failed, {skipped} skipped, '
+             f'{tools.rate_limit_waited():.1f}s spent waiting for AWS rate limits')
+    return 1 if failed else 0
+
+
+def delete_unfinished_certificates(certificates: Dict[str, List[str]]) -> List[Tuple[str, str]]:
+    """Deletes certificates created by an interrupted run for things which didn't finish provisioning
+
+    Returns the (thing name, certificate ARN) pairs which were deleted."""
+    from cloudcam.iot_deprovision_thing import delete_certificate
+
+    pairs = [(thing_name, arn) for thing_name, arns in certificates.items() for arn in arns]
+    log.info(f'deleting {len(pairs)} certificates of things an earlier run did not finish')
+    deleted, errors = tools.fan_out(lambda pair: delete_certificate(*pair), pairs)
+    for (thing_name, arn), e in errors.items():
+        log.error(f'failed to delete certificate {arn} of {thing_name}: {e}')
+    return list(deleted)
+
+
+def deprovision(args) -> int:
+    from slugify import slugify
+    from cloudcam.iot_deprovision_thing import iter_deprovision_things
+
+    def thing_names():
+        yield from args.things
+        if args.manifest:
+            for spec in iter_manifest(args.manifest, args.format):
+                if spec.get('thingName'):
+                    yield slugify(spec['thingName'])
+
+    deprovisioned = 0
+    failed = 0
+    for thing_name, _, error in iter_deprovision_things(thing_names(), args.concurrency):
+        if error is not None:
+            failed += 1
+            log.error(f'failed to deprovision {thing_name}: {error}')
+        else:
+            deprovisioned += 1
+            log.debug(f'deprovisioned {thing_name}')
+
+    log.info(f'done: {deprovisioned} deprovisioned, {failed} failed, '
+             f'{tools.rate_limit_waited():.1f}s spent waiting for AWS rate limits')
+    return 1 if failed else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='cloudcam', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    p = commands.add_parser('provision', help='provision things listed in a CSV/JSONL manifest')
+    p.add_argument('manifest')
+    p.add_argument('--format', choices=('csv', 'jsonl'), help='manifest format (default: from file extension)')
+    p.add_argument('--out-dir', default='things', help='directory for thing configs (default: %(default)s)')
+    p.add_argument('--journal', help='progress journal (default: OUT_DIR/journal.jsonl)')
+    p.add_argument('--identity-id', help='Cognito identity to own the things')
+    p.add_argument('--policy-name', help='camera IoT policy name (default: $CAMERA_IOT_POLICY_NAME)')
+    p.add_argument('--concurrency', type=int, default=int(os.getenv('PROVISION_CONCURRENCY', 8)))
+    p.set_defaults(func=provision)
+
+    p = commands.add_parser('deprovision', help='delete things with their certificates and policies')
+    p.add_argument('things', nargs='*', help='thing names')
+    p.add_argument('--manifest', help='CSV/JSONL manifest of things to deprovision')
+    p.add_argument('--format', choices=('csv', 'jsonl'), help='manifest format (default: from file extension)')
+    p.add_argument('--concurrency', type=int, default=int(os.getenv('DEPROVISION_CONCURRENCY', 8)))
+    p.set_defaults(func=deprovision)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(format='%(asctime)s %(message)s', stream=sys.stderr,
+                        level=logging.DEBUG if args.verbose else logging.INFO)
+    return args.func(args)
@@ -1,12 +1,9 @@
-import boto3
 import logging
 import os
 
 log = logging.getLogger("cloudcam")
 log.setLevel(logging.DEBUG)
 
-iot = boto3.client("iot")
-
 user_iot_policy_name = os.getenv('USER_IOT_POLICY_NAME')
 if not user_iot_policy_name:
     raise Exception("Missing USER_IOT_POLICY_NAME")
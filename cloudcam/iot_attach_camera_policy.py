@@ -1,22 +1,16 @@
 import json
 import logging
-import boto3
-from cloudcam import tools
+from cloudcam import iot_policy, owner_index, tools
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-iot = boto3.client('iot')
-sts = boto3.client('sts')
+iot = tools.LazyClient('iot')
 
 
 def handler(event, context):
     logger.info(json.dumps(event, sort_keys=True, indent=4))
 
-    iot_endpoint = iot.describe_endpoint()
-    region = iot_endpoint['endpointAddress'].split('.')[2]
-    account_id = sts.get_caller_identity()['Account']
-
     identity_id = context.identity.cognito_identity_id
     thing_name = event['thingName']
 
@@ -28,6 +22,35 @@ def handler(event, context):
     if not thing_name:
         raise Exception("thingName must be specified")
 
+    # don't let identities take over things owned by someone else
+    attributes = iot.describe_thing(thingName=thing_name).get('attributes', {})
+    owners = iot_policy.owner_identities(attributes)
+    if owners - {identity_id}:
+        raise Exception(f"{thing_name} is owned by another identity")
+
+    if iot_policy.shared_identity_policy_p():
+        # a single attribute update adds the thing to the identity's topic namespace
+        iot.update_thing(
+            thingName=thing_name,
+            attributePayload={
+                'attributes': {
+                    f'access:{identity_id}': 'owner',
+                    iot_policy.owner_attribute: identity_id,
+                },
+                'merge': True
+            }
+        )
+        iot_policy.attach_shared_identity_policy(identity_id)
+        owner_index.add_thing(identity_id, thing_name)
+        return {
+            "thingName": thing_name,
+            "identityId": identity_id,
+            "policyName": iot_policy.user_iot_policy_name,
+            "ownerTopicPrefix": iot_policy.owner_topic_prefix(identity_id),
+        }
+
+    region = tools.aws_region()
+    account_id = tools.aws_account_id()
     policy = {
         "Version": "2012-10-17",
         "Statement": [{
@@ -68,15 +91,12 @@ def handler(event, context):
             ]
         }]
     }
-    policy_name = f'{identity_id}-{thing_name}'.replace(':', '_')
+    policy_name = iot_policy.camera_identity_policy_name(thing_name, identity_id)
 
     logger.info(f'policy_name: {policy_name} policy: {policy}')
 
-    tools.ignore_all(iot.detach_principal_policy, policyName=policy_name, principal=identity_id)
-    tools.ignore_all(iot.delete_policy, policyName=policy_name)
-
-    tools.ignore_resource_already_exists(iot.create_policy, policyName=policy_name, policyDocument=json.dumps(policy))
-    iot.attach_principal_policy(policyName=policy_name, principal=identity_id)
+    iot_policy.upsert_policy(policy_name, policy, target=identity_id)
+    owner_index.add_thing(identity_id, thing_name)
 
     iot.update_thing(
         thingName=thing_name,
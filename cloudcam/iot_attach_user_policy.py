@@ -2,13 +2,13 @@
 
 Sadly, we can't do this without their cognito identity, which we apparently don't have in the Cognito triggers. That would be too easy."""
 
-import boto3
 import logging
 import os
+from cloudcam import tools
 
 log = logging.getLogger("cloudcam")
 log.setLevel(logging.DEBUG)
-iot = boto3.client("iot")
+iot = tools.LazyClient("iot")
 
 user_iot_policy_name = os.getenv('USER_IOT_POLICY_NAME')
 if not user_iot_policy_name:
@@ -0,0 +1,222 @@
+"""Pool of pre-minted IoT certificates
+
+Creating keys and a certificate is the slowest step of provisioning a thing, so a warm container keeps a number
+of registered, not yet attached certificates ready to be claimed. Key pairs and CSRs are generated locally (in a
+process pool where the platform allows it - AWS Lambda has no /dev/shm, so there it's done in-process) and
+registered through create_certificate_from_csr whenever the pool drops below its low watermark.
+
+Long-lived callers (the CLI) refill from a background thread. Lambda freezes background threads between
+invocations, so there the pool is refilled synchronously at the end of an invocation instead (refill_if_low with
+the time the invocation has left): the invocation which drains the pool pays for minting, the following ones on
+the same container claim certificates.
+
+Pooled certificates are registered INACTIVE and only activated when claimed, so certificates left behind when a
+container is recycled (their private keys only ever lived in its memory) can't be used by anyone. The first refill
+sweeps such leftovers: INACTIVE certificates with the pool's common name older than max_age are deleted, looking at
+no more than sweep_max_describes candidates per sweep. Pooled certificates older than max_age are deleted instead
+of being handed out as well.
+
+A cold container's first claim always misses, the pool only pays off for containers kept warm by repeated or
+batch provisioning."""
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from time import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+
+logger = logging.getLogger()
+
+# common name of pooled certificates, tells pooled certificates apart when sweeping
+pool_common_name = 'cloudcam-pool'
+
+# max number of certificates described (to check their common name) per sweep
+sweep_max_describes = 100
+
+
+def generate_key_and_csr(common_name: str = 'cloudcam', key_size: int = 2048) -> Tuple[str, str, str]:
+    """Returns (private key PEM, public key PEM, CSR PEM) of a new RSA key pair"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=key_size)
+    csr = x509.CertificateSigningRequestBuilder().subject_name(
+        x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    ).sign(key, hashes.SHA256())
+    return (key.private_bytes(serialization.Encoding.PEM,
+                              serialization.PrivateFormat.TraditionalOpenSSL,
+                              serialization.NoEncryption()).decode('ascii'),
+            key.public_key().public_bytes(serialization.Encoding.PEM,
+                                          serialization.PublicFormat.SubjectPublicKeyInfo).decode('ascii'),
+            csr.public_bytes(serialization.Encoding.PEM).decode('ascii'))
+
+
+def generate_keys_and_csrs(count: int, key_workers: int,
+                           common_name: str = 'cloudcam') -> List[Tuple[str, str, str]]:
+    """Generates count key pairs/CSRs, in parallel processes if possible"""
+    if key_workers > 1 and count > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=min(key_workers, count)) as executor:
+                return list(executor.map(generate_key_and_csr, [common_name] * count))
+        except (OSError, ImportError, NotImplementedError) as e:
+            logger.info(f'process pool unavailable ({e}), generating keys in-process')
+    return [generate_key_and_csr(common_name) for _ in range(count)]
+
+
+def certificate_common_name(certificate_pem: str) -> Optional[str]:
+    cert = x509.load_pem_x509_certificate(certificate_pem.encode('ascii'))
+    names = cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)
+    return names[0].value if names else None
+
+
+def iter_certificates(iot, **kwargs) -> Iterator[Dict[str, Any]]:
+    """Yields the certificates of the account, fetching pages as needed"""
+    kwargs = dict(kwargs, pageSize=250)
+    while True:
+        res = iot.list_certificates(**kwargs)
+        yield from res['certificates']
+        if not res.get('nextMarker'):
+            return
+        kwargs['marker'] = res['nextMarker']
+
+
+def sweep_stale_certificates(iot, max_age: float, max_describes: int = sweep_max_describes,
+                             deadline: Optional[float] = None) -> List[str]:
+    """Deletes INACTIVE pooled certificates older than max_age, e.g. ones left behind by recycled containers
+
+    Certificates are listed oldest first, so the sweep stops at the first one younger than max_age, after
+    max_describes candidates or at the deadline (in time() seconds). Returns the ids of the deleted certificates."""
+    deleted = []
+    describes = 0
+    for cert in iter_certificates(iot, ascendingOrder=True):
+        if time() - cert['creationDate'].timestamp() < max_age:
+            break
+        if cert['status'] != 'INACTIVE':
+            continue
+        if describes >= max_describes or (deadline and time() > deadline):
+            logger.info(f'stopping sweep of stale pooled certificates after {describes} candidates')
+            break
+        describes += 1
+        certificate_id = cert['certificateId']
+        description = iot.describe_certificate(certificateId=certificate_id)['certificateDescription']
+        if certificate_common_name(description['certificatePem']) != pool_common_name:
+            continue
+        try:
+            iot.delete_certificate(certificateId=certificate_id)
+        except Exception as e:
+            # e.g. claimed concurrently and attached, or deactivated and still attached to a thing
+            logger.info(f'not deleting stale pooled certificate {certificate_id}: {e}')
+            continue
+        deleted.append(certificate_id)
+    if deleted:
+        logger.info(f'deleted {len(deleted)} stale pooled certificates')
+    return deleted
+
+
+class CertificatePool:
+    def __init__(self, iot, size: int, low_watermark: int, max_age: float = 24 * 3600, key_workers: int = 2,
+                 background_refill: bool = True):
+        self.iot = iot
+        self.size = size
+        self.low_watermark = low_watermark
+        self.max_age = max_age
+        self.key_workers = key_workers
+        # claims start a refill thread when the pool runs low, otherwise the caller calls refill_if_low
+        self.background_refill = background_refill
+        self._certs: deque = deque()
+        self._lock = threading.Lock()
+        self._refill_thread: Optional[threading.Thread] = None
+        self._swept = False
+
+    def __len__(self):
+        return len(self._certs)
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """Takes a certificate out of the pool and activates it, in the same format as create_keys_and_certificate
+        returns
+
+        Returns None if the pool is empty (callers should create a certificate themselves then)."""
+        expired = []
+        entry = None
+        with self._lock:
+            while self._certs:
+                entry = self._certs.popleft()
+                if time() - entry['created'] > self.max_age:
+                    expired.append(entry)
+                    entry = None
+                    continue
+                break
+            low = len(self._certs) < self.low_watermark
+        for expired_entry in expired:
+            self.retire(expired_entry)
+        if low and self.background_refill:
+            self.start_refill()
+        if not entry:
+            return None
+
+        certificate_id = entry['keys_and_cert']['certificateId']
+        try:
+            self.iot.update_certificate(certificateId=certificate_id, newStatus='ACTIVE')
+        except Exception as e:
+            logger.error(f'failed to activate pooled certificate {certificate_id}: {e}')
+            self.retire(entry)
+            return None
+        return entry['keys_and_cert']
+
+    def start_refill(self):
+        """Refills the pool in a background thread unless a refill is already running"""
+        with self._lock:
+            if self._refill_thread and self._refill_thread.is_alive():
+                return
+            self._refill_thread = threading.Thread(target=self.refill, name='cert-pool-refill', daemon=True)
+            self._refill_thread.start()
+
+    def refill_if_low(self, deadline: Optional[float] = None):
+        """Refills the pool in the calling thread if it's below its low watermark, until the deadline"""
+        if len(self._certs) < self.low_watermark:
+            self.refill(deadline)
+
+    def refill(self, deadline: Optional[float] = None):
+        """Mints certificates until the pool is full or the deadline (in time() seconds) passes, sweeping stale
+        pooled certificates on the first refill"""
+        if not self._swept:
+            self._swept = True
+            try:
+                sweep_stale_certificates(self.iot, self.max_age, deadline=deadline)
+            except Exception as e:
+                logger.error(f'failed to sweep stale pooled certificates: {e}')
+
+        missing = self.size - len(self._certs)
+        if missing <= 0:
+            return
+        logger.info(f'minting {missing} certificates for the pool')
+        # minted a few at a time so a deadline is never overshot by much
+        chunk_size = max(self.key_workers, 1)
+        while missing > 0 and not (deadline and time() > deadline):
+            count = min(chunk_size, missing)
+            for private_key, public_key, csr in generate_keys_and_csrs(count, self.key_workers, pool_common_name):
+                try:
+                    cert = self.iot.create_certificate_from_csr(certificateSigningRequest=csr, setAsActive=False)
+                except Exception as e:
+                    logger.error(f'failed to register pooled certificate: {e}')
+                    return
+                with self._lock:
+                    self._certs.append({'created': time(), 'keys_and_cert': {
+                        'certificateArn': cert['certificateArn'],
+                        'certificateId': cert['certificateId'],
+                        'certificatePem': cert['certificatePem'],
+                        'keyPair': {'PublicKey': public_key, 'PrivateKey': private_key},
+                    }})
+            missing -= count
+
+    def retire(self, entry: Dict[str, Any]):
+        """Deletes a pooled certificate (which is still INACTIVE)"""
+        certificate_id = entry['keys_and_cert']['certificateId']
+        logger.info(f'retiring pooled certificate {certificate_id}')
+        try:
+            self.iot.delete_certificate(certificateId=certificate_id)
+        except Exception as e:
+            logger.error(f'failed to retire pooled certificate {certificate_id}: {e}')
@@ -0,0 +1,145 @@
+"""Deprovisions things: the reverse of iot_provision_thing
+
+For each thing, all of its principals are looked up and torn down concurrently:
+  - certificates are detached from the thing and their policies, deactivated and deleted
+  - Cognito identities are detached from the thing, their per-thing policies (see iot_policy) are deleted and the
+    thing is removed from their owner index entry
+and the thing itself is deleted once nothing is attached to it anymore. Things are processed concurrently too,
+with all calls going through the shared rate limiters (see tools)."""
+
+import logging
+import os
+from time import sleep
+from typing import Any, Iterable, Iterator, List, Set, Tuple
+
+from botocore.exceptions import ClientError
+
+from cloudcam import iot_policy, owner_index, tools
+from cloudcam.iot_list_things import list_owner_things, things_exist
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+iot = tools.LazyClient('iot')
+
+# number of things deprovisioned concurrently
+deprovision_concurrency = int(os.getenv('DEPROVISION_CONCURRENCY', 8))
+
+# detaching principals is eventually consistent, delete_thing is retried this many times until it goes through
+delete_thing_retries = 5
+delete_thing_retry_delay = 1
+
+
+def handler(event, context):
+    """Deprovisions a thing (thingName) or a batch of things (thingNames)
+
+    When called by a Cognito identity, only things owned by it can be deprovisioned. Things which no longer exist
+    (e.g. deleted outside of cloudcam) are checked for in one batch, reported as missing and dropped from the
+    owner index of the identity."""
+    thing_names = event.get('thingNames') or ([event['thingName']] if event.get('thingName') else None)
+    if not thing_names:
+        raise Exception("thingName or thingNames must be specified")
+    thing_names = list(dict.fromkeys(thing_names))
+
+    identity_id = context.identity.cognito_identity_id if hasattr(context, 'identity') else None
+    if identity_id:
+        owned = set(list_owner_things(identity_id))
+        denied = [thing_name for thing_name in thing_names if thing_name not in owned]
+        if denied:
+            raise Exception(f"Access to {', '.join(denied)} denied")
+
+    exists = things_exist(thing_names)
+    missing = [thing_name for thing_name in thing_names if not exists[thing_name]]
+    if identity_id:
+        for thing_name in missing:
+            owner_index.remove_thing(identity_id, thing_name)
+
+    deprovisioned = []
+    errors = {}
+    for thing_name, _, error in iter_deprovision_things([t for t in thing_names if exists[t]]):
+        if error is not None:
+            logger.error(f'failed to deprovision {thing_name}: {error}')
+            errors[thing_name] = str(error)
+        else:
+            deprovisioned.append(thing_name)
+
+    return {
+        "deprovisioned": deprovisioned,
+        "missing": missing,
+        "errors": errors,
+    }
+
+
+def iter_deprovision_things(thing_names: Iterable[str],
+                            max_workers: int = deprovision_concurrency) -> Iterator[Tuple[str, Any, Any]]:
+    """Deprovisions things concurrently, yields (thing name, None, exception) as each thing is done"""
+    return tools.iter_fan_out(deprovision_thing, thing_names, max_workers=max_workers)
+
+
+def deprovision_thing(thing_name: str):
+    """Deletes a thing along with its certificates and per-thing identity policies"""
+    try:
+        attributes = iot.describe_thing(thingName=thing_name).get('attributes', {})
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ResourceNotFoundException":
+            logger.info(f'{thing_name} does not exist')
+            return
+        raise
+
+    certificates, identities = thing_principals(thing_name)
+    identities |= iot_policy.owner_identities(attributes)
+
+    # certificates and identities are independent of each other
+    teardown = [(delete_certificate, thing_name, arn) for arn in certificates] + \
+               [(remove_identity, thing_name, identity_id) for identity_id in identities]
+    _, errors = tools.fan_out(lambda step: step[0](*step[1:]), teardown, max_workers=max(1, len(teardown)))
+    if errors:
+        raise next(iter(errors.values()))
+
+    delete_thing(thing_name)
+    logger.info(f'deprovisioned {thing_name}: {len(certificates)} certificates, {len(identities)} identities')
+
+
+def thing_principals(thing_name: str) -> Tuple[List[str], Set[str]]:
+    """Returns (certificate ARNs, Cognito identity ids) attached to a thing"""
+    principals = []
+    kwargs = dict(thingName=thing_name)
+    while True:
+        res = iot.list_thing_principals(**kwargs)
+        principals.extend(res['principals'])
+        if not res.get('nextToken'):
+            break
+        kwargs['nextToken'] = res['nextToken']
+    certificates = [p for p in principals if p.startswith('arn:') and ':cert/' in p]
+    identities = {p for p in principals if not p.startswith('arn:')}
+    return certificates, identities
+
+
+def delete_certificate(thing_name: str, certificate_arn: str):
+    certificate_id = certificate_arn.rsplit('/', 1)[1]
+    tools.ignore_resource_not_found(iot.detach_thing_principal, thingName=thing_name, principal=certificate_arn)
+    policies = iot.list_attached_policies(target=certificate_arn, recursive=False)['policies']
+    for policy in policies:
+        tools.ignore_resource_not_found(iot.detach_policy, policyName=policy['policyName'], target=certificate_arn)
+    tools.ignore_resource_not_found(iot.update_certificate, certificateId=certificate_id, newStatus='INACTIVE')
+    tools.ignore_resource_not_found(iot.delete_certificate, certificateId=certificate_id)
+
+
+def remove_identity(thing_name: str, identity_id: str):
+    tools.ignore_resource_not_found(iot.detach_thing_principal, thingName=thing_name, principal=identity_id)
+    for policy_name in (iot_policy.identity_policy_name(thing_name, identity_id),
+                        iot_policy.camera_identity_policy_name(thing_name, identity_id)):
+        iot_policy.delete_policy(policy_name, targets=[identity_id])
+    owner_index.remove_thing(identity_id, thing_name)
+
+
+def delete_thing(thing_name: str):
+    for attempt in range(delete_thing_retries + 1):
+        try:
+            tools.ignore_resource_not_found(iot.delete_thing, thingName=thing_name)
+            return
+        except ClientError as e:
+            # principals are still attached until the detach calls propagate
+            if e.response["Error"]["Code"] != "InvalidRequestException" or attempt == delete_thing_retries:
+                raise
+            sleep(delete_thing_retry_delay)
@@ -1,14 +1,58 @@
+import json
 import logging
-import boto3
+import os
+import re
+from time import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from botocore.config import Config
 from botocore.exceptions import ClientError
+from cloudcam import iot_policy, owner_index, presign, tools
+from cloudcam.thumbs import thumb_key, thumb_sizes
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-iot = boto3.client('iot')
+thumb_bucket_name = os.getenv("S3_THUMB_BUCKET_NAME")
+
+# max number of thing shadows fetched concurrently in the enriched list mode
+shadow_concurrency = int(os.getenv("SHADOW_CONCURRENCY", 32))
+
+# fields of the enriched list mode, see thing_record
+thing_fields = ('streaming', 'online', 'lastSeen', 'lastThumb', 'thumbUrl', 'shadow')
+shadow_fields = {'streaming', 'online', 'lastSeen', 'lastThumb', 'shadow'}
+
+# things which haven't reported anything to their shadow for this many seconds are considered offline
+online_timeout = int(os.getenv("THING_ONLINE_TIMEOUT", 600))
+
+thumb_url_expires_in = 3600
+
+iot = tools.LazyClient('iot')
+iot_data = tools.LazyClient('iot-data', config=Config(max_pool_connections=shadow_concurrency))
+url_cache = presign.PresignedUrlCache()
+
+# list_principal_things returns at most this many things per call
+max_page_size = 250
+
+# number of thing names per fleet index query in things_exist
+search_batch_size = 50
+
+# thing names which can be used in a fleet index query (after escaping, see search_term)
+searchable_thing_name = re.compile(r'^[a-zA-Z0-9_:-]+$')
+
+# set when the fleet index turns out not to exist (fleet indexing not enabled)
+_search_index_unavailable = False
+
+# fleet index query errors after which the names of the batch are looked up with describe_thing instead
+search_fallback_codes = ("ResourceNotFoundException", "IndexNotReadyException", "InvalidRequestException",
+                         "UnauthorizedException", "AccessDeniedException")
 
 
 def thing_exists_p(thing_name):
+    return things_exist([thing_name])[thing_name]
+
+
+def describe_thing_exists_p(thing_name):
     try:
         iot.describe_thing(thingName=thing_name)
         return True
@@ -19,8 +63,63 @@ def thing_exists_p(thing_name):
             raise
 
 
+def things_exist(thing_names: Iterable[str]) -> Dict[str, bool]:
+    """Returns {thing name: whether it exists}
+
+    Names are looked up in batches in the fleet index if thing indexing is enabled (and the caller may use it). The
+    index is eventually consistent, so it only confirms things exist: names it doesn't return (e.g. things
+    provisioned a moment ago), names which can't be used in an index query and batches whose query failed are
+    checked concurrently with describe_thing."""
+    global _search_index_unavailable
+    thing_names = list(dict.fromkeys(thing_names))
+    found = set()
+    if not _search_index_unavailable and len(thing_names) > 1:
+        searchable = [t for t in thing_names if searchable_thing_name.match(t)]
+        for i in range(0, len(searchable), search_batch_size):
+            batch = searchable[i:i + search_batch_size]
+            try:
+                found.update(search_thing_names(f'thingName:({" OR ".join(map(search_term, batch))})'))
+            except ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code not in search_fallback_codes:
+                    raise
+                logger.info(f'fleet index query failed ({code}), using describe_thing for {len(batch)} things')
+                if code == "ResourceNotFoundException":
+                    _search_index_unavailable = True
+                    break
+
+    exists = {t: True for t in thing_names if t in found}
+    results, errors = tools.fan_out(describe_thing_exists_p, [t for t in thing_names if t not in found])
+    if errors:
+        raise next(iter(errors.values()))
+    exists.update(results)
+    return exists
+
+
+def search_term(thing_name: str) -> str:
+    """Escapes the characters of a thing name which have a meaning in fleet index queries (e.g. cam-1 -> cam\\-1)"""
+    return re.sub(r'([:-])', r'\\\1', thing_name)
+
+
+def search_thing_names(query: str) -> Iterator[str]:
+    next_token = None
+    while True:
+        kwargs = dict(queryString=query, maxResults=500)
+        if next_token:
+            kwargs['nextToken'] = next_token
+        res = iot.search_index(**kwargs)
+        for thing in res.get('things', []):
+            yield thing['thingName']
+        next_token = res.get('nextToken')
+        if not next_token:
+            return
+
+
 def handler(event, context):
-    """List things the current Cognito identity has access to"""
+    """List things the current Cognito identity has access to
+
+    Returns all of them unless pageSize or nextToken are passed, in which case one page of things is returned
+    along with the nextToken of the next page (null on the last page)."""
     # cognito identity id is passed via lambda context
     identity_id = context.identity.cognito_identity_id
     if not identity_id:
@@ -28,12 +127,152 @@ def handler(event, context):
 
     logger.info(f'listing things, identityId: {identity_id}')
 
-    # TODO: pagination
-    thing_names = iot.list_principal_things(
-        maxResults=100,
-        principal=identity_id,
-    )['things']
+    event = event or {}
+    fields = event.get('fields')
+    if isinstance(fields, str):
+        fields = fields.split(',')
+
+    if not (event.get('pageSize') or event.get('nextToken')):
+        thing_names = list_owner_things(identity_id)
+        result = {
+            "thingNames": thing_names,
+        }
+        if fields:
+            result["things"] = thing_records(thing_names, fields, event.get('thumbSize'))
+        if iot_policy.shared_identity_policy_p():
+            # web clients talk to the things under this prefix, see iot_owner_relay
+            result["ownerTopicPrefix"] = iot_policy.owner_topic_prefix(identity_id)
+        return result
 
-    return {
+    page_size = min(int(event.get('pageSize') or max_page_size), max_page_size)
+    next_token = event.get('nextToken')
+    indexed = owner_index.owner_things(identity_id) if not next_token or next_token.startswith('index:') else None
+    if indexed is not None:
+        # page through the owner index, tokens are offsets into the sorted list of things
+        offset = int(next_token[len('index:'):]) if next_token else 0
+        thing_names = indexed[offset:offset + page_size]
+        next_token = f'index:{offset + page_size}' if offset + page_size < len(indexed) else None
+    else:
+        thing_names, next_token = next(iter_principal_thing_pages(identity_id, page_size, next_token))
+    result = {
         "thingNames": thing_names,
+        "nextToken": next_token,
+    }
+    if fields:
+        result["things"] = thing_records(thing_names, fields, event.get('thumbSize'))
+    if iot_policy.shared_identity_policy_p():
+        result["ownerTopicPrefix"] = iot_policy.owner_topic_prefix(identity_id)
+    return result
+
+
+def thing_records(thing_names: List[str],
+                  fields: Iterable[str],
+                  thumb_size: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Returns a record with the requested fields for each of the things (the enriched list mode)
+
+    Fields:
+      streaming - whether a stream is enabled in the shadow
+      online    - whether the thing reported to its shadow within the last THING_ONLINE_TIMEOUT seconds
+      lastSeen  - unix time of the last report of the thing to its shadow
+      lastThumb - last_uploaded_thumb reported by the thing
+      thumbUrl  - presigned URL of the current thumbnail (of thumbSize: small/medium, full size by default)
+      shadow    - the whole shadow state
+
+    Shadows are only fetched (concurrently) if a field derived from them is requested."""
+    fields = set(fields)
+    unknown = fields - set(thing_fields)
+    if unknown:
+        raise Exception(f"Unknown fields {', '.join(sorted(unknown))}")
+    if thumb_size and thumb_size not in thumb_sizes:
+        raise Exception(f"Unknown thumbSize {thumb_size}")
+
+    records = [{"thingName": thing_name} for thing_name in thing_names]
+
+    if fields & shadow_fields:
+        shadows, errors = tools.fan_out(get_shadow, thing_names, max_workers=shadow_concurrency)
+        for thing_name, e in errors.items():
+            logger.error(f'failed to get shadow of {thing_name}: {e}')
+        now = time()
+        for record in records:
+            record.update(shadow_record(shadows.get(record["thingName"]), fields, now))
+
+    if 'thumbUrl' in fields:
+        urls = presign.presigned_urls(tools.session(), tools.aws_region(), url_cache,
+                                      [(thumb_bucket_name, thumb_key(thing_name, thumb_size), 'GET')
+                                       for thing_name in thing_names],
+                                      expires_in=thumb_url_expires_in)
+        for record, url in zip(records, urls):
+            record["thumbUrl"] = url
+
+    return records
+
+
+def get_shadow(thing_name: str) -> Optional[Dict[str, Any]]:
+    """Returns the shadow document of a thing, None if it has none"""
+    try:
+        return json.loads(iot_data.get_thing_shadow(thingName=thing_name)['payload'].read().decode('utf-8'))
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "ResourceNotFoundException":
+            return None
+        raise
+
+
+def shadow_record(shadow: Optional[Dict[str, Any]], fields: Iterable[str], now: float) -> Dict[str, Any]:
+    state = (shadow or {}).get('state', {})
+    reported = state.get('reported') or {}
+    streams = (state.get('desired') or {}).get('streams') or {}
+    last_seen = latest_timestamp((shadow or {}).get('metadata', {}).get('reported'))
+    values = {
+        'streaming': any(isinstance(stream, dict) and stream.get('stream_enable') for stream in streams.values()),
+        'online': bool(last_seen and now - last_seen < online_timeout),
+        'lastSeen': last_seen,
+        'lastThumb': reported.get('last_uploaded_thumb'),
+        'shadow': state if shadow else None,
     }
+    return {field: values[field] for field in fields if field in values}
+
+
+def latest_timestamp(metadata) -> Optional[int]:
+    """Returns the latest update timestamp in (a part of) shadow metadata"""
+    if isinstance(metadata, dict):
+        if isinstance(metadata.get('timestamp'), int):
+            return metadata['timestamp']
+        return max(filter(None, map(latest_timestamp, metadata.values())), default=None)
+    if isinstance(metadata, list):
+        return max(filter(None, map(latest_timestamp, metadata)), default=None)
+    return None
+
+
+def iter_principal_thing_pages(principal: str,
+                               page_size: int = max_page_size,
+                               next_token: Optional[str] = None) -> Iterator[Tuple[List[str], Optional[str]]]:
+    """Yields (thing names, next token) pages of the things attached to a principal, fetching them lazily"""
+    while True:
+        kwargs = dict(principal=principal, maxResults=page_size)
+        if next_token:
+            kwargs['nextToken'] = next_token
+        res = iot.list_principal_things(**kwargs)
+        next_token = res.get('nextToken')
+        yield res['things'], next_token
+        if not next_token:
+            return
+
+
+def iter_principal_things(principal: str, page_size: int = max_page_size) -> Iterator[str]:
+    """Yields names of all things attached to a principal, fetching pages as needed"""
+    for thing_names, _ in iter_principal_thing_pages(principal, page_size):
+        yield from thing_names
+
+
+def list_owner_things(identity_id):
+    """Returns names of the things the Cognito identity has access to
+
+    Read from the owner index if there is one, which is synced from the IoT registry the first time and then every
+    OWNER_INDEX_MAX_AGE seconds."""
+    thing_names = owner_index.owner_things(identity_id)
+    if thing_names is None:
+        listed_at = time()
+        thing_names = list(iter_principal_things(identity_id))
+        owner_index.backfill_owner_things(identity_id, thing_names, listed_at)
+        thing_names = owner_index.owner_things(identity_id) or thing_names
+    return thing_names
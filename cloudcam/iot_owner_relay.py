@@ -0,0 +1,84 @@
+"""Relays messages between Cognito identities and their things in the shared identity policy mode
+
+With IDENTITY_POLICY_MODE=shared web clients only get the cloudcam/owner/{identity id}/ topic namespace of their
+identity (see SharedUserIoTPolicy), while things keep using their shadow and cloudcam/{thing}/ topics. Two topic rules
+bridge them:
+  - requests published to cloudcam/owner/{identity id}/{thing}/{shadow/update,shadow/get,webrtc/setup} are
+    forwarded to the thing if its owner attribute names the identity. Shadow gets are answered on
+    .../{thing}/shadow/get/accepted.
+  - accepted shadow updates of things with an owner are republished to
+    cloudcam/owner/{owner}/{thing}/shadow/update/accepted.
+Both rules pass the raw payload base64 encoded along with the topic. Owners are cached for owner_cache_ttl seconds
+per container, so a thing handed to another identity may keep relaying to its previous owner for that long."""
+
+import base64
+import logging
+import threading
+from time import time
+from typing import Optional
+
+from cloudcam import iot_policy, tools
+
+logger = logging.getLogger()
+
+iot = tools.LazyClient('iot')
+iot_data = tools.LazyClient('iot-data')
+
+owner_cache_ttl = 10
+
+# thing name -> (owner identity id, fetched at)
+_owners = {}
+_owners_lock = threading.Lock()
+
+
+def handler(event, context):
+    topic = event['topic']
+    payload = base64.b64decode(event.get('payload') or '')
+    parts = topic.split('/')
+    if topic.startswith('$aws/things/'):
+        relay_shadow_update(parts[2], payload)
+    elif topic.startswith('cloudcam/owner/') and len(parts) > 4:
+        relay_request(parts[2], parts[3], '/'.join(parts[4:]), payload)
+    else:
+        logger.warning(f'not relaying message to {topic}')
+    return {}
+
+
+def thing_owner(thing_name: str) -> Optional[str]:
+    """Returns the identity in the owner attribute of a thing (None if it has no owner or doesn't exist)"""
+    with _owners_lock:
+        cached = _owners.get(thing_name)
+    if cached and time() - cached[1] < owner_cache_ttl:
+        return cached[0]
+    thing = tools.ignore_resource_not_found(iot.describe_thing, thingName=thing_name) or {}
+    attributes = thing.get('attributes', {})
+    owner = attributes.get(iot_policy.owner_attribute) or None
+    with _owners_lock:
+        _owners[thing_name] = (owner, time())
+    return owner
+
+
+def relay_request(identity_id: str, thing_name: str, action: str, payload: bytes):
+    """Forwards a request of an identity to one of its things"""
+    if thing_owner(thing_name) != identity_id:
+        logger.warning(f'{identity_id} does not own {thing_name}, dropping {action} request')
+        return
+    if action == 'shadow/update':
+        iot_data.update_thing_shadow(thingName=thing_name, payload=payload)
+    elif action == 'shadow/get':
+        shadow = iot_data.get_thing_shadow(thingName=thing_name)['payload'].read()
+        iot_data.publish(topic=f'{iot_policy.owner_topic_prefix(identity_id)}/{thing_name}/shadow/get/accepted',
+                         qos=0, payload=shadow)
+    elif action == 'webrtc/setup':
+        iot_data.publish(topic=f'cloudcam/{thing_name}/webrtc/setup', qos=0, payload=payload)
+    else:
+        logger.warning(f'not relaying {action} request of {identity_id} to {thing_name}')
+
+
+def relay_shadow_update(thing_name: str, payload: bytes):
+    """Republishes an accepted shadow update of a thing to the namespace of its owner"""
+    owner = thing_owner(thing_name)
+    if not owner:
+        return
+    iot_data.publish(topic=f'{iot_policy.owner_topic_prefix(owner)}/{thing_name}/shadow/update/accepted',
+                     qos=0, payload=payload)
@@ -0,0 +1,183 @@
+"""Idempotent IoT policy upserts
+
+Policies are compared by a hash of their canonical JSON (sorted keys, no whitespace), so an unchanged policy costs
+a single get_policy call. A changed policy gets a new default version instead of being detached, deleted and
+recreated, and attachments already made by this container are not repeated.
+
+Cognito identities are authorized to interact with their things in one of two modes (IDENTITY_POLICY_MODE):
+  per-thing - an IoT policy per (thing, identity) pair, see ThingProvisioner.generate_identity_policy. AWS allows
+              at most 10 policies per principal, so this caps the number of things per identity.
+  shared    - the single USER_IOT_POLICY_NAME policy (SharedUserIoTPolicy) is attached to every identity once. It
+              only grants access to the cloudcam/owner/{identity id}/ topic namespace, which iot_owner_relay bridges
+              to the topics of the things whose owner attribute names the identity, so adding a thing to an
+              identity is just an attribute update."""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, Optional, Set, Union
+
+from botocore.exceptions import ClientError
+from slugify import slugify
+
+from cloudcam import tools
+
+logger = logging.getLogger()
+
+iot = tools.LazyClient('iot')
+
+identity_policy_mode = os.getenv('IDENTITY_POLICY_MODE', 'per-thing')
+if identity_policy_mode not in ('per-thing', 'shared'):
+    raise Exception(f"Invalid IDENTITY_POLICY_MODE {identity_policy_mode}")
+
+user_iot_policy_name = os.getenv('USER_IOT_POLICY_NAME')
+if identity_policy_mode == 'shared' and not user_iot_policy_name:
+    raise Exception("Missing USER_IOT_POLICY_NAME")
+
+# thing attribute naming the identity that owns the thing in the shared mode
+owner_attribute = 'owner'
+
+# AWS IoT keeps at most 5 versions of a policy
+max_policy_versions = 5
+
+# (policy name, target) pairs attached by this container
+_attached = set()
+_attached_lock = threading.Lock()
+
+
+def canonical_document(document: Union[str, Dict[str, Any]]) -> str:
+    if isinstance(document, str):
+        document = json.loads(document)
+    return json.dumps(document, sort_keys=True, separators=(',', ':'))
+
+
+def document_hash(document: Union[str, Dict[str, Any]]) -> str:
+    return hashlib.sha256(canonical_document(document).encode('utf-8')).hexdigest()
+
+
+def upsert_policy(policy_name: str, document: Union[str, Dict[str, Any]], target: Optional[str] = None) -> bool:
+    """Makes sure policy_name exists with the given document (and is attached to target, if specified)
+
+    Returns True if the policy was created or updated."""
+    status = put_policy(policy_name, document)
+    if target:
+        # a (re-)created policy has no attachments, new versions of an existing one keep them
+        attach_policy(policy_name, target, force=status == 'created')
+    return status != 'unchanged'
+
+
+def put_policy(policy_name: str, document: Union[str, Dict[str, Any]]) -> str:
+    """Creates the policy, or a new default version of it if its document differs
+
+    Returns 'created', 'updated' or 'unchanged'."""
+    policy_document = canonical_document(document)
+    for attempt in range(2):
+        try:
+            existing = iot.get_policy(policyName=policy_name)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ResourceNotFoundException':
+                raise
+            try:
+                iot.create_policy(policyName=policy_name, policyDocument=policy_document)
+                logger.info(f'created policy {policy_name}')
+                return 'created'
+            except ClientError as e:
+                # created concurrently, compare against that one
+                if e.response['Error']['Code'] != 'ResourceAlreadyExistsException' or attempt:
+                    raise
+                continue
+        if document_hash(existing['policyDocument']) == document_hash(policy_document):
+            return 'unchanged'
+        create_policy_version(policy_name, policy_document)
+        logger.info(f'updated policy {policy_name}')
+        return 'updated'
+    return 'unchanged'
+
+
+def create_policy_version(policy_name: str, policy_document: str):
+    try:
+        iot.create_policy_version(policyName=policy_name, policyDocument=policy_document, setAsDefault=True)
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'VersionsLimitExceededException':
+            raise
+        prune_policy_versions(policy_name, keep=max_policy_versions - 1)
+        iot.create_policy_version(policyName=policy_name, policyDocument=policy_document, setAsDefault=True)
+
+
+def prune_policy_versions(policy_name: str, keep: int):
+    """Deletes the oldest non-default versions of a policy until at most keep versions are left"""
+    versions = iot.list_policy_versions(policyName=policy_name)['policyVersions']
+    old_versions = sorted((v for v in versions if not v['isDefaultVersion']), key=lambda v: v['createDate'])
+    for version in old_versions[:max(0, len(versions) - keep)]:
+        tools.ignore_resource_not_found(iot.delete_policy_version, policyName=policy_name,
+                                        policyVersionId=version['versionId'])
+
+
+def delete_policy(policy_name: str, targets=()):
+    """Detaches a policy from targets and deletes it along with all its versions, if it exists"""
+    for target in targets:
+        tools.ignore_resource_not_found(iot.detach_policy, policyName=policy_name, target=target)
+    try:
+        versions = iot.list_policy_versions(policyName=policy_name)['policyVersions']
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ResourceNotFoundException':
+            return
+        raise
+    for version in versions:
+        if not version['isDefaultVersion']:
+            tools.ignore_resource_not_found(iot.delete_policy_version, policyName=policy_name,
+                                            policyVersionId=version['versionId'])
+    tools.ignore_resource_not_found(iot.delete_policy, policyName=policy_name)
+    forget_policy(policy_name)
+
+
+def attach_policy(policy_name: str, target: str, force: bool = False):
+    """Attaches a policy to a target unless this container already did so"""
+    key = (policy_name, target)
+    with _attached_lock:
+        if key in _attached and not force:
+            return
+    iot.attach_policy(policyName=policy_name, target=target)
+    with _attached_lock:
+        _attached.add(key)
+
+
+def forget_policy(policy_name: str):
+    """Drops attachments of a policy from the cache, e.g. after the policy was deleted"""
+    with _attached_lock:
+        _attached.difference_update([key for key in _attached if key[0] == policy_name])
+
+
+def identity_policy_name(thing_name: str, identity_id: str) -> str:
+    """Name of the per-thing policy of an identity created when provisioning a thing"""
+    return f"{thing_name}-{slugify(identity_id)}"
+
+
+def camera_identity_policy_name(thing_name: str, identity_id: str) -> str:
+    """Name of the per-thing policy of an identity created by iot_attach_camera_policy"""
+    return f'{identity_id}-{thing_name}'.replace(':', '_')
+
+
+def shared_identity_policy_p() -> bool:
+    return identity_policy_mode == 'shared'
+
+
+def owner_topic_prefix(identity_id: str) -> str:
+    """Topic namespace shared by an identity and its things in the shared mode"""
+    return f'cloudcam/owner/{identity_id}'
+
+
+def owner_identities(attributes: Dict[str, str]) -> Set[str]:
+    """Returns identities recorded as owners in thing attributes"""
+    identities = {name[len('access:'):] for name, value in attributes.items()
+                  if name.startswith('access:') and value == 'owner'}
+    if attributes.get(owner_attribute):
+        identities.add(attributes[owner_attribute])
+    identities.discard('')
+    return identities
+
+
+def attach_shared_identity_policy(identity_id: str):
+    attach_policy(user_iot_policy_name, identity_id)
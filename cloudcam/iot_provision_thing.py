@@ -1,16 +1,14 @@
 import logging
-import boto3
 import os
+from time import time
 from slugify import slugify
-import requests
-from cloudcam import tools
-from typing import Dict, Optional, Tuple, Any
-import json
+from cloudcam import iot_policy, owner_index, tools
+from cloudcam.iot_cert_pool import CertificatePool
+from typing import Callable, Dict, Iterable, Iterator, Optional, Tuple, Any
 
 logger = logging.getLogger()
 
-iot = boto3.client('iot')
-sts = boto3.client('sts')
+iot = tools.LazyClient('iot')
 
 default_thing_type_name = "Camera"
 default_thing_type_name = ""
@@ -19,9 +17,25 @@ camera_iot_policy_name = os.getenv('CAMERA_IOT_POLICY_NAME')
 if not camera_iot_policy_name:
     raise Exception("Missing CAMERA_IOT_POLICY_NAME")
 
+# number of things provisioned concurrently in batch mode
+# each thing takes 5-8 sequential IoT control plane calls, this keeps us around the default IoT API rate limits
+provision_concurrency = int(os.getenv('PROVISION_CONCURRENCY', 8))
+
+# stop starting new things in batch mode when the lambda has less than this many ms left
+provision_time_margin_ms = 5000
+
+# number of pre-minted certificates kept ready per container (0 disables the pool), see iot_cert_pool
+# in lambda the pool is refilled at the end of invocations, background threads don't run between them
+cert_pool_size = int(os.getenv('CERT_POOL_SIZE', 0))
+cert_pool = CertificatePool(iot,
+                            size=cert_pool_size,
+                            low_watermark=int(os.getenv('CERT_POOL_LOW_WATERMARK', cert_pool_size // 2)),
+                            max_age=int(os.getenv('CERT_POOL_MAX_AGE', 24 * 3600)),
+                            background_refill=not os.getenv('AWS_LAMBDA_FUNCTION_NAME')) if cert_pool_size else None
+
 
 def handler(event, context):
-    """Provisions a new thing under the specified Cognito identity"""
+    """Provisions a new thing (or a batch of things, see provision_batch) under the specified Cognito identity"""
     # cognito identity id is passed via lambda context
     identity_id = None
     # prefer cognito
@@ -29,18 +43,83 @@ def handler(event, context):
         identity_id = context.identity.cognito_identity_id
         print(f"id: {identity_id}")
 
-    # lambda parameters
-    thing_type_name = event.get('thingTypeName', default_thing_type_name)
-    client_id = event.get('clientId')
-    thing_name = slugify(event['thingName'])
+    try:
+        if 'things' in event:
+            return provision_batch(event['things'], identity_id, context)
+
+        provisioner = ThingProvisioner(cognito_identity_id=identity_id, **thing_spec(event))
+        return provisioner.provision()
+    finally:
+        refill_cert_pool(context)
+
+
+def refill_cert_pool(context=None):
+    """Tops up the certificate pool of the container if it runs in the foreground, within the time left"""
+    if not cert_pool or cert_pool.background_refill:
+        return
+    remaining_time_ms = getattr(context, 'get_remaining_time_in_millis', None)
+    deadline = time() + (remaining_time_ms() - provision_time_margin_ms) / 1000 if remaining_time_ms else None
+    try:
+        cert_pool.refill_if_low(deadline)
+    except Exception as e:
+        logger.error(f'failed to refill certificate pool: {e}')
+
+
+def thing_spec(spec: Dict[str, Any]) -> Dict[str, Any]:
+    """Converts thing lambda parameters to ThingProvisioner arguments"""
+    thing_name = slugify(spec.get('thingName') or '')
     if not thing_name:
         raise Exception("thingName must be specified")
-
-    provisioner = ThingProvisioner(thing_name=thing_name,
-                                   cognito_identity_id=identity_id,
-                                   client_id=client_id,
-                                   thing_type=thing_type_name)
-    return provisioner.provision()
+    return dict(thing_name=thing_name,
+                client_id=spec.get('clientId'),
+                thing_type=spec.get('thingTypeName', default_thing_type_name))
+
+
+def iter_provision_things(specs: Iterable[Dict[str, Any]],
+                          cognito_identity_id: str = None,
+                          max_workers: int = provision_concurrency,
+                          on_certificate: Callable[[str, str], None] = None
+                          ) -> Iterator[Tuple[Dict[str, Any], Any, Any]]:
+    """Provisions things concurrently
+
+    Yields (spec, provision result, exception) as soon as each thing is done, so callers can persist
+    certificates of provisioned things right away even if other things fail. on_certificate(thing_name,
+    certificate_arn) is called (from worker threads) as soon as a certificate was created for a thing."""
+    def provision(spec):
+        return ThingProvisioner(cognito_identity_id=cognito_identity_id, on_certificate=on_certificate,
+                                **thing_spec(spec)).provision()
+
+    return tools.iter_fan_out(provision, specs, max_workers=max_workers)
+
+
+def provision_batch(specs, identity_id, context=None):
+    """Provisions a list of things, returns their configs along with per-thing errors
+
+    Things that couldn't be started before the lambda runs out of time are returned as unprocessed."""
+    unprocessed = []
+    remaining_time_ms = getattr(context, 'get_remaining_time_in_millis', None)
+
+    def until_deadline():
+        for i, spec in enumerate(specs):
+            if remaining_time_ms and remaining_time_ms() < provision_time_margin_ms:
+                unprocessed.extend(specs[i:])
+                return
+            yield spec
+
+    things = []
+    errors = {}
+    for spec, result, error in iter_provision_things(until_deadline(), identity_id):
+        if error is not None:
+            logger.error(f'failed to provision {spec.get("thingName")}: {error}')
+            errors[spec.get('thingName')] = str(error)
+        else:
+            things.append(result)
+
+    return {
+        "things": things,
+        "errors": errors,
+        "unprocessed": unprocessed,
+    }
 
 
 class ThingProvisioner:
@@ -57,8 +136,10 @@ class ThingProvisioner:
                  thing_name: str,
                  cognito_identity_id: str = None,
                  client_id: str = None,
-                 thing_type: str = None):
+                 thing_type: str = None,
+                 on_certificate: Callable[[str, str], None] = None):
         self.cognito_identity_id = cognito_identity_id
+        self.on_certificate = on_certificate
         self.thing_name = thing_name
         self.thing_type = thing_type
 
@@ -67,32 +148,29 @@ class ThingProvisioner:
             client_id = thing_name
         self.client_id = client_id
 
-        # get env info
-        self.iot_endpoint = iot.describe_endpoint(
-            endpointType='iot:Data-ATS'
-        )  # "We recommend that all customers create an Amazon Trust Services (ATS) endpoint..."
+        # get env info (cached for the lifetime of the container)
+        self.iot_endpoint = tools.iot_endpoint()
         self.root_ca_pem = self.get_root_ca()  # Amazon Root CA 1
-        self.region = self.iot_endpoint['endpointAddress'].split('.')[2]
-        identity = sts.get_caller_identity()
-        self.account_id = identity['Account']
+        self.region = tools.aws_region()
+        self.account_id = tools.aws_account_id()
 
     def get_root_ca(self) -> str:
         """Get root CA certificate."""
-        ca = requests.get(
-            'https://www.amazontrust.com/repository/AmazonRootCA1.pem').text
-        return ca
+        return tools.root_ca_pem()
 
     def provision(self):
         # logger.info(f'identityId: {cognito_identity_id} thingName: {thing_name} thingTypeName: {thing_type} clientId: {client_id}')
 
         # create iot thing
         identity_id = self.cognito_identity_id
+        attributes = {f'access:{identity_id if identity_id else ""}': 'owner'}
+        if identity_id and iot_policy.shared_identity_policy_p():
+            # grants the owner access to the thing via the shared identity policy
+            attributes[iot_policy.owner_attribute] = identity_id
         create_thing = dict(
             thingName=self.thing_name,
             attributePayload={
-                'attributes': {
-                    f'access:{identity_id if identity_id else ""}': 'owner'
-                }
+                'attributes': attributes
             })
         if self.thing_type:
             create_thing['thingTypeName'] = self.thing_type
@@ -102,8 +180,12 @@ class ThingProvisioner:
         thing_arn = create_res['thingArn']
         self.thing_arn = thing_arn
 
-        # provision iot keys/certs
-        keys_and_cert = iot.create_keys_and_certificate(setAsActive=True)
+        # provision iot keys/certs, from the pool if there's one ready
+        keys_and_cert = cert_pool.claim() if cert_pool else None
+        if not keys_and_cert:
+            keys_and_cert = iot.create_keys_and_certificate(setAsActive=True)
+        if self.on_certificate:
+            self.on_certificate(self.thing_name, keys_and_cert['certificateArn'])
 
         # allow thing to connect and do stuff
         self.attach_thing_policy(keys_and_cert=keys_and_cert)
@@ -111,6 +193,7 @@ class ThingProvisioner:
         # allow user to interact with the device
         if identity_id:
             self.attach_identity_policy()
+            owner_index.add_thing(identity_id, self.thing_name)
 
         # create thing config (which will be encoded as a single json file
         # containing all the required config data for the C client/thing)
@@ -118,7 +201,7 @@ class ThingProvisioner:
             "thingName": self.thing_name,
             "thingTypeName": self.thing_type,
             "clientId": self.thing_name,
-            "endpoint": self.iot_endpoint['endpointAddress'],
+            "endpoint": self.iot_endpoint,
             "caPem": self.root_ca_pem,
             "certificatePem": keys_and_cert['certificatePem'],
             "certificatePrivateKey": keys_and_cert['keyPair']['PrivateKey']
@@ -147,22 +230,17 @@ class ThingProvisioner:
         iot.attach_thing_principal(principal=self.cognito_identity_id,
                                    thingName=self.thing_name)
 
+        if iot_policy.shared_identity_policy_p():
+            # the thing owner attribute is set on creation, the identity only needs the shared policy once
+            iot_policy.attach_shared_identity_policy(self.cognito_identity_id)
+            return
+
         # generate policy
         identity_policy, identity_policy_name = self.generate_identity_policy()
 
-        # (re-)create policy
-        tools.ignore_all(iot.detach_policy,
-                         policyName=identity_policy_name,
-                         target=self.cognito_identity_id)
-        tools.ignore_all(iot.delete_policy, policyName=identity_policy_name)
-        tools.ignore_resource_already_exists(
-            iot.create_policy,
-            policyName=identity_policy_name,
-            policyDocument=json.dumps(identity_policy))
-
-        # attach policy to user
-        iot.attach_policy(policyName=identity_policy_name,
-                          target=self.cognito_identity_id)
+        # create or update policy and attach it to user (no-op if nothing changed)
+        iot_policy.upsert_policy(identity_policy_name, identity_policy,
+                                 target=self.cognito_identity_id)
 
     def generate_identity_policy(self) -> Tuple[Dict[str, Any], str]:
         region = self.region
@@ -170,12 +248,10 @@ class ThingProvisioner:
         thing_name = self.thing_name
 
         # note: there's an AWS limit of 10 IoT policies per principal (Cognito identity in this case)
-        # so we need to either move to storing thing owner/group information in the thing name (say, prefix)
-        # or use IoT rules (the limit is 1000 rules per account) to copy messages between the thing-owned and
-        # identity-owned topics (using, perhaps, IoT SQL functions like topic(x) and substitution templates)
+        # so an identity can't own more than 10 things this way, see IDENTITY_POLICY_MODE=shared in iot_policy
 
         # Cognito identity policy -- allows caller Cognito identity to interact with the thing
-        identity_policy_name = f"{thing_name}-{slugify(self.cognito_identity_id)}"
+        identity_policy_name = iot_policy.identity_policy_name(thing_name, self.cognito_identity_id)
         identity_policy = {
             "Version":
             "2012-10-17",
@@ -1,49 +1,114 @@
 from __future__ import print_function
 
 import json
-import boto3
 import logging
 import os
+from botocore.config import Config
+from cloudcam import tools, presign
+from cloudcam.thumb_freshness import FreshnessIndex
+from cloudcam.thumbs import thumb_key, upload_key
 
 log = logging.getLogger("cloudcam")
 log.setLevel(logging.DEBUG)
 
 thumb_bucket_name = os.getenv("S3_THUMB_BUCKET_NAME")
 
-iot_data = boto3.client('iot-data')
-s3 = boto3.client('s3')
+# max number of things to request thumbnails from concurrently
+# (also the size of the http connection pool of the clients below)
+thumb_request_concurrency = int(os.getenv("THUMB_REQUEST_CONCURRENCY", 32))
+
+# presigned thumbnail URLs are reused across invocations until they have less than this many seconds left
+thumb_url_expires_in = 3600
+thumb_url_min_validity = int(os.getenv("THUMB_URL_MIN_VALIDITY", 900))
+
+# things which uploaded a thumbnail (or were asked for one) less than this many seconds ago are skipped
+thumb_min_refresh_interval = int(os.getenv("THUMB_MIN_REFRESH_INTERVAL", 60))
+
+client_config = Config(max_pool_connections=thumb_request_concurrency)
+iot_data = tools.LazyClient('iot-data', config=client_config)
+s3 = tools.LazyClient('s3', config=client_config.merge(Config(signature_version='s3v4',
+                                                              s3={'addressing_style': 'virtual'})))
+
+url_cache = presign.PresignedUrlCache(min_validity=thumb_url_min_validity)
+freshness = FreshnessIndex()
+
+# client ids of web clients (see ui/src/api/iot.ts), whose presence events aren't thing connections
+web_client_id_prefix = 'wss-'
 
 
 def handler(event, context):
     """Requests an updated thumbnail from the thing via the iot thing shadow"""
     # lambda parameters
-    thing_names = event['thingNames']
+    # (presence events carry the client id, which is the thing name by default)
+    if event.get('eventType') == 'connected' and event.get('clientId', '').startswith(web_client_id_prefix):
+        return {'results': {}}
+    thing_names = event.get('thingNames') or ([event['clientId']] if event.get('eventType') == 'connected' else None)
     if not thing_names:
         raise Exception("thingNames must be specified")
+    thing_names = list(dict.fromkeys(thing_names))
+    concurrency = max(1, min(int(event.get('concurrency', thumb_request_concurrency)), thumb_request_concurrency))
+    min_interval = 0 if event.get('force') else float(event.get('minInterval', thumb_min_refresh_interval))
+
+    # skip things which have a fresh thumbnail (or were asked for one recently), so that only the things which will
+    # actually be asked for a thumbnail get their URLs signed
+    fresh, errors = tools.fan_out(lambda thing_name: freshness.is_fresh(thing_name, min_interval),
+                                  thing_names, max_workers=concurrency)
+    stale = [thing_name for thing_name in thing_names if thing_name not in errors and not fresh[thing_name]]
+
+    # send presigned thumbnail upload/download URLs to the things, concurrently so that
+    # a single slow publish doesn't hold up the rest of the fleet
+    # note: security is handled by AWS IoT policies attached to the
+    # Cognito identity, so we don't perform any checks here
+    thumb_urls = gen_thumb_urls(stale)
+    _, publish_errors = tools.fan_out(lambda thing_name: request_thumb(thing_name, *thumb_urls[thing_name]),
+                                      stale, max_workers=concurrency)
+    errors.update(publish_errors)
+    for thing_name, e in errors.items():
+        log.error(f'failed to request thumbnail from {thing_name}: {e}')
 
-    # update iot things shadows with presignad thumbnail upload/download URLs
+    return {
+        'results': {thing_name: {'success': False, 'error': str(errors[thing_name])} if thing_name in errors
+                    else {'success': True, 'skipped': bool(fresh[thing_name])}
+                    for thing_name in thing_names}
+    }
+
+
+def request_thumb(thing_name, upload_url, download_url):
+    """Publishes an upload_thumb command to the specified thing"""
+    iot_data.publish(
+        topic=f'cloudcam/{thing_name}/commands',
+        qos=1,
+        payload=json.dumps({'command': 'upload_thumb',
+                            'upload_url': upload_url,
+                            'download_url': download_url
+                            }).encode('utf-8'))
+    freshness.record_request(thing_name)
+
+
+def gen_thumb_urls(thing_names):
+    """Returns {thing_name: (upload_url, download_url)}, signing any URLs missing from the cache in one batch
+
+    The download URL the thing reports back points at its own upload rather than at thumb/{thing}.jpg, which is
+    only written once s3_thumb_derivatives has processed the upload (and not at all for duplicate frames)."""
+    if not thing_names:
+        return {}
+    url_keys = []
     for thing_name in thing_names:
-        # note: security is handled by AWS IoT policies attached to the
-        # Cognito identity, so we don't perform any checks here
-        iot_data.publish(
-            topic=f'cloudcam/{thing_name}/commands',
-            qos=1,
-            payload=json.dumps({'command': 'upload_thumb',
-                                'upload_url': gen_upload_url(thing_name),
-                                'download_url': gen_download_url(thing_name)
-                                }).encode('utf-8'))
-    return {}
+        url_keys.append((thumb_bucket_name, upload_key(thing_name), 'PUT'))
+        url_keys.append((thumb_bucket_name, upload_key(thing_name), 'GET'))
+    urls = presign.presigned_urls(tools.session(), s3.meta.region_name, url_cache, url_keys, expires_in=thumb_url_expires_in)
+    return {thing_name: (urls[2 * i], urls[2 * i + 1]) for i, thing_name in enumerate(thing_names)}
 
 
 def gen_upload_url(thing_name):
     """Returns a presigned upload (PUT) URL for the specified thing thumbnail"""
-    return s3.generate_presigned_url('put_object',
-                                     Params={'Bucket': thumb_bucket_name, 'Key': f'thumb/{thing_name}.jpg'},
-                                     ExpiresIn=3600, HttpMethod='PUT')
+    return presign.presigned_url(s3, url_cache, thumb_bucket_name, upload_key(thing_name), 'PUT',
+                                 expires_in=thumb_url_expires_in)
+
 
+def gen_download_url(thing_name, size=None, fmt='jpg'):
+    """Returns a presigned download (GET) URL for the specified thing thumbnail
 
-def gen_download_url(thing_name):
-    """Returns a presigned download (GET) URL for the specified thing thumbnail"""
-    return s3.generate_presigned_url('get_object',
-                                     Params={'Bucket': thumb_bucket_name, 'Key': f'thumb/{thing_name}.jpg'},
-                                     ExpiresIn=3600, HttpMethod='GET')
+    size selects one of the downscaled variants in thumbs.thumb_sizes (default: full size upload)"""
+    return presign.presigned_url(s3, url_cache, thumb_bucket_name, thumb_key(thing_name, size, fmt), 'GET',
+                                 expires_in=thumb_url_expires_in)
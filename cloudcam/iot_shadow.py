@@ -0,0 +1,111 @@
+"""Versioned thing shadow cache
+
+Shadow documents are cached per thing along with their version, so handlers working on the same thing in a warm
+container don't have to fetch and parse the whole document again. Updates only send the parts of the state which
+actually changed and are conditional on the cached version: if the shadow was updated by someone else in the
+meantime, IoT rejects the update with a version conflict, the document is fetched again and the change is
+reapplied on top of it, so concurrent updates of different parts of the shadow don't overwrite each other."""
+
+import copy
+import json
+import logging
+import threading
+from time import time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger()
+
+
+def diff(old: Any, new: Any) -> Any:
+    """Returns a partial shadow state turning old into new, keys which were removed are set to None"""
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return new
+    changes = {}
+    for key, value in new.items():
+        if key not in old:
+            changes[key] = value
+        elif old[key] != value:
+            changes[key] = diff(old[key], value)
+    for key in old:
+        if key not in new:
+            changes[key] = None
+    return changes
+
+
+def merge(state: Dict[str, Any], changes: Dict[str, Any]) -> Dict[str, Any]:
+    """Applies a partial shadow state the way IoT does (None deletes a key)"""
+    merged = dict(state)
+    for key, value in changes.items():
+        if value is None:
+            merged.pop(key, None)
+        elif isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class ShadowCache:
+    def __init__(self, iot_data, max_age: float = 300):
+        self.iot_data = iot_data
+        self.max_age = max_age
+        # thing name -> (state, version, fetched at)
+        self._shadows: Dict[str, Tuple[Dict[str, Any], Optional[int], float]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, thing_name: str, refresh: bool = False) -> Tuple[Dict[str, Any], Optional[int]]:
+        """Returns (state, version) of the shadow of a thing, ({}, None) if it has none
+
+        The returned state is a copy and can be modified freely."""
+        with self._lock:
+            cached = self._shadows.get(thing_name)
+        if refresh or not cached or time() - cached[2] > self.max_age:
+            cached = self.fetch(thing_name)
+        return copy.deepcopy(cached[0]), cached[1]
+
+    def fetch(self, thing_name: str):
+        try:
+            document = json.loads(self.iot_data.get_thing_shadow(thingName=thing_name)['payload'].read().decode('utf-8'))
+            cached = (document.get('state', {}), document.get('version'), time())
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ResourceNotFoundException":
+                raise
+            cached = ({}, None, time())
+        with self._lock:
+            self._shadows[thing_name] = cached
+        return cached
+
+    def invalidate(self, thing_name: str):
+        with self._lock:
+            self._shadows.pop(thing_name, None)
+
+    def update(self, thing_name: str, fn: Callable[[Dict[str, Any]], Dict[str, Any]], section: str = 'desired',
+               retries: int = 3, refresh: bool = False) -> Dict[str, Any]:
+        """Replaces a section of the shadow state (desired or reported) with fn(section)
+
+        Only the difference is sent, conditional on the cached version (or a freshly fetched one with refresh). On
+        a version conflict the shadow is fetched again and fn is called again with the fresh section. Returns the
+        new section."""
+        for attempt in range(retries + 1):
+            state, version = self.get(thing_name, refresh=refresh or attempt > 0)
+            current = state.get(section) or {}
+            new = fn(copy.deepcopy(current))
+            changes = diff(current, new)
+            if not changes:
+                return new
+            payload = {'state': {section: changes}}
+            if version is not None:
+                payload['version'] = version
+            try:
+                response = json.loads(self.iot_data.update_thing_shadow(
+                    thingName=thing_name, payload=json.dumps(payload).encode('utf-8'))['payload'].read().decode('utf-8'))
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "ConflictException" or attempt == retries:
+                    raise
+                logger.info(f'shadow of {thing_name} changed since version {version}, retrying')
+                continue
+            with self._lock:
+                self._shadows[thing_name] = (merge(state, {section: changes}), response.get('version'), time())
+            return new
@@ -0,0 +1,52 @@
+import logging
+import os
+from time import time
+
+from cloudcam import presign, thumb_history, tools
+from cloudcam.iot_list_things import list_owner_things
+
+log = logging.getLogger("cloudcam")
+log.setLevel(logging.DEBUG)
+
+thumb_bucket_name = os.getenv("S3_THUMB_BUCKET_NAME")
+
+# max number of frames returned by a single query
+history_max_frames = 500
+history_url_expires_in = 3600
+
+s3 = tools.LazyClient('s3')
+url_cache = presign.PresignedUrlCache()
+
+
+def handler(event, context):
+    """Returns presigned URLs of thumbnail history frames of a thing within a time range
+
+    Parameters: thingName, start/end (unix time in seconds, default: everything up to now) and limit
+    (max number of frames, evenly spaced across the range if there are more)."""
+    thing_name = event['thingName']
+    if not thing_name:
+        raise Exception("thingName must be specified")
+
+    identity_id = context.identity.cognito_identity_id if hasattr(context, 'identity') else None
+    if not identity_id:
+        raise Exception("Cognito identity not present")
+    if thing_name not in list_owner_things(identity_id):
+        raise Exception(f"Access to {thing_name} denied")
+
+    start_ms = int(float(event.get('start', 0)) * 1000)
+    end_ms = int(float(event.get('end', time())) * 1000)
+    limit = min(int(event.get('limit', history_max_frames)), history_max_frames)
+
+    index = thumb_history.load_index(thing_name)
+    frame_ids = thumb_history.query(index, start_ms, end_ms, limit)
+    urls = presign.presigned_urls(tools.session(), s3.meta.region_name, url_cache,
+                                  [(thumb_bucket_name, thumb_history.frame_key(thing_name, frame_id), 'GET')
+                                   for frame_id in frame_ids],
+                                  expires_in=history_url_expires_in)
+
+    return {
+        "thingName": thing_name,
+        "frameCount": len(index),
+        "frames": [{"timestamp": thumb_history.frame_timestamp_ms(frame_id) / 1000, "url": url}
+                   for frame_id, url in zip(frame_ids, urls)],
+    }
@@ -0,0 +1,160 @@
+"""Composes the latest thumbnails of all things of a Cognito identity into a single sprite image
+
+The sprite is stored next to a JSON map of tile offsets so the camera list can be rendered from one image
+download. Each tile remembers the ETag of the thumbnail it was made from, so on a rebuild only tiles whose
+thumbnail changed are downloaded and decoded. The rest are copied over from a lossless PNG copy of the previous
+sprite, so unchanged tiles don't lose quality by being re-encoded on every rebuild; the JPEG is only served."""
+
+import json
+import logging
+import math
+import os
+from io import BytesIO
+
+from botocore.exceptions import ClientError
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+
+from cloudcam import presign, tools
+from cloudcam.iot_list_things import list_owner_things
+from cloudcam.thumbs import thumb_key, thumb_sizes
+
+log = logging.getLogger("cloudcam")
+log.setLevel(logging.DEBUG)
+
+thumb_bucket_name = os.getenv("S3_THUMB_BUCKET_NAME")
+
+# sprites are made of the small thumbnail variants
+sprite_tile_size = 'small'
+sprite_jpeg_quality = 80
+sprite_url_expires_in = 3600
+
+s3 = tools.LazyClient('s3')
+url_cache = presign.PresignedUrlCache()
+
+
+def sprite_key(identity_id, ext):
+    return f'sprite/{identity_id.replace(":", "_")}.{ext}'
+
+
+def request_identity_id(event, context):
+    """Returns the Cognito identity of the caller
+
+    API Gateway proxy events carry it in requestContext.identity, direct invocations in the lambda context."""
+    identity = ((event or {}).get('requestContext') or {}).get('identity') or {}
+    if identity.get('cognitoIdentityId'):
+        return identity['cognitoIdentityId']
+    return context.identity.cognito_identity_id if getattr(context, 'identity', None) else None
+
+
+def handler(event, context):
+    """Returns a URL of the thumbnail sprite of the current Cognito identity and its tile map"""
+    identity_id = request_identity_id(event, context)
+    if not identity_id:
+        raise Exception("Cognito identity not present")
+
+    sprite_map = update_sprite(identity_id, sorted(list_owner_things(identity_id)))
+
+    result = {
+        "spriteUrl": presign.presigned_url(s3, url_cache, thumb_bucket_name, sprite_key(identity_id, 'jpg'),
+                                           expires_in=sprite_url_expires_in),
+        "spriteMap": sprite_map,
+    }
+    if event and 'requestContext' in event:
+        return {'statusCode': 200, 'headers': {'Content-Type': 'application/json'}, 'body': json.dumps(result)}
+    return result
+
+
+def thumb_etag(thing_name):
+    """Returns the ETag of the small thumbnail of a thing (None if there isn't one yet)"""
+    try:
+        return s3.head_object(Bucket=thumb_bucket_name, Key=thumb_key(thing_name, sprite_tile_size))['ETag']
+    except ClientError as e:
+        # the role has s3:ListBucket, so a 403 is a real permission error rather than a missing key
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+
+def load_image(key):
+    return Image.open(BytesIO(s3.get_object(Bucket=thumb_bucket_name, Key=key)['Body'].read())).convert('RGB')
+
+
+def load_previous_sprite(identity_id):
+    """Returns the lossless copy of the previous sprite and its tiles (None, {} if there isn't one)
+
+    The tiles are read from the PNG itself rather than the JSON map, so they always match the image."""
+    try:
+        body = s3.get_object(Bucket=thumb_bucket_name, Key=sprite_key(identity_id, 'png'))['Body'].read()
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None, {}
+        raise
+    image = Image.open(BytesIO(body))
+    tiles = json.loads(image.info.get('tiles', '{}'))
+    return image.convert('RGB'), tiles
+
+
+def load_sprite_map(identity_id):
+    try:
+        return json.loads(s3.get_object(Bucket=thumb_bucket_name, Key=sprite_key(identity_id, 'json'))['Body'].read())
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+
+
+def update_sprite(identity_id, thing_names):
+    """Rebuilds the sprite of an identity if any of its thumbnails changed, returns the sprite map"""
+    etags, errors = tools.fan_out(thumb_etag, thing_names)
+    if errors:
+        raise next(iter(errors.values()))
+    etags = {thing_name: etag for thing_name, etag in etags.items() if etag}
+    tile_width, tile_height = thumb_sizes[sprite_tile_size]
+
+    previous = load_sprite_map(identity_id)
+    if previous and {t: tile['etag'] for t, tile in previous['tiles'].items()} == etags:
+        log.info(f'sprite of {identity_id} is up to date')
+        return previous
+
+    # lay out the tiles on a roughly square grid
+    tile_things = [thing_name for thing_name in thing_names if thing_name in etags]
+    columns = max(1, math.ceil(math.sqrt(len(tile_things))))
+    rows = max(1, math.ceil(len(tile_things) / columns))
+    sprite = Image.new('RGB', (columns * tile_width, rows * tile_height))
+
+    # only fetch the previous sprite if some of its tiles can be reused
+    previous_sprite, previous_tiles = None, {}
+    if previous and any(tile['etag'] == etags.get(t) for t, tile in previous['tiles'].items()):
+        previous_sprite, previous_tiles = load_previous_sprite(identity_id)
+    changed = [t for t in tile_things if previous_tiles.get(t, {}).get('etag') != etags[t]]
+    thumbs, errors = tools.fan_out(lambda t: load_image(thumb_key(t, sprite_tile_size)), changed)
+    if errors:
+        raise next(iter(errors.values()))
+    log.info(f'rebuilding sprite of {identity_id}: {len(changed)} of {len(tile_things)} tiles changed')
+
+    tiles = {}
+    for i, thing_name in enumerate(tile_things):
+        x, y = (i % columns) * tile_width, (i // columns) * tile_height
+        if thing_name in thumbs:
+            tile = thumbs[thing_name]
+        else:
+            old = previous_tiles[thing_name]
+            tile = previous_sprite.crop((old['x'], old['y'], old['x'] + old['w'], old['y'] + old['h']))
+        sprite.paste(tile, (x, y))
+        tiles[thing_name] = {'x': x, 'y': y, 'w': tile.width, 'h': tile.height, 'etag': etags[thing_name]}
+
+    sprite_map = {'width': sprite.width, 'height': sprite.height, 'tiles': tiles}
+    png_info = PngInfo()
+    png_info.add_text('tiles', json.dumps(tiles))
+    lossless = BytesIO()
+    sprite.save(lossless, 'PNG', pnginfo=png_info)
+    s3.put_object(Bucket=thumb_bucket_name, Key=sprite_key(identity_id, 'png'), Body=lossless.getvalue(),
+                  ContentType='image/png')
+    out = BytesIO()
+    sprite.save(out, 'JPEG', quality=sprite_jpeg_quality, optimize=True)
+    s3.put_object(Bucket=thumb_bucket_name, Key=sprite_key(identity_id, 'jpg'), Body=out.getvalue(),
+                  ContentType='image/jpeg', CacheControl='no-cache')
+    s3.put_object(Bucket=thumb_bucket_name, Key=sprite_key(identity_id, 'json'), Body=json.dumps(sprite_map),
+                  ContentType='application/json', CacheControl='no-cache')
+    return sprite_map
@@ -0,0 +1,209 @@
+"""Janus gateway REST API helpers and a per-gateway session pool
+
+Creating a Janus session and attaching the streaming plugin takes two round trips (plus a TLS handshake for a
+new connection), so JanusSessionPool keeps one live HTTPS connection, session and streaming plugin handle per
+gateway for the lifetime of the container. Sessions are kept alive with keepalive requests while the process
+runs and recreated transparently if the gateway reaped them anyway (e.g. while the lambda container was frozen).
+The streaming plugin requests we make (list/create/destroy) are synchronous, their results come back in the
+response to the request itself, so there is no need for a long-poll event loop. Sessions of gateways which leave
+the inventory are dropped from the pool (see janus_start_stream.get_janus_instances). Pooled sessions are destroyed
+at process exit on a best effort basis only, a lambda container is usually killed without running exit handlers, so
+it's Janus's session_timeout which actually reaps the sessions of containers that went away.
+
+Requests can be given a deadline (in time() seconds): waiting for the session and each HTTP request are then bounded
+by the time left, so an abandoned caller doesn't keep the gateway's session busy past it."""
+
+import atexit
+import json
+import logging
+import threading
+from time import time
+from typing import Any, Dict, List, Optional
+
+import requests
+
+from cloudcam.tools import rand_string
+
+logger = logging.getLogger()
+
+janus_verify_https = False
+janus_connect_timeout = 5
+janus_rest_port = 8089
+
+# Janus reaps sessions idle for session_timeout seconds (60 by default)
+janus_session_timeout = 60
+janus_keepalive_interval = 25
+
+# Janus error codes of requests to sessions/handles which no longer exist
+janus_error_session_not_found = 458
+janus_error_handle_not_found = 459
+
+
+class JanusSessionGone(RuntimeError):
+    """Raised when the Janus session or plugin handle of a request no longer exists"""
+
+
+def janus_gateway_url(janus_gateway_dns_name):
+    return f'https://{janus_gateway_dns_name}:{janus_rest_port}/janus'
+
+
+def request_timeout(deadline: Optional[float] = None) -> float:
+    """Returns the timeout of a request made before a deadline, raises TimeoutError if it passed"""
+    if deadline is None:
+        return janus_connect_timeout
+    left = deadline - time()
+    if left <= 0:
+        raise TimeoutError("Janus request deadline passed")
+    return min(left, janus_connect_timeout)
+
+
+def janus_request(s, url, body, deadline=None):
+    """Sends a request via Janus REST API, returns the response"""
+    body = dict(body, transaction=rand_string())
+    response = s.post(url, data=json.dumps(body), verify=janus_verify_https,
+                      timeout=request_timeout(deadline)).json()
+    if response['janus'] not in ('success', 'ack'):
+        error = response.get('error', {})
+        if error.get('code') in (janus_error_session_not_found, janus_error_handle_not_found):
+            raise JanusSessionGone(f'Janus response error: {response}')
+        raise RuntimeError(f'Janus response error: {response}')
+    return response
+
+
+def janus_create_session(s, url, deadline=None):
+    """Creates a session via Janus REST API"""
+    response = janus_request(s, url, {'janus': 'create'}, deadline)
+    return url + '/' + str(response['data']['id'])
+
+
+def janus_attach_plugin(s, session_url, plugin, deadline=None):
+    """Attaches a plugin to an existing session via Janus REST API"""
+    response = janus_request(s, session_url, {'janus': 'attach', 'plugin': plugin}, deadline)
+    return session_url + '/' + str(response['data']['id'])
+
+
+def janus_send_plugin_message(s, plugin_url, body, deadline=None):
+    """Sends a message to plugin attached to an existing session via Janus REST API"""
+    return janus_request(s, plugin_url, {'janus': 'message', 'body': body}, deadline)['plugindata']['data']
+
+
+class JanusSession:
+    """A Janus session with an attached plugin handle on a single gateway, over a persistent HTTPS connection"""
+
+    def __init__(self, gateway_url: str, plugin: str = 'janus.plugin.streaming'):
+        self.gateway_url = gateway_url
+        self.plugin = plugin
+        self.http = requests.Session()
+        self.session_url: Optional[str] = None
+        self.plugin_url: Optional[str] = None
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+
+    def _open(self, deadline=None):
+        session_url = janus_create_session(self.http, self.gateway_url, deadline)
+        self.plugin_url = janus_attach_plugin(self.http, session_url, self.plugin, deadline)
+        self.session_url = session_url
+        logger.info(f'opened Janus session {self.plugin_url}')
+
+    def message(self, body: Dict[str, Any], deadline: Optional[float] = None) -> Dict[str, Any]:
+        """Sends a message to the plugin, (re)opening the session if needed
+
+        Raises TimeoutError if the deadline passes before the session is free or a request is sent."""
+        if not self.lock.acquire(timeout=max(deadline - time(), 0) if deadline is not None else -1):
+            raise TimeoutError(f'Janus session of {self.gateway_url} busy until the deadline')
+        try:
+            if not self.session_url or time() - self.last_used > janus_session_timeout:
+                self._open(deadline)
+            try:
+                data = janus_send_plugin_message(self.http, self.plugin_url, body, deadline)
+            except JanusSessionGone:
+                logger.info(f'Janus session {self.session_url} is gone, reopening')
+                self._open(deadline)
+                data = janus_send_plugin_message(self.http, self.plugin_url, body, deadline)
+            self.last_used = time()
+            return data
+        finally:
+            self.lock.release()
+
+    def keepalive(self):
+        """Refreshes the session if it's been idle for a while"""
+        with self.lock:
+            if not self.session_url or time() - self.last_used < janus_keepalive_interval:
+                return
+            if time() - self.last_used > janus_session_timeout:
+                # already reaped, reopened on next use
+                self.session_url = self.plugin_url = None
+                return
+            try:
+                janus_request(self.http, self.session_url, {'janus': 'keepalive'})
+                self.last_used = time()
+            except Exception as e:
+                logger.info(f'Janus keepalive of {self.session_url} failed: {e}')
+                self.session_url = self.plugin_url = None
+
+    def destroy(self):
+        with self.lock:
+            if self.session_url:
+                try:
+                    janus_request(self.http, self.session_url, {'janus': 'destroy'})
+                except Exception as e:
+                    logger.info(f'failed to destroy Janus session {self.session_url}: {e}')
+                self.session_url = self.plugin_url = None
+            self.http.close()
+
+
+class JanusSessionPool:
+    def __init__(self):
+        self._sessions: Dict[str, JanusSession] = {}
+        self._lock = threading.Lock()
+        self._keepalive_thread: Optional[threading.Thread] = None
+
+    def session(self, janus_gateway_dns_name: str) -> JanusSession:
+        """Returns the pooled streaming plugin session of a gateway"""
+        with self._lock:
+            session = self._sessions.get(janus_gateway_dns_name)
+            if session is None:
+                session = self._sessions[janus_gateway_dns_name] = JanusSession(
+                    janus_gateway_url(janus_gateway_dns_name))
+            if not self._keepalive_thread:
+                self._keepalive_thread = threading.Thread(target=self._keepalive_loop, name='janus-keepalive',
+                                                          daemon=True)
+                self._keepalive_thread.start()
+        return session
+
+    def gateways(self) -> List[str]:
+        """Returns the dns names of the gateways with a pooled session"""
+        with self._lock:
+            return list(self._sessions)
+
+    def discard(self, janus_gateway_dns_name: str, destroy: bool = True):
+        """Drops the pooled session of a gateway, e.g. when the gateway goes away
+
+        The Janus session is destroyed unless destroy is False, e.g. when the gateway is gone and would only make
+        the request time out."""
+        with self._lock:
+            session = self._sessions.pop(janus_gateway_dns_name, None)
+        if session:
+            if destroy:
+                session.destroy()
+            else:
+                session.http.close()
+
+    def close(self):
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.destroy()
+
+    def _keepalive_loop(self):
+        stop = threading.Event()
+        while not stop.wait(janus_keepalive_interval / 2):
+            with self._lock:
+                sessions = list(self._sessions.values())
+            for session in sessions:
+                session.keepalive()
+
+
+pool = JanusSessionPool()
+atexit.register(pool.close)
@@ -0,0 +1,105 @@
+"""Cached inventory of Janus gateways (Lightsail instances)
+
+Listing Lightsail instances is slow, so the running and pending Janus instances are cached in the state store (see
+store.py) under janus-inventory/{instance name prefix} for JANUS_INVENTORY_TTL seconds, and in memory for a few
+seconds on top of that. janus_scale_lightsail rewrites the record whenever it creates or removes instances, so the
+TTL only matters for changes made outside of it. Instances which are still pending are listed with ready set to
+false and not handed out; while there are any, the inventory is listed again every JANUS_INVENTORY_PENDING_TTL
+seconds so they are picked up soon after they start running.
+
+Records keep the parts of the Lightsail instance dicts we use (name, bundleId, hardware.cpuCount, state.name) and
+ready."""
+
+import logging
+import os
+import threading
+from time import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from cloudcam import store
+
+logger = logging.getLogger()
+
+inventory_ttl = int(os.getenv('JANUS_INVENTORY_TTL', 300))
+local_ttl = int(os.getenv('JANUS_INVENTORY_LOCAL_TTL', 15))
+pending_ttl = int(os.getenv('JANUS_INVENTORY_PENDING_TTL', 30))
+
+# instances in these states are listed, only running ones are ready to take streams
+listed_states = ('pending', 'running')
+
+
+def list_instances(lightsail, prefix: str) -> List[Dict[str, Any]]:
+    """Returns all Lightsail instances whose names start with prefix"""
+    instances = []
+    kwargs = {}
+    while True:
+        res = lightsail.get_instances(**kwargs)
+        instances.extend(instance for instance in res['instances'] if instance['name'].startswith(prefix))
+        if not res.get('nextPageToken'):
+            return instances
+        kwargs['pageToken'] = res['nextPageToken']
+
+
+def instance_record(instance: Dict[str, Any]) -> Dict[str, Any]:
+    return {'name': instance['name'],
+            'bundleId': instance.get('bundleId'),
+            'hardware': {'cpuCount': instance.get('hardware', {}).get('cpuCount')},
+            'state': {'name': instance.get('state', {}).get('name')},
+            'ready': instance.get('state', {}).get('name') == 'running'}
+
+
+def inventory_key(prefix: str) -> str:
+    return f'janus-inventory/{prefix}'
+
+
+class GatewayInventory:
+    def __init__(self, lightsail, prefix: str, state_store: Optional[store.Store] = None):
+        self.lightsail = lightsail
+        self.prefix = prefix
+        self._store = state_store
+        # (records, fetched at)
+        self._cached = None
+        self._lock = threading.Lock()
+
+    @property
+    def store(self) -> Optional[store.Store]:
+        return self._store or store.default_store()
+
+    def instances(self) -> List[Dict[str, Any]]:
+        """Returns the Janus instances which are ready to take streams"""
+        return [record for record in self.records() if record['ready']]
+
+    def records(self) -> List[Dict[str, Any]]:
+        """Returns the running and pending Janus instances"""
+        with self._lock:
+            cached = self._cached
+        if cached and time() - cached[1] < local_ttl:
+            return cached[0]
+
+        if self.store:
+            value, _ = self.store.get(inventory_key(self.prefix))
+            if value is not None and time() - value['updatedAt'] < self._ttl(value['instances']):
+                with self._lock:
+                    self._cached = (value['instances'], time())
+                return value['instances']
+
+        return self.refresh()
+
+    @staticmethod
+    def _ttl(records: List[Dict[str, Any]]) -> int:
+        return pending_ttl if not all(record['ready'] for record in records) else inventory_ttl
+
+    def refresh(self, exclude: Iterable[str] = ()) -> List[Dict[str, Any]]:
+        """Lists the running and pending Janus instances from Lightsail and rewrites the cached inventory
+
+        Instances named in exclude are left out (e.g. ones being deleted which are still listed as running)."""
+        exclude = set(exclude)
+        records = [instance_record(instance) for instance in list_instances(self.lightsail, self.prefix)
+                   if instance['state']['name'] in listed_states and instance['name'] not in exclude]
+        logger.info(f'Janus inventory: {", ".join(record["name"] for record in records if record["ready"])}, '
+                    f'pending: {", ".join(record["name"] for record in records if not record["ready"])}')
+        if self.store:
+            self.store.put(inventory_key(self.prefix), {'instances': records, 'updatedAt': time()})
+        with self._lock:
+            self._cached = (records, time())
+        return records
@@ -0,0 +1,193 @@
+"""Load-aware placement of streams on Janus gateways
+
+The load of each gateway (number of streams from the streaming plugin list, and the bandwidth they take estimated
+from the bitrate we create streams with, as Janus doesn't report it) is compared with the capacity of its Lightsail
+bundle. A scheduler ranks the gateways which still have headroom for another stream, gateways which would go over
+JANUS_MAX_UTILIZATION are never used. Schedulers are pluggable, see schedulers and JANUS_PLACEMENT_SCHEDULER.
+
+Loads are cached and refreshed in the background once older than JANUS_LOAD_MAX_AGE seconds, so placing a stream
+only waits for the gateways whose load isn't known yet."""
+
+import abc
+import json
+import logging
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from cloudcam import janus_api, tools
+
+logger = logging.getLogger()
+
+# bitrate of the streams we create, the bandwidth taken by a gateway is estimated from it
+stream_bitrate_kbps = 256
+
+# gateway capacity per CPU of its Lightsail bundle, JANUS_BUNDLE_CAPACITY can override it per bundle, e.g.
+# {"medium_2_0": {"streams": 150, "kbps": 60000}}
+streams_per_cpu = int(os.getenv('JANUS_STREAMS_PER_CPU', 100))
+kbps_per_cpu = int(os.getenv('JANUS_KBPS_PER_CPU', 40000))
+bundle_capacity = json.loads(os.getenv('JANUS_BUNDLE_CAPACITY') or '{}')
+
+# gateways are not given new streams past this fraction of their capacity
+max_utilization = float(os.getenv('JANUS_MAX_UTILIZATION', 0.9))
+
+# how old the cached load of a gateway may get before it's refreshed in the background
+load_max_age = float(os.getenv('JANUS_LOAD_MAX_AGE', 10))
+
+scheduler_name = os.getenv('JANUS_PLACEMENT_SCHEDULER', 'least-loaded')
+
+
+class NoGatewayCapacity(RuntimeError):
+    pass
+
+
+class GatewayLoad:
+    """Load and capacity of a gateway
+
+    estimated_kbps is the bandwidth the streams would take at stream_bitrate_kbps, not a measurement."""
+
+    def __init__(self, gateway: Dict[str, Any], streams: int, estimated_kbps: int, max_streams: int, max_kbps: int):
+        self.gateway = gateway
+        self.streams = streams
+        self.estimated_kbps = estimated_kbps
+        self.max_streams = max_streams
+        self.max_kbps = max_kbps
+
+    def utilization(self, extra_streams: int = 0) -> float:
+        """Returns the fraction of the capacity used (by the current streams and extra_streams more)"""
+        return max((self.streams + extra_streams) / self.max_streams,
+                   (self.estimated_kbps + extra_streams * stream_bitrate_kbps) / self.max_kbps)
+
+    def headroom_p(self) -> bool:
+        """Whether another stream fits on the gateway"""
+        return self.utilization(1) <= max_utilization
+
+    def __repr__(self):
+        return f'<GatewayLoad {self.gateway["public_dns_name"]} {self.streams} streams ~{self.estimated_kbps} kbps ' \
+               f'{self.utilization():.0%}>'
+
+
+def gateway_capacity(gateway: Dict[str, Any]):
+    """Returns (max streams, max kbps) of a gateway, from its Lightsail bundle"""
+    capacity = bundle_capacity.get(gateway.get('bundle_id'))
+    if capacity:
+        return capacity['streams'], capacity['kbps']
+    cpu_count = gateway.get('cpu_count') or 1
+    return cpu_count * streams_per_cpu, cpu_count * kbps_per_cpu
+
+
+def janus_stream_count(gateway: Dict[str, Any]) -> int:
+    """Returns the number of streams on a gateway"""
+    return len(janus_api.pool.session(gateway['public_dns_name']).message({'request': 'list'})['list'])
+
+
+class GatewayLoadCache:
+    def __init__(self, stream_count: Callable[[Dict[str, Any]], int] = janus_stream_count,
+                 max_age: float = load_max_age, background_refresh: bool = True):
+        self.stream_count = stream_count
+        self.max_age = max_age
+        # stale loads are refreshed by a single worker, otherwise they are fetched before being returned
+        self.background_refresh = background_refresh
+        # dns name -> (stream count or None if the gateway couldn't be queried, fetched at)
+        self._streams: Dict[str, Any] = {}
+        self._refreshing = set()
+        self._refresh_executor = ThreadPoolExecutor(max_workers=1) if background_refresh else None
+        self._lock = threading.Lock()
+
+    def _fetch(self, gateway):
+        dns_name = gateway['public_dns_name']
+        try:
+            streams = self.stream_count(gateway)
+        except Exception as e:
+            logger.warning(f'failed to get load of gateway {dns_name}: {e}')
+            streams = None
+        with self._lock:
+            self._streams[dns_name] = (streams, time())
+            self._refreshing.discard(dns_name)
+        return streams
+
+    def _load(self, gateway):
+        dns_name = gateway['public_dns_name']
+        with self._lock:
+            cached = self._streams.get(dns_name)
+            stale = not cached or time() - cached[1] > self.max_age
+            refresh = stale and cached and self.background_refresh and dns_name not in self._refreshing
+            if refresh:
+                self._refreshing.add(dns_name)
+        if refresh:
+            self._refresh_executor.submit(self._fetch, gateway)
+        if not stale or (cached and self.background_refresh):
+            return cached[0]
+        return self._fetch(gateway)
+
+    def loads(self, gateways: Iterable[Dict[str, Any]]) -> List[GatewayLoad]:
+        """Returns the load of the gateways which could be queried, fetching unknown ones concurrently"""
+        gateways = {gateway['public_dns_name']: gateway for gateway in gateways}
+        counts, _ = tools.fan_out(lambda dns_name: self._load(gateways[dns_name]), gateways)
+        loads = []
+        for dns_name, gateway in gateways.items():
+            streams = counts.get(dns_name)
+            if streams is not None:
+                loads.append(GatewayLoad(gateway, streams, streams * stream_bitrate_kbps,
+                                         *gateway_capacity(gateway)))
+        return loads
+
+    def add_stream(self, dns_name: str, count: int = 1):
+        """Accounts for a stream placed on a gateway until its load is fetched again"""
+        with self._lock:
+            cached = self._streams.get(dns_name)
+            if cached and cached[0] is not None:
+                self._streams[dns_name] = (cached[0] + count, cached[1])
+
+    def invalidate(self, dns_name: Optional[str] = None):
+        with self._lock:
+            if dns_name:
+                self._streams.pop(dns_name, None)
+            else:
+                self._streams.clear()
+
+
+class Scheduler(abc.ABC):
+    @abc.abstractmethod
+    def rank(self, loads: List[GatewayLoad]) -> List[GatewayLoad]:
+        """Returns the gateways which have headroom for another stream, best first"""
+
+
+class LeastLoadedScheduler(Scheduler):
+    """Prefers the gateway which would be the least utilized after taking the stream"""
+
+    def rank(self, loads):
+        return sorted(filter(GatewayLoad.headroom_p, loads),
+                      key=lambda load: (load.utilization(1), load.streams, load.gateway['public_dns_name']))
+
+
+class RandomScheduler(Scheduler):
+    """Picks gateways at random, as long as they have headroom"""
+
+    def rank(self, loads):
+        loads = list(filter(GatewayLoad.headroom_p, loads))
+        random.shuffle(loads)
+        return loads
+
+
+schedulers = {
+    'least-loaded': LeastLoadedScheduler,
+    'random': RandomScheduler,
+}
+
+
+class Placement:
+    def __init__(self, scheduler: Optional[Scheduler] = None, load_cache: Optional[GatewayLoadCache] = None):
+        self.scheduler = scheduler or schedulers[scheduler_name]()
+        self.load_cache = load_cache or GatewayLoadCache()
+
+    def rank(self, gateways: Iterable[Dict[str, Any]], exclude: Iterable[str] = ()) -> List[Dict[str, Any]]:
+        """Returns gateways with headroom for another stream, best first, skipping the excluded dns names"""
+        exclude = set(exclude)
+        loads = self.load_cache.loads(g for g in gateways if g['public_dns_name'] not in exclude)
+        ranked = self.scheduler.rank(loads)
+        logger.info(f'gateway ranking: {ranked}')
+        return [load.gateway for load in ranked]
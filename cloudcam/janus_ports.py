@@ -0,0 +1,99 @@
+"""RTP port allocation on Janus gateways
+
+The RTP ports of each gateway are tracked in a bitmap in the state store (see store.py) under
+janus-ports/{gateway dns name}, one bit per even port of janus_rtp_port_range. A port is allocated by setting the
+lowest clear bit with a conditional write, so concurrent stream starts on the same gateway never get the same port,
+and freed again when reconciliation finds its stream gone.
+
+The bitmap is reconciled with the streams which actually exist on the gateway every JANUS_PORT_RECONCILE_INTERVAL
+seconds (streams go away when Janus restarts, ports may be used by streams created elsewhere). Ports allocated within
+the last allocation_grace seconds are kept, their streams may not have been created yet.
+
+Without a STATE_STORE the bitmaps are kept in memory, which is only safe within a single process."""
+
+import logging
+import os
+from time import time
+from typing import Callable, Iterable, Optional
+
+from cloudcam import store
+
+logger = logging.getLogger()
+
+janus_rtp_port_range = range(20000, 21000, 2)
+
+reconcile_interval = int(os.getenv('JANUS_PORT_RECONCILE_INTERVAL', 300))
+allocation_grace = 60
+
+_memory_store = store.MemoryStore()
+
+
+def ports_key(janus_gateway_dns_name: str) -> str:
+    return f'janus-ports/{janus_gateway_dns_name}'
+
+
+def lowest_clear_bit(bits: int) -> int:
+    return (~bits & (bits + 1)).bit_length() - 1
+
+
+class PortAllocator:
+    def __init__(self, state_store: Optional[store.Store] = None, port_range: range = janus_rtp_port_range):
+        self._store = state_store
+        self.port_range = port_range
+
+    @property
+    def store(self) -> store.Store:
+        return self._store or store.default_store() or _memory_store
+
+    def _index(self, port: int) -> int:
+        if port not in self.port_range:
+            raise ValueError(f'{port} is not in RTP port range {self.port_range}')
+        return (port - self.port_range.start) // self.port_range.step
+
+    def allocate(self, janus_gateway_dns_name: str, used_ports: Optional[Callable[[], Iterable[int]]] = None) -> int:
+        """Allocates a free port on a gateway
+
+        used_ports returns the ports in use on the gateway, it's called when the bitmap is due for reconciliation."""
+        key = ports_key(janus_gateway_dns_name)
+        value, _ = self.store.get(key)
+        if used_ports and (value is None or time() - value['reconciledAt'] > reconcile_interval):
+            self.reconcile(janus_gateway_dns_name, used_ports())
+
+        allocated = None
+
+        def allocate(value):
+            nonlocal allocated
+            now = time()
+            bits = int(value['bits'], 16) if value else 0
+            index = lowest_clear_bit(bits)
+            if index >= len(self.port_range):
+                raise RuntimeError("Unable to allocate RTP port")
+            allocated = self.port_range[index]
+            recent = {port: at for port, at in (value or {}).get('recent', {}).items() if now - at < allocation_grace}
+            recent[str(allocated)] = now
+            return {'bits': format(bits | 1 << index, 'x'),
+                    'recent': recent,
+                    'reconciledAt': value['reconciledAt'] if value else 0}
+
+        self.store.update(key, allocate)
+        logger.info(f'allocated RTP port {allocated} on {janus_gateway_dns_name}')
+        return allocated
+
+    def reconcile(self, janus_gateway_dns_name: str, used_ports: Iterable[int]):
+        """Replaces the bitmap of a gateway with the ports in use on it, keeping recently allocated ports"""
+        used_bits = 0
+        for port in used_ports:
+            if port in self.port_range:
+                used_bits |= 1 << self._index(port)
+
+        def reconcile(value):
+            now = time()
+            bits = used_bits
+            recent = {port: at for port, at in (value or {}).get('recent', {}).items() if now - at < allocation_grace}
+            for port in recent:
+                bits |= 1 << self._index(int(port))
+            if value and value['bits'] != format(bits, 'x'):
+                logger.info(f'reconciled RTP ports of {janus_gateway_dns_name}: {value["bits"]} -> {bits:x}')
+            return {'bits': format(bits, 'x'), 'recent': recent, 'reconciledAt': now}
+
+        self.store.update(ports_key(janus_gateway_dns_name), reconcile)
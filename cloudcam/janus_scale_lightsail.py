@@ -3,8 +3,9 @@ import logging
 import os
 import random
 import time
-import boto3
 import base64
+from functools import lru_cache
+from cloudcam import janus_inventory, tools
 from cloudcam.tools import rand_string
 
 logger = logging.getLogger()
@@ -66,17 +67,20 @@ janus_encrypted_ssl_key_pem = """
 AQICAHis7Bk3aJWyhBrASLOI3VFZZioQz+0hpmQUNTLY3S0U9wHxY3acfQUeNboxG6gsWy6YAAAHEDCCBwwGCSqGSIb3DQEHBqCCBv0wggb5AgEAMIIG8gYJKoZIhvcNAQcBMB4GCWCGSAFlAwQBLjARBAxMf2Au59uIXPtM5ogCARCAggbDogpUEVNtQ8quksTmFgOm/c0S8OcHupJA77foE7RVfIs5Ec8HFQw3tmjdRRzpIUivFEOrJDRRe7UP5RzqRWOla6qupbIaHiBlLb3IrG/V2txuWWDP5UtnSUhyZrYmh0SxiQwo4xbpImCByfrP5IzFMLGTATwe6HSEbzdhwjk5TCw4GoyRV+SJUtbgSb9PJ//rvQ2jNv4tOt5RXT5tLppUq+3K0sa988rI9vkQ8VhhZV3fsY5rTgiDgySnwMexugiZ+M8sLHms539PctXf5kjRjzm86YxXw5zLxJHSjNJyPEBNHuz2Y6TCbhNDPV4jC/3dYmRZQwnZfGE+ec5ygBHqioAasILzg5COPcQEhvC/k+koZDC0oag9soz2rHjDClvuiYKyJEsIXoVrIHa9IHzgaurOYp5eWZIWk9a/qutsRhR1ScbzyszG44pB/3Aevo1LhRaKB0DeJgdngD59p13MORVedeLvOHVWMZpexESn7OQrAzZTEdFF17u+GgFRkAjjo55kvl2ZxsbzOvNyCl7LVED5tTKr24E5ikSdXzm38nLMnAMlRqO1ZgfDi4Kxgq0FOZI05RRXxRifjThG85EE6ZrkmFK+KG5CFMx2uIecdlWzrJOTxQ41YZG8DRRQwC8zAKAuywJjfsnIXye6dn1wJl3vE5K5MWo8uOINbJu5/6KqbxPBV5Gi4ydsCbZZkL+Lpm+9M11TyHzpZTEPckuYceu1/Ddv4wVHKhQRdADxRMCBBPx/yh/8JIPKkMatilBlzkn8MvVQMmbww2Pxzmcw+D4Rb6qeLTUA+hKsk3xaRwswUU5zQw1AorvMlHebou9pQdTYQ/+vGf1j/1cYoDHQjBEywoEPUYYwYf8KZW/bdyPN7Kf6Bn27soqZKRT9bxM8X13IEv3bgsLGt0YAHHr9/baPB/gDEIvy0/SrquUp/lVhbrCFwUhiSz/4k7hFsIZQROv1UfOXwyMriKAwhxtMQgdfTsD4H7Du6Lp4QpK27wq0dTkUqnzVqf3o3QyBe6/HyBNeGqOQ3Lu8ieBhxnJDzkoY+PzHtzhuuZm+nP1tT/X75btG4XqgjpcpUD5fZ0zgaZaoC/IDOG2glNqV8MYsZO8CujhQYp7EGm3gTObFWEX+1psqrwy8UniaaFvX7t5T73Tl9glVx0oHEayhWxL9T9Y2WA/kAgECCZWBeob1ldLNO2L60zF7EXJSHtkwrlC6kN35A1HVo3vGLQA4R3NpeLjvtyJcBFpn7U+IbarWy+6ad8avkBsbDz4HjaS45P9WIY42aABByZn8PukT9qZ+r49ozgINO3QWiGrLrZuhJ5nSz+xjObXmGatXlV++Cb405vYP6luqBtoC8KBZAyQ/Hp6VQITzE3zCCwtB0opq0B7hxEbh2Z8xGsAsSZH/Aj/HpBsvXdMV87jaCL20ifjkULRaVTW5nKstf/VtoV0RtW9abNbLzhxr/k6pAyVylSKysTJjY3YcV+qfINIv8kVRU8pj2ZDSlXuKswXuZwc6ERtwa1v7fJj6oDzY9g5GNF79EmNRvE5bEDCaHZEwbC0N4Djd0wowJ3iKz5G+ihCSnD26jubhEQ6oMoBbRMMEffTva0MflzL6qksmvupDvDekfkdVH1QESppn3iBrmgsZV0/WBM7L8V00xQMRjcR6shdCiFjP7L/HGdPowlnzrW1ogHegmsJ46+rf8B3NagOZbrcCQiv58I4qrAQ+78TpaSODVBvrK8hCH6hva0+L/Gh06b8cVBBTtpSXTX/4+VodoLXbONtV/ox95tvxkfG0hMiYBwpmireRKKpHe5J5Pc8SwjWQFch73TLik3dEnEtPMtlgcy5Qngb1i7kIIAn0eGXdZlr1BnJ2JFlwYkIfGweu2TVVYyWWg30vKKdF78XrEa/fRJSWWZ98eUfFwtSOrMknOH16RBGJ30RNRhi5NKNNnQyWMN7qhYGwpv4WW///TFoidsrwrBl8F15l3n3eEjMWLf8T6kSNtFLoxw+gK3mUBCYPwN15vd7OFE/1MJcqh00VEqI13Q4FRaTZI8KAuaLdxItbYgaVG4FD0prvULmmiqAyaA227ujWZl3gC+BBVXd0zCrAzQ9CbhWMQHiM1WoVkRztTTzJPFndmupyBZYvn0pK+C503yywK1Rc/XTzdueP6Fz7BHyWGfrX4ZofujyI7JO/Av/b3mbM1MZ0wDZQgxzdCDmxGNh2R5hpJ/dKMt/kmu+6ENqecg16q8pAzhgsRL16FvTIHdtmmdZD84LLTblKKaMkmqW2OupnOJeuj9j1kEYObJOtk7EPR5CHgDXDifm3
 """
 
-lightsail = boto3.client('lightsail')
-route53 = boto3.client('route53')
-cloudwatch_us_east_1 = boto3.client('cloudwatch',
-                                    region_name='us-east-1')  # this is required for Route53 health check alarms
-kms = boto3.client('kms')
-sts = boto3.client('sts')
+lightsail = tools.LazyClient('lightsail')
+route53 = tools.LazyClient('route53')
+inventory = janus_inventory.GatewayInventory(lightsail, janus_instance_name_prefix)
+cloudwatch_us_east_1 = tools.LazyClient('cloudwatch',
+                                        region_name='us-east-1')  # this is required for Route53 health check alarms
+kms = tools.LazyClient('kms')
+sts = tools.LazyClient('sts')
 
-aws_account_id = sts.get_caller_identity()['Account']
 
 # Route53 health check alarms topic must reside in us-east-1 so it's created elsewhere and referenced here by the arn
-janus_health_check_alarms_topic_arn = f'arn:aws:sns:us-east-1:{aws_account_id}:JanusHealthCheckAlarms'
+@lru_cache(maxsize=None)
+def get_janus_health_check_alarms_topic_arn():
+    aws_account_id = sts.get_caller_identity()['Account']
+    return f'arn:aws:sns:us-east-1:{aws_account_id}:JanusHealthCheckAlarms'
 
 
 def get_lightsail_init_script():
@@ -108,9 +112,8 @@ EOF
 
 
 def get_janus_instances():
-    """Returns a list of Janus instances available for stream allocation"""
-    return list(filter(lambda instance: instance['name'].startswith(janus_instance_name_prefix),
-                       lightsail.get_instances()['instances']))
+    """Returns a list of all Janus instances, straight from Lightsail"""
+    return janus_inventory.list_instances(lightsail, janus_instance_name_prefix)
 
 
 def open_instance_public_tcp_port(instance_name, port):
@@ -152,8 +155,11 @@ def create_janus_instance():
     for _ in range(120):
         time.sleep(1)
         if get_instance_status(instance_name) == 'running':
+            logger.info(f'Instance {instance_name} is running')
             break
-    logger.info(f'Instance {instance_name} is running')
+    else:
+        # listed as pending in the gateway inventory, which picks it up once it's running
+        logger.warning(f'Instance {instance_name} is not running yet, setting it up anyway')
     # open ports requred for Janus
     for port in [8080, 8088, 8089, 7889, 8188]:
         open_instance_public_tcp_port(instance_name, port)
@@ -206,7 +212,7 @@ def create_janus_instance():
         AlarmName=f'{domain_name}',
         AlarmDescription=f'Alarm for Route53 health check on https://{domain_name}:8089/janus/info endpoint',
         ActionsEnabled=True,
-        AlarmActions=[janus_health_check_alarms_topic_arn],
+        AlarmActions=[get_janus_health_check_alarms_topic_arn()],
         MetricName='HealthCheckStatus',
         Namespace='AWS/Route53',
         Statistic='Minimum',
@@ -289,13 +295,14 @@ def handler(event, context):
     # required_instance_count is specified, add/remove instances until the actual count matches the required_instance_count
     deleted_instance = False
     created_instance = False
+    removed_instance_names = []
     if required_instance_count is not None:
         logger.info(
             f'Janus instance required count: {required_instance_count}, current count: {current_instance_count}')
         if current_instance_count > required_instance_count:
             for _ in range(current_instance_count - required_instance_count):
                 remove_janus_instance(instances[-1]['name'])
-                instances.pop()
+                removed_instance_names.append(instances.pop()['name'])
                 deleted_instance = True
         elif current_instance_count < required_instance_count:
             for _ in range(required_instance_count - current_instance_count):
@@ -312,8 +319,12 @@ def handler(event, context):
                 instance_name = matching_instance['name']
                 logger.info(f'Instance {instance_name} is dead, replacing it with a new one')
                 remove_janus_instance(instance_name)
+                removed_instance_names.append(instance_name)
                 create_janus_instance()
 
+    # rewrite the gateway inventory used for stream allocation, deleted instances may still be listed as running
+    if removed_instance_names or created_instance:
+        inventory.refresh(exclude=removed_instance_names)
 
     return {
         'current_count': current_instance_count,
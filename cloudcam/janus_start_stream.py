@@ -1,26 +1,35 @@
 import json
 import logging
-import random
+import threading
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from time import time
 import os
+from cloudcam import janus_api, janus_inventory, janus_placement, janus_ports, tools
+from cloudcam.iot_shadow import ShadowCache
 from cloudcam.tools import rand_string
 
-import boto3
-import requests
-
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-janus_verify_https = False
-janus_connect_timeout = 5
-janus_rtp_port_range = range(20000, 21000, 2)
 janus_hosted_zone_domain = os.environ['JANUS_HOSTED_ZONE_DOMAIN']
 janus_instance_name_prefix = os.environ['JANUS_INSTANCE_NAME_PREFIX']
 
-lightsail = boto3.client('lightsail')
+# max time spent allocating a stream on a single gateway before failing over to the next one
+janus_allocate_timeout = float(os.getenv('JANUS_ALLOCATE_TIMEOUT', 6))
+
+lightsail = tools.LazyClient('lightsail')
+inventory = janus_inventory.GatewayInventory(lightsail, janus_instance_name_prefix)
 
-iot = boto3.client('iot')
-iot_data = boto3.client('iot-data')
+iot = tools.LazyClient('iot')
+iot_data = tools.LazyClient('iot-data')
+shadows = ShadowCache(iot_data)
+placement = janus_placement.Placement()
+ports = janus_ports.PortAllocator()
+
+# runs allocation attempts, a timed out attempt keeps its worker until its in-flight Janus request times out
+allocation_executor = ThreadPoolExecutor(max_workers=8)
 
 
 def get_lightsail_public_dns_name(instance):
@@ -29,65 +38,33 @@ def get_lightsail_public_dns_name(instance):
 
 def translate_lightsail_instance(instance):
     return {'instance_id': instance['name'],
-            'public_dns_name': get_lightsail_public_dns_name(instance)}
+            'public_dns_name': get_lightsail_public_dns_name(instance),
+            'bundle_id': instance.get('bundleId'),
+            'cpu_count': instance.get('hardware', {}).get('cpuCount')}
 
 
 def get_janus_instances():
-    """Returns a list of Janus instances available for stream allocation (AWS Lightsail)"""
-    return list(map(translate_lightsail_instance,
-                    filter(lambda instance: instance['name'].startswith(janus_instance_name_prefix),
-                           lightsail.get_instances()['instances'])))
-
-
-def janus_create_session(s, url):
-    """Creates a session via Janus REST API"""
-    response = s.post(url, data=json.dumps({'janus': 'create', 'transaction': rand_string()}),
-                      verify=janus_verify_https, timeout=janus_connect_timeout).json()
-    if response['janus'] != 'success':
-        raise RuntimeError(f'Janus response error: {response}')
-    return url + '/' + str(response['data']['id'])
-
-
-def janus_attach_plugin(s, session_url, plugin):
-    """Attaches a plugin to an existing session via Janus REST API"""
-    response = s.post(session_url, data=json.dumps({'janus': 'attach',
-                                                    'plugin': plugin,
-                                                    'transaction': rand_string()}),
-                      verify=janus_verify_https, timeout=janus_connect_timeout).json()
-    if response['janus'] != 'success':
-        raise RuntimeError(f'Janus response error: {response}')
-    return session_url + '/' + str(response['data']['id'])
-
-
-def janus_send_plugin_message(s, plugin_url, body):
-    """Sends a message to plugin attached to an existing session via Janus REST API"""
-    response = s.post(plugin_url, data=json.dumps({'janus': 'message',
-                                                   'body': body,
-                                                   'transaction': rand_string()}),
-                      verify=janus_verify_https, timeout=janus_connect_timeout).json()
-    if response['janus'] != 'success':
-        raise RuntimeError(f'Janus response error: {response}')
-    return response['plugindata']['data']
-
-
-def janus_allocate_stream(janus_gateway_dns_name, stream):
-    """Allocates a RTP input stream on a specified Janus instance via Janus REST API"""
-    janus_rest_url = f'https://{janus_gateway_dns_name}:8089/janus'
-    logger.info(janus_rest_url)
-
-    # use a requests session so https connection persists across requests
-    s = requests.Session()
-
-    # create Janus session
-    session_url = janus_create_session(s, janus_rest_url)
-    logger.info(session_url)
-
-    # attach streaming plugin to the session
-    streaming_plugin_url = janus_attach_plugin(s, session_url, 'janus.plugin.streaming')
-    logger.info(streaming_plugin_url)
+    """Returns a list of Janus instances available for stream allocation (AWS Lightsail, cached)
+
+    Pooled Janus sessions of gateways which are no longer available are dropped, so they aren't kept alive."""
+    janus_instances = list(map(translate_lightsail_instance, inventory.instances()))
+    available = {instance['public_dns_name'] for instance in janus_instances}
+    for dns_name in janus_api.pool.gateways():
+        if dns_name not in available:
+            logger.info(f'dropping Janus session of {dns_name}, no longer in the inventory')
+            janus_api.pool.discard(dns_name, destroy=False)
+    return janus_instances
+
+
+def janus_allocate_stream(janus_gateway_dns_name, stream, deadline=None):
+    """Allocates a RTP input stream on a specified Janus instance via Janus REST API
+
+    Janus requests are not sent after the deadline (in time() seconds)."""
+    # the https connection, Janus session and streaming plugin handle are reused across invocations
+    janus = janus_api.pool.session(janus_gateway_dns_name)
 
     # list existing streams
-    streams = janus_send_plugin_message(s, streaming_plugin_url, {'request': 'list'})['list']
+    streams = janus.message({'request': 'list'}, deadline)['list']
     logger.info(streams)
 
     rtp_port = None
@@ -98,71 +75,171 @@ def janus_allocate_stream(janus_gateway_dns_name, stream):
 
     # check if there's a stream already allocated (this data is stored in the iot thing shadow)
     if stream and stream['stream_name']:
-        for st in streams:
-            if st.get('id') == stream['stream_id'] and st.get('description') == stream['stream_name']:
-                rtp_port = stream['stream_rtp_port']
-                stream_id = stream['stream_id']
-                stream_name = stream['stream_name']
-                stream_secret = stream['stream_secret']
-                stream_pin = stream['stream_pin']
-
-    # otherwise, find a free port pair for RTP input and create the stream
+        st = {o.get('id'): o for o in streams}.get(stream['stream_id'])
+        if st and st.get('description') == stream['stream_name']:
+            rtp_port = stream['stream_rtp_port']
+            stream_id = stream['stream_id']
+            stream_name = stream['stream_name']
+            stream_secret = stream['stream_secret']
+            stream_pin = stream['stream_pin']
+
+    # otherwise, allocate a free port pair for RTP input and create the stream
     if not (rtp_port or stream_id or stream_name or stream_secret or stream_pin):
-        used_rtp_ports = set([o['id'] for o in streams])
-        rtp_port = None
-        for p in janus_rtp_port_range:
-            if p not in used_rtp_ports:
-                rtp_port = p
-                break
-
-        if not rtp_port:
-            raise RuntimeError("Unable to allocate RTP port")
-
+        # stream ids are their RTP ports
+        rtp_port = ports.allocate(janus_gateway_dns_name, used_ports=lambda: [o['id'] for o in streams])
         stream_id = rtp_port
         stream_name = f'rtp-h264-{stream_id}-{rand_string(size=12)}'
         stream_secret = rand_string(size=42)
         stream_pin = rand_string(size=42)
 
-        logger.info(f'allocated RTP port {rtp_port} for stream {stream_name}')
+        logger.info(f'creating stream {stream_name} on RTP port {rtp_port}')
 
         # this creates the stream via a messagee to Janus streaming plugin
-        data = janus_send_plugin_message(s, streaming_plugin_url,
-                                         {'request': 'create',
-                                          'type': 'rtp',
-                                          # 'secret': stream_secret,
-                                          # 'pin': stream_pin,
-                                          'permanent': False,
-                                          'id': stream_id,
-                                          'name': stream_name,
-                                          'is_private': False,
-                                          'video': True,
-                                          'audio': False,
-                                          'videoport': rtp_port,
-                                          'videopt': 96,
-                                          'videortpmap': 'H264/90000',
-                                          'videofmtp': 'profile-level-id=42e028;packetization-mode=1'})
+        data = janus.message({'request': 'create',
+                              'type': 'rtp',
+                              # 'secret': stream_secret,
+                              # 'pin': stream_pin,
+                              'permanent': False,
+                              'id': stream_id,
+                              'name': stream_name,
+                              'is_private': False,
+                              'video': True,
+                              'audio': False,
+                              'videoport': rtp_port,
+                              'videopt': 96,
+                              'videortpmap': 'H264/90000',
+                              'videofmtp': 'profile-level-id=42e028;packetization-mode=1'},
+                             deadline)
         logger.info(data)
 
+        # the port stays allocated on failure (it may be taken by a stream we don't know about), reconciliation
+        # frees it if it isn't
         if data.get('error') or data.get('error_code'):
             raise RuntimeError(f'Janus error {data.get("error_code")}: {data.get("error")}')
 
-        streams = janus_send_plugin_message(s, streaming_plugin_url, {'request': 'list'})['list']
-        logger.info(streams)
-
     return {'gateway_instance': janus_gateway_dns_name,
-            'gateway_url': janus_rest_url,
-            'session_url': session_url,
-            'streaming_plugin_url': streaming_plugin_url,
+            'gateway_url': janus.gateway_url,
+            'session_url': janus.session_url,
+            'streaming_plugin_url': janus.plugin_url,
             'stream_id': stream_id,
             'stream_name': stream_name,
             'stream_secret': stream_secret,
             'stream_pin': stream_pin,
             'stream_rtp_port': rtp_port,
-            'stream_h264_bitrate': 256,  # todo: make bitrate adjustable
+            'stream_h264_bitrate': janus_placement.stream_bitrate_kbps,  # todo: make bitrate adjustable
             'stream_enable': True,
             'timestamp': int(time())}
 
 
+def janus_destroy_stream(janus_gateway_dns_name, stream_id):
+    """Destroys a stream on a Janus instance, its RTP port is freed by the next reconciliation"""
+    data = janus_api.pool.session(janus_gateway_dns_name).message({'request': 'destroy', 'id': stream_id})
+    if data.get('error') or data.get('error_code'):
+        raise RuntimeError(f'Janus error {data.get("error_code")}: {data.get("error")}')
+
+
+def release_streams(streams):
+    """Destroys streams which were allocated but not recorded in the shadow, best effort"""
+    for stream in streams:
+        logger.info(f'destroying unused stream {stream["stream_name"]} on {stream["gateway_instance"]}')
+        try:
+            janus_destroy_stream(stream['gateway_instance'], stream['stream_id'])
+        except Exception as e:
+            logger.warning(f'failed to destroy stream {stream["stream_name"]} on {stream["gateway_instance"]}: {e!r}')
+
+
+def stream_ref(stream):
+    return stream and (stream['gateway_instance'], stream['stream_id'])
+
+
+def unrecorded_streams(allocations, recorded):
+    """Returns the streams created by allocations (see handler) which are neither in recorded nor were already in
+    the shadow they were allocated from"""
+    kept = {stream_ref(stream) for stream in recorded}
+    unrecorded = []
+    for base, *allocated in allocations:
+        previous = {stream_ref(base.get('primary')), stream_ref(base.get('standby'))}
+        unrecorded.extend(stream for stream in allocated if stream and stream_ref(stream) not in kept | previous)
+    return unrecorded
+
+
+def release_late_stream(stream, future):
+    """Destroys the stream created by an allocation attempt which finished after it timed out
+
+    stream is the one the attempt was reallocating, it's left alone if the attempt found it still up."""
+    if future.cancelled() or future.exception():
+        return
+    if stream_ref(future.result()) != stream_ref(stream):
+        release_streams([future.result()])
+
+
+def gateway_candidates(janus_instances, ranked, stream):
+    """Returns the gateways to try for a stream in order: the one it's already allocated on (even if it has no
+    headroom for new streams), then the ranked ones"""
+    current = [gateway for gateway in janus_instances
+               if stream and gateway['public_dns_name'] == stream.get('gateway_instance')]
+    return current + [gateway for gateway in ranked if gateway not in current]
+
+
+def allocate_streams(janus_instances, primary, standby):
+    """Allocates (reallocates if they are gone) the primary and standby streams at the same time
+
+    Each stream goes to the best gateway not taken by the other one, and fails over to the next best gateway when
+    allocation on a gateway fails or takes longer than janus_allocate_timeout. Returns (primary, standby), standby
+    is None if there's no gateway left for it."""
+    ranked = placement.rank(janus_instances)
+
+    # gateways taken by either of the streams, or failed
+    claimed = set()
+    lock = threading.Lock()
+
+    def claim(candidates):
+        with lock:
+            for gateway in candidates:
+                if gateway['public_dns_name'] not in claimed:
+                    claimed.add(gateway['public_dns_name'])
+                    return gateway
+        return None
+
+    def allocate(gateway, candidates, stream):
+        while gateway:
+            dns_name = gateway['public_dns_name']
+            future = allocation_executor.submit(janus_allocate_stream, dns_name, stream,
+                                                time() + janus_allocate_timeout)
+            try:
+                allocated = future.result(timeout=janus_allocate_timeout)
+                if not stream or stream.get('gateway_instance') != dns_name:
+                    placement.load_cache.add_stream(dns_name)
+                return allocated
+            except Exception as e:
+                if isinstance(e, futures.TimeoutError):
+                    # the attempt stops at the deadline, but a stream it creates until then is recorded nowhere
+                    future.add_done_callback(partial(release_late_stream, stream))
+                logger.warning(f'failed to allocate stream on {dns_name}: {e!r}')
+                placement.load_cache.invalidate(dns_name)
+            gateway = claim(candidates)
+        return None
+
+    # the first choices are claimed up front so the primary gets the best gateway
+    primary_candidates = gateway_candidates(janus_instances, ranked, primary)
+    standby_candidates = gateway_candidates(janus_instances, ranked, standby)
+    primary_gateway = claim(primary_candidates)
+    if not primary_gateway:
+        raise janus_placement.NoGatewayCapacity("No Janus gateway has capacity for another stream")
+    standby_gateway = claim(standby_candidates)
+    allocations = {'primary': (primary_gateway, primary_candidates, primary),
+                   'standby': (standby_gateway, standby_candidates, standby)}
+    results, _ = tools.fan_out(lambda role: allocate(*allocations[role]), allocations)
+    primary_stream = results.get('primary')
+    standby_stream = results.get('standby')
+    if not primary_stream:
+        if not standby_stream:
+            raise RuntimeError("Unable to allocate a stream on any Janus gateway")
+        # the standby becomes the primary
+        primary_stream, standby_stream = standby_stream, None
+    return primary_stream, standby_stream
+
+
 def handler(event, context):
     """Creates/starts a RTP stream from the thing"""
     logger.info(json.dumps(event, sort_keys=True, indent=4))
@@ -171,13 +248,6 @@ def handler(event, context):
     thing_name = event['thingName']
     logger.info(thing_name)
 
-    # retrieve iot thing shadow document
-    thing_shadow = json.loads(iot_data.get_thing_shadow(thingName=thing_name)['payload'].read().decode('utf-8'))
-    logger.info(json.dumps(thing_shadow, indent=2))
-
-    # retrieve currently allocated stream info
-    streams = thing_shadow['state'].get('desired', {}).get('streams') or {}
-
     # get a list of available Janus instances
     janus_instances = get_janus_instances()
     for instance in janus_instances:
@@ -185,36 +255,36 @@ def handler(event, context):
         public_dns_name = instance['public_dns_name']
         logger.info(f'janus container instance {instance_id} {public_dns_name}')
 
-    # allocate primary/standby Janus instances
-    primary_gateway = random.choice(janus_instances)
-    primary_gateway_dns_name = primary_gateway["public_dns_name"]
-
-    standby_janus_instances = janus_instances[:].remove(primary_gateway)
-    standby_gateway_dns_name = standby_janus_instances and random.choice(standby_janus_instances)['public_dns_name']
-
-    logger.info(f'gateway: {primary_gateway_dns_name}, standby gateway: {standby_gateway_dns_name}')
-
-    # todo: retry with another gateway on failure
-    primary_stream = janus_allocate_stream(primary_gateway_dns_name, streams.get('primary'))
-    standby_stream = standby_gateway_dns_name and janus_allocate_stream(standby_gateway_dns_name,
-                                                                        streams.get('standby'))
-    current_stream = streams.get('current', 'primary')
-
-    # update iot thing shadow with new stream data
-    iot_data.update_thing_shadow(
-        thingName=thing_name,
-        payload=json.dumps({'state': {
-            'desired': {
-                'streams': {
-                    'primary': primary_stream,
-                    'standby': standby_stream,
-                    'current': current_stream
-                }
-            }
-        }}).encode('utf-8'))
-
-    return {
-        'primary': primary_stream,
-        'standby': standby_stream,
-        'current': current_stream
-    }
+    # (desired streams allocated from, primary, standby) of each allocation
+    allocations = []
+
+    def update_streams(desired):
+        streams = desired.get('streams') or {}
+        if not allocations or allocations[-1][0] != streams:
+            # allocate primary/standby streams concurrently, on different gateways. When a concurrent start changed
+            # the streams since the last attempt this runs again from its streams, reusing them if they are up
+            primary_stream, standby_stream = allocate_streams(janus_instances, streams.get('primary'),
+                                                              streams.get('standby'))
+            allocations.append((streams, primary_stream, standby_stream))
+        _, primary_stream, standby_stream = allocations[-1]
+        return dict(desired, streams={
+            'primary': primary_stream,
+            'standby': standby_stream,
+            'current': streams.get('current', 'primary')
+        })
+
+    # the allocation is based on the current shadow and recorded conditional on its version. Conflicts are frequent
+    # as every report of the thing bumps the version too, the desired streams are unchanged then and sent again
+    try:
+        streams = shadows.update(thing_name, update_streams, retries=10, refresh=True)['streams']
+    except Exception:
+        # none of the streams created by this invocation got recorded
+        release_streams(unrecorded_streams(allocations, ()))
+        raise
+    logger.info(f'gateway: {streams["primary"]["gateway_instance"]}, '
+                f'standby gateway: {streams["standby"] and streams["standby"]["gateway_instance"]}')
+
+    # streams created by attempts which lost to a concurrent start
+    release_streams(unrecorded_streams(allocations[:-1], (streams['primary'], streams['standby'])))
+
+    return streams
@@ -1,13 +1,15 @@
 import json
 import logging
 
-import boto3
+from cloudcam import tools
+from cloudcam.iot_shadow import ShadowCache
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-iot = boto3.client('iot')
-iot_data = boto3.client('iot-data')
+iot = tools.LazyClient('iot')
+iot_data = tools.LazyClient('iot-data')
+shadows = ShadowCache(iot_data)
 
 
 def handler(event, context):
@@ -18,12 +20,9 @@ def handler(event, context):
     thing_name = event['thingName']
     logger.info(thing_name)
 
-    # retrieve iot thing shadow document
-    thing_shadow = json.loads(iot_data.get_thing_shadow(thingName=thing_name)['payload'].read().decode('utf-8'))
-    logger.info(json.dumps(thing_shadow, indent=2))
-
-    # retrieve currently allocated stream info
-    streams = thing_shadow['state']['desired'].get('streams')
+    # retrieve currently allocated stream info (from the cached iot thing shadow)
+    thing_shadow, _ = shadows.get(thing_name)
+    streams = thing_shadow.get('desired', {}).get('streams')
     logger.info(f'Currently allocated streams: {streams}')
 
     # todo: client refcounting so camera could stop streaming if there are no clients
@@ -33,11 +32,5 @@ def handler(event, context):
     # start/stop streaming depending on the list size
     # streams['current'] = None
 
-    # update iot thing shadow with new stream data
-    iot_data.update_thing_shadow(
-        thingName=thing_name,
-        payload=json.dumps({'state': {
-            'desired': {
-                'streams': streams
-            }
-        }}).encode('utf-8'))
+    # update iot thing shadow with new stream data (a no-op unless the streams changed)
+    shadows.update(thing_name, lambda desired: dict(desired, streams=streams))
@@ -0,0 +1,82 @@
+"""Materialized owner -> things index
+
+Keeps the names of the things of each Cognito identity in the state store (see store.py) under owner/{identity id},
+so listing the things of an identity is a single read instead of list_principal_things calls against the IoT
+registry. Updated when things are provisioned, attached to an identity or deprovisioned.
+
+Each thing is stored with the time it was added. The index of an identity is only used once it was synced with the
+IoT registry (backfill_owner_things), and is resynced every OWNER_INDEX_MAX_AGE seconds, so things attached or
+removed without going through the index (e.g. provisioned by the CLI without STATE_STORE) show up eventually.
+A sync keeps things added to the index while the registry was being listed, so it can't drop concurrent additions.
+
+All functions are no-ops (and owner_things returns None) when no STATE_STORE is configured."""
+
+import os
+from time import time
+from typing import Iterable, List, Optional
+
+from cloudcam import store
+
+owner_index_max_age = int(os.getenv('OWNER_INDEX_MAX_AGE', 3600))
+
+
+def owner_key(identity_id: str) -> str:
+    return f'owner/{identity_id}'
+
+
+def enabled() -> bool:
+    return store.default_store() is not None
+
+
+def owner_things(identity_id: str) -> Optional[List[str]]:
+    """Returns sorted names of the things of an identity, None if the identity isn't synced (recently enough)"""
+    if not enabled():
+        return None
+    value, _ = store.default_store().get(owner_key(identity_id))
+    if value is None or time() - value.get('synced', 0) > owner_index_max_age:
+        return None
+    return sorted(value['things'])
+
+
+def backfill_owner_things(identity_id: str, thing_names: Iterable[str], listed_at: Optional[float] = None):
+    """Syncs the index of an identity with its things listed from the IoT registry
+
+    listed_at is when listing started; things added to the index since then are kept even if the listing missed
+    them."""
+    if not enabled():
+        return
+    listed_at = listed_at or time()
+    thing_names = set(thing_names)
+
+    def sync(value):
+        things = (value or {}).get('things', {})
+        synced = {name: things.get(name, listed_at) for name in thing_names}
+        synced.update((name, added) for name, added in things.items() if added >= listed_at)
+        return {'things': synced, 'synced': listed_at}
+
+    store.default_store().update(owner_key(identity_id), sync)
+
+
+def add_thing(identity_id: str, thing_name: str):
+    if not enabled():
+        return
+
+    def add(value):
+        value = value or {'things': {}}
+        value['things'][thing_name] = time()
+        return value
+
+    store.default_store().update(owner_key(identity_id), add)
+
+
+def remove_thing(identity_id: str, thing_name: str):
+    if not enabled():
+        return
+
+    def remove(value):
+        if not value:
+            return None
+        value['things'].pop(thing_name, None)
+        return value
+
+    store.default_store().update(owner_key(identity_id), remove)
@@ -0,0 +1,140 @@
+"""Presigned S3 URL generation with a process-level cache
+
+Signing URLs through botocore is comparatively slow (request serialization, endpoint resolution, event hooks)
+and the thumbnail keys never change, so URLs are cached per warm container and reused while they still have
+`min_validity` seconds of validity left. Cache misses can be signed in a batch with a local SigV4 query string
+signer which derives the signing key once instead of once per URL."""
+
+import hashlib
+import hmac
+import threading
+from datetime import datetime, timezone
+from time import time
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote
+
+UrlKey = Tuple[str, str, str]  # (bucket, key, http method)
+
+
+class PresignedUrlCache:
+    """Caches presigned URLs keyed by (bucket, key, method) until they are about to expire"""
+
+    def __init__(self, min_validity: int = 900):
+        # URLs with less than min_validity seconds left are considered expired
+        self.min_validity = min_validity
+        self._urls: Dict[UrlKey, Tuple[str, float]] = {}
+        self._access_key: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def get(self, url_key: UrlKey, now: float = None) -> Optional[str]:
+        now = now or time()
+        with self._lock:
+            entry = self._urls.get(url_key)
+            if not entry:
+                return None
+            url, expires_at = entry
+            if expires_at - now < self.min_validity:
+                del self._urls[url_key]
+                return None
+            return url
+
+    def put(self, url_key: UrlKey, url: str, expires_at: float):
+        with self._lock:
+            self._urls[url_key] = (url, expires_at)
+
+    def evict_expired(self, now: float = None):
+        now = now or time()
+        with self._lock:
+            for url_key in [k for k, (_, expires_at) in self._urls.items() if expires_at - now < self.min_validity]:
+                del self._urls[url_key]
+
+    def check_credentials(self, access_key: str):
+        """Drops all cached URLs if the credentials they were signed with have been rotated"""
+        with self._lock:
+            if self._access_key != access_key:
+                self._urls.clear()
+                self._access_key = access_key
+
+
+def _hmac(key: bytes, msg: str) -> bytes:
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+class S3UrlSigner:
+    """Generates SigV4 query string authenticated (presigned) S3 URLs without going through botocore
+
+    The signing key only depends on the secret key, date, region and service, so it's derived once per signer."""
+
+    def __init__(self, access_key: str, secret_key: str, token: Optional[str], region: str, now: datetime = None):
+        self.access_key = access_key
+        self.token = token
+        self.region = region
+        self.now = now or datetime.now(timezone.utc)
+        self.amz_date = self.now.strftime('%Y%m%dT%H%M%SZ')
+        self.date_stamp = self.now.strftime('%Y%m%d')
+        self.scope = f'{self.date_stamp}/{region}/s3/aws4_request'
+        k_date = _hmac(('AWS4' + secret_key).encode('utf-8'), self.date_stamp)
+        self.signing_key = _hmac(_hmac(_hmac(k_date, region), 's3'), 'aws4_request')
+
+    @classmethod
+    def from_session(cls, session, region: str, now: datetime = None) -> 'S3UrlSigner':
+        """Creates a signer using the current credentials of a boto3 session"""
+        credentials = session.get_credentials().get_frozen_credentials()
+        return cls(credentials.access_key, credentials.secret_key, credentials.token, region, now=now)
+
+    def host(self, bucket: str) -> str:
+        return f'{bucket}.s3.{self.region}.amazonaws.com'
+
+    def sign(self, bucket: str, key: str, method: str = 'GET', expires_in: int = 3600) -> str:
+        host = self.host(bucket)
+        path = '/' + quote(key, safe='/~')
+        params = {
+            'X-Amz-Algorithm': 'AWS4-HMAC-SHA256',
+            'X-Amz-Credential': f'{self.access_key}/{self.scope}',
+            'X-Amz-Date': self.amz_date,
+            'X-Amz-Expires': str(expires_in),
+            'X-Amz-SignedHeaders': 'host',
+        }
+        if self.token:
+            params['X-Amz-Security-Token'] = self.token
+        query = '&'.join(f'{quote(k, safe="-_.~")}={quote(v, safe="-_.~")}' for k, v in sorted(params.items()))
+        canonical_request = f'{method}\n{path}\n{query}\nhost:{host}\n\nhost\nUNSIGNED-PAYLOAD'
+        string_to_sign = (f'AWS4-HMAC-SHA256\n{self.amz_date}\n{self.scope}\n'
+                          f'{hashlib.sha256(canonical_request.encode("utf-8")).hexdigest()}')
+        signature = hmac.new(self.signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        return f'https://{host}{path}?{query}&X-Amz-Signature={signature}'
+
+
+_client_methods = {'GET': 'get_object', 'PUT': 'put_object'}
+
+
+def presigned_url(s3, cache: PresignedUrlCache, bucket: str, key: str, method: str = 'GET',
+                  expires_in: int = 3600) -> str:
+    """Returns a presigned URL for a single object, signing it via botocore on a cache miss"""
+    url_key = (bucket, key, method)
+    url = cache.get(url_key)
+    if not url:
+        expires_at = time() + expires_in
+        url = s3.generate_presigned_url(_client_methods[method], Params={'Bucket': bucket, 'Key': key},
+                                        ExpiresIn=expires_in, HttpMethod=method)
+        cache.put(url_key, url, expires_at)
+    return url
+
+
+def presigned_urls(session, region: str, cache: PresignedUrlCache, url_keys: Iterable[UrlKey],
+                   expires_in: int = 3600) -> List[str]:
+    """Returns presigned URLs for a batch of (bucket, key, method), signing all cache misses with one signing key"""
+    url_keys = list(url_keys)
+    signer = S3UrlSigner.from_session(session, region)
+    cache.check_credentials(signer.access_key)
+    cache.evict_expired()
+    expires_at = signer.now.timestamp() + expires_in
+    urls = []
+    for url_key in url_keys:
+        url = cache.get(url_key)
+        if not url:
+            bucket, key, method = url_key
+            url = signer.sign(bucket, key, method, expires_in)
+            cache.put(url_key, url, expires_at)
+        urls.append(url)
+    return urls
@@ -0,0 +1,152 @@
+"""Processes thumbnails uploaded by things
+
+Triggered by S3 uploads to upload/{thing}.jpg. Static scenes produce identical or nearly identical frames on
+every refresh, so each upload is fingerprinted with a SHA-256 content hash and a 64 bit difference hash (dHash)
+which are stored as metadata of thumb/{thing}.jpg. Uploads matching the current thumbnail are dropped, which
+keeps the thumbnail (and its ETag) stable for conditional GETs. The time of every upload is recorded for
+thumb_freshness, duplicate or not. Things report a download URL of their upload/ key (see iot_request_thumb), so
+the UI never waits for the promotion below or misses a dropped frame.
+
+Accepted frames are copied to thumb/{thing}.jpg along with downscaled variants and appended to the thumbnail
+history of the thing (see thumb_history). The JPEG is decoded once in draft mode, which lets libjpeg scale the
+image down by 1/2, 1/4 or 1/8 while decoding so the full frame is never decompressed, and the hash and all
+variants are derived from that single decoded image."""
+
+import hashlib
+import logging
+import os
+from io import BytesIO
+from urllib.parse import unquote_plus
+
+import numpy as np
+from botocore.exceptions import ClientError
+from PIL import Image
+
+from cloudcam import thumb_freshness, thumb_history, tools
+from cloudcam.thumbs import thumb_formats, thumb_key, thumb_sizes, thing_name_from_upload_key
+
+log = logging.getLogger("cloudcam")
+log.setLevel(logging.DEBUG)
+
+thumb_bucket_name = os.getenv("S3_THUMB_BUCKET_NAME")
+
+# frames whose dHash differs from the current thumbnail in at most this many bits are considered unchanged
+thumb_dhash_threshold = int(os.getenv("THUMB_DHASH_THRESHOLD", 2))
+
+# number of past frames kept per thing (0 disables the history)
+thumb_history_size = int(os.getenv("THUMB_HISTORY_SIZE", 10000))
+
+jpeg_quality = 80
+webp_quality = 75
+
+s3 = tools.LazyClient('s3')
+
+
+def handler(event, context):
+    """Promotes changed uploads to the thing thumbnail and creates small/medium JPEG and WebP variants of it"""
+    for record in event.get('Records', []):
+        bucket = record['s3']['bucket']['name']
+        key = unquote_plus(record['s3']['object']['key'])
+        thing_name = thing_name_from_upload_key(key)
+        if not thing_name:
+            log.info(f'ignoring {key}, not a thumbnail upload')
+            continue
+        upload = s3.get_object(Bucket=bucket, Key=key)
+        thumb_freshness.record_upload(thing_name, upload['LastModified'].timestamp())
+        process_upload(bucket, thing_name, upload['Body'].read(),
+                       uploaded_ms=int(upload['LastModified'].timestamp() * 1000))
+    return {}
+
+
+def process_upload(bucket, thing_name, data, uploaded_ms):
+    """Stores an uploaded frame as the thing thumbnail unless it matches the current one
+
+    Returns True if the frame was stored."""
+    content_hash = hashlib.sha256(data).hexdigest()
+    current = current_fingerprint(bucket, thing_name)
+    if current and current['content-sha256'] == content_hash:
+        log.info(f'dropping thumbnail upload of {thing_name}, identical to the current one')
+        return False
+
+    image = decode(data)
+    image_dhash = dhash(image)
+    if current and hamming_distance(current['dhash'], image_dhash) <= thumb_dhash_threshold:
+        log.info(f'dropping thumbnail upload of {thing_name}, nearly identical to the current one')
+        return False
+
+    s3.put_object(Bucket=bucket, Key=thumb_key(thing_name), Body=data, ContentType='image/jpeg',
+                  CacheControl='no-cache', Metadata={'content-sha256': content_hash, 'dhash': image_dhash})
+    store_derivatives(bucket, thing_name, make_derivatives(image))
+    if thumb_history_size:
+        thumb_history.append_frame(s3, bucket, thing_name, uploaded_ms, data, capacity=thumb_history_size)
+    return True
+
+
+def current_fingerprint(bucket, thing_name):
+    """Returns the content hash and dHash metadata of the current thumbnail of a thing (None if there isn't one)"""
+    try:
+        metadata = s3.head_object(Bucket=bucket, Key=thumb_key(thing_name))['Metadata']
+    except ClientError as e:
+        # the role has s3:ListBucket, so a 403 is a real permission error rather than a missing key
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey", "NotFound"):
+            return None
+        raise
+    if 'content-sha256' not in metadata or 'dhash' not in metadata:
+        return None
+    return metadata
+
+
+def decode(data):
+    image = Image.open(BytesIO(data))
+    # let the decoder downscale to the smallest power of two reduction still larger than the largest variant
+    image.draft('RGB', max(thumb_sizes.values()))
+    return image.convert('RGB')
+
+
+def dhash(image, hash_size=8):
+    """Returns the difference hash of an image as a hex string
+
+    The image is reduced to (hash_size + 1) x hash_size grayscale pixels and each bit records whether a pixel is
+    brighter than its right neighbour."""
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.int16)
+    bits = np.packbits((pixels[:, 1:] > pixels[:, :-1]).ravel())
+    return bits.tobytes().hex()
+
+
+def hamming_distance(a, b):
+    return bin(int(a, 16) ^ int(b, 16)).count('1')
+
+
+def store_derivatives(bucket, thing_name, derivatives):
+    _, errors = tools.fan_out(
+        lambda size_fmt: s3.put_object(Bucket=bucket,
+                                       Key=thumb_key(thing_name, *size_fmt),
+                                       Body=derivatives[size_fmt],
+                                       ContentType=thumb_formats[size_fmt[1]]),
+        derivatives.keys(), max_workers=len(derivatives))
+    for (size, fmt), e in errors.items():
+        log.error(f'failed to store {size} {fmt} thumbnail of {thing_name}: {e}')
+    if errors:
+        raise next(iter(errors.values()))
+    log.info(f'stored {len(derivatives)} thumbnail variants of {thing_name}')
+
+
+def make_derivatives(image):
+    """Returns {(size, fmt): encoded image} for all thumbnail sizes and formats of a decoded image"""
+    derivatives = {}
+    # derive each size from the previous (larger) one, which is cheaper than resampling the decoded frame again
+    for size, bounds in sorted(thumb_sizes.items(), key=lambda item: item[1], reverse=True):
+        image = image.copy()
+        image.thumbnail(bounds, Image.LANCZOS)
+        for fmt in thumb_formats:
+            derivatives[(size, fmt)] = encode(image, fmt)
+    return derivatives
+
+
+def encode(image, fmt):
+    out = BytesIO()
+    if fmt == 'webp':
+        image.save(out, 'WEBP', quality=webp_quality, method=4)
+    else:
+        image.save(out, 'JPEG', quality=jpeg_quality, optimize=True, progressive=True)
+    return out.getvalue()
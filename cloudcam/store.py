@@ -0,0 +1,197 @@
+"""Small key-value store for state shared between lambda invocations
+
+Values are JSON documents stored under string keys, each with a version number which is incremented on every
+write. Writes can be made conditional on the version read before (optimistic locking), so concurrent
+read-modify-write cycles don't overwrite each other; see Store.update.
+
+The store is selected with the STATE_STORE environment variable:
+  dynamodb:TABLE  - DynamoDB table with a "key" string hash key (see cloudformation/dynamodb.yml)
+  sqlite:PATH     - SQLite database file, for local use and tests
+  memory:         - in-process dict, for tests"""
+
+import abc
+import json
+import os
+import sqlite3
+import threading
+from typing import Any, Callable, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+from cloudcam import tools
+
+
+class VersionConflict(Exception):
+    """Raised when a conditional write finds a different version than expected"""
+
+
+class Store(abc.ABC):
+    @abc.abstractmethod
+    def get(self, key: str) -> Tuple[Optional[Any], int]:
+        """Returns (value, version) of a key, (None, 0) if it doesn't exist"""
+
+    @abc.abstractmethod
+    def put(self, key: str, value: Any, expected_version: Optional[int] = None) -> int:
+        """Stores a value, returns its new version
+
+        If expected_version is given the write only succeeds if the current version matches it (0 meaning the
+        key must not exist), otherwise VersionConflict is raised."""
+
+    @abc.abstractmethod
+    def delete(self, key: str, expected_version: Optional[int] = None):
+        """Deletes a key, optionally only if its current version matches expected_version"""
+
+    def update(self, key: str, fn: Callable[[Optional[Any]], Any], retries: int = 10) -> Any:
+        """Replaces the value of a key with fn(value), retrying on concurrent modification
+
+        fn may return None to delete the key. Returns the new value."""
+        for attempt in range(retries + 1):
+            value, version = self.get(key)
+            new_value = fn(value)
+            try:
+                if new_value is None:
+                    if version:
+                        self.delete(key, expected_version=version)
+                else:
+                    self.put(key, new_value, expected_version=version)
+                return new_value
+            except VersionConflict:
+                if attempt == retries:
+                    raise
+
+
+class MemoryStore(Store):
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, version = self._items.get(key, (None, 0))
+        return (json.loads(value) if value is not None else None), version
+
+    def put(self, key, value, expected_version=None):
+        with self._lock:
+            _, version = self._items.get(key, (None, 0))
+            if expected_version is not None and version != expected_version:
+                raise VersionConflict(key)
+            self._items[key] = (json.dumps(value), version + 1)
+            return version + 1
+
+    def delete(self, key, expected_version=None):
+        with self._lock:
+            _, version = self._items.get(key, (None, 0))
+            if expected_version is not None and version != expected_version:
+                raise VersionConflict(key)
+            self._items.pop(key, None)
+
+
+class SQLiteStore(Store):
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value TEXT, version INTEGER)')
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT value, version FROM store WHERE key = ?', (key,)).fetchone()
+        return (json.loads(row[0]), row[1]) if row else (None, 0)
+
+    def put(self, key, value, expected_version=None):
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._db.execute('SELECT version FROM store WHERE key = ?', (key,)).fetchone()
+                version = row[0] if row else 0
+                if expected_version is not None and version != expected_version:
+                    raise VersionConflict(key)
+                self._db.execute('INSERT OR REPLACE INTO store (key, value, version) VALUES (?, ?, ?)',
+                                 (key, json.dumps(value), version + 1))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return version + 1
+
+    def delete(self, key, expected_version=None):
+        with self._lock:
+            if expected_version is None:
+                self._db.execute('DELETE FROM store WHERE key = ?', (key,))
+            elif not self._db.execute('DELETE FROM store WHERE key = ? AND version = ?',
+                                      (key, expected_version)).rowcount:
+                raise VersionConflict(key)
+
+
+class DynamoDBStore(Store):
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        self.dynamodb = tools.LazyClient('dynamodb')
+
+    def get(self, key):
+        item = self.dynamodb.get_item(TableName=self.table_name, Key={'key': {'S': key}},
+                                      ConsistentRead=True).get('Item')
+        if not item:
+            return None, 0
+        return json.loads(item['value']['S']), int(item['version']['N'])
+
+    def put(self, key, value, expected_version=None):
+        kwargs = {}
+        if expected_version == 0:
+            kwargs['ConditionExpression'] = 'attribute_not_exists(#k)'
+            kwargs['ExpressionAttributeNames'] = {'#k': 'key'}
+        elif expected_version is not None:
+            kwargs['ConditionExpression'] = 'version = :version'
+            kwargs['ExpressionAttributeValues'] = {':version': {'N': str(expected_version)}}
+        if expected_version is not None:
+            version = expected_version + 1
+        else:
+            # unconditional writes still need to know the version to increment it
+            version = self.get(key)[1] + 1
+        try:
+            self.dynamodb.put_item(TableName=self.table_name,
+                                   Item={'key': {'S': key}, 'value': {'S': json.dumps(value)},
+                                         'version': {'N': str(version)}},
+                                   **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                raise VersionConflict(key)
+            raise
+        return version
+
+    def delete(self, key, expected_version=None):
+        kwargs = {}
+        if expected_version is not None:
+            kwargs['ConditionExpression'] = 'version = :version'
+            kwargs['ExpressionAttributeValues'] = {':version': {'N': str(expected_version)}}
+        try:
+            self.dynamodb.delete_item(TableName=self.table_name, Key={'key': {'S': key}}, **kwargs)
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                raise VersionConflict(key)
+            raise
+
+
+def open_store(spec: str) -> Store:
+    """Returns a store from a STATE_STORE style spec, e.g. dynamodb:cloudcam-state"""
+    kind, _, arg = spec.partition(':')
+    if kind == 'dynamodb':
+        return DynamoDBStore(arg)
+    if kind == 'sqlite':
+        return SQLiteStore(arg)
+    if kind == 'memory':
+        return MemoryStore()
+    raise Exception(f"Unknown store {spec}")
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def default_store() -> Optional[Store]:
+    """Returns the store configured with STATE_STORE, None if there isn't one"""
+    global _default_store
+    if _default_store is None and os.getenv('STATE_STORE'):
+        with _default_store_lock:
+            if _default_store is None:
+                _default_store = open_store(os.getenv('STATE_STORE'))
+    return _default_store
@@ -0,0 +1,82 @@
+"""Tracks how recently each thing uploaded a thumbnail so redundant refresh requests can be skipped
+
+Upload times are recorded in the state store (see store.py) under thumb-upload/{thing} by s3_thumb_derivatives as
+the upload events come in, so checking freshness never touches S3. Upload times known to be recent enough are
+remembered per warm container, and thumbnail requests sent from this container are remembered as well so that
+repeated requests are coalesced while the thing is still busy uploading.
+
+Without a STATE_STORE only the requests sent from this container are taken into account."""
+
+import threading
+from time import time
+from typing import Dict, Optional
+
+from cloudcam import store
+
+
+def freshness_key(thing_name: str) -> str:
+    return f'thumb-upload/{thing_name}'
+
+
+def record_upload(thing_name: str, uploaded: float, state_store: Optional[store.Store] = None):
+    """Records the time of a thumbnail upload of a thing (called for upload events)"""
+    state_store = state_store or store.default_store()
+    if not state_store:
+        return
+
+    def newest(value):
+        if value and value['uploadedAt'] >= uploaded:
+            return value
+        return {'uploadedAt': uploaded}
+
+    state_store.update(freshness_key(thing_name), newest)
+
+
+class FreshnessIndex:
+    def __init__(self, state_store: Optional[store.Store] = None):
+        self._store = state_store
+        self._uploaded: Dict[str, float] = {}
+        self._requested: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def store(self) -> Optional[store.Store]:
+        return self._store or store.default_store()
+
+    def last_upload(self, thing_name: str, min_interval: float = 0, now: float = None) -> Optional[float]:
+        """Returns the time of the last thumbnail upload of the thing (None if none was recorded)
+
+        Upload times younger than min_interval are answered from memory, older ones are re-read from the store."""
+        now = now or time()
+        with self._lock:
+            uploaded = self._uploaded.get(thing_name)
+        if uploaded and now - uploaded < min_interval:
+            return uploaded
+        if not self.store:
+            return uploaded
+        value, _ = self.store.get(freshness_key(thing_name))
+        if value is None:
+            return None
+        self.record_upload(thing_name, value['uploadedAt'])
+        return value['uploadedAt']
+
+    def record_upload(self, thing_name: str, uploaded: float):
+        with self._lock:
+            if uploaded > self._uploaded.get(thing_name, 0):
+                self._uploaded[thing_name] = uploaded
+
+    def record_request(self, thing_name: str, requested: float = None):
+        with self._lock:
+            self._requested[thing_name] = requested or time()
+
+    def is_fresh(self, thing_name: str, min_interval: float, now: float = None) -> bool:
+        """Returns True if the thing uploaded a thumbnail or was asked for one less than min_interval seconds ago"""
+        if min_interval <= 0:
+            return False
+        now = now or time()
+        with self._lock:
+            requested = self._requested.get(thing_name)
+        if requested and now - requested < min_interval:
+            return True
+        uploaded = self.last_upload(thing_name, min_interval=min_interval, now=now)
+        return bool(uploaded and now - uploaded < min_interval)
@@ -0,0 +1,129 @@
+"""Bounded per-thing thumbnail history
+
+Every accepted thumbnail frame is stored under a time-partitioned key (see thumbs.history_key) and its frame id is
+appended to a per-thing index, a flat little-endian array of uint64 frame ids in ascending order. A frame id is
+the millisecond timestamp of the frame times seq_limit plus a sequence number telling apart frames of the same
+millisecond. Frame keys are derived from the ids, so range queries are a binary search over the index instead of
+ListObjects scans. Once a thing has more than `capacity` frames the oldest ones are deleted, making the history a
+ring buffer of the latest frames.
+
+The index is kept base64 encoded in the state store (see store.py) under thumb-history/{thing} and updated with
+versioned writes, so concurrent uploads of the same thing don't lose frames. The whole index is rewritten with every
+frame and a DynamoDB item holds up to about 35000 frame ids, so capacity is capped at max_index_frames."""
+
+import base64
+import logging
+from typing import List, Optional
+
+import numpy as np
+
+from cloudcam import store
+from cloudcam.thumbs import history_key
+
+log = logging.getLogger("cloudcam")
+
+index_dtype = np.dtype('<u8')
+
+# max number of frames per millisecond
+seq_limit = 1000
+
+# max number of frames in the index of a thing, whatever the capacity asked for (8 bytes each, base64 encoded)
+max_index_frames = 30000
+
+# max number of keys per S3 DeleteObjects request
+delete_batch_size = 1000
+
+
+def index_key(thing_name: str) -> str:
+    return f'thumb-history/{thing_name}'
+
+
+def decode_index(value: Optional[str]) -> np.ndarray:
+    if not value:
+        return np.empty(0, dtype=index_dtype)
+    return np.frombuffer(base64.b64decode(value), dtype=index_dtype)
+
+
+def encode_index(index: np.ndarray) -> str:
+    return base64.b64encode(index.astype(index_dtype).tobytes()).decode()
+
+
+def frame_key(thing_name: str, frame_id: int) -> str:
+    return history_key(thing_name, *divmod(int(frame_id), seq_limit))
+
+
+def frame_timestamp_ms(frame_id: int) -> int:
+    return int(frame_id) // seq_limit
+
+
+def load_index(thing_name: str, state_store: Optional[store.Store] = None) -> np.ndarray:
+    """Returns the frame id index of a thing (empty if the thing has no history yet)"""
+    state_store = state_store or store.default_store()
+    if not state_store:
+        return decode_index(None)
+    value, _ = state_store.get(index_key(thing_name))
+    return decode_index(value)
+
+
+def append_frame(s3, bucket: str, thing_name: str, timestamp_ms: int, data: bytes, capacity: int,
+                 state_store: Optional[store.Store] = None) -> Optional[int]:
+    """Stores a frame in the history of a thing, evicting the oldest frames beyond capacity
+
+    Returns the frame id (None without a STATE_STORE, which the history needs)."""
+    state_store = state_store or store.default_store()
+    if not state_store:
+        log.warning(f'not storing history of {thing_name}, no STATE_STORE configured')
+        return None
+    if capacity > max_index_frames:
+        log.warning(f'history capacity {capacity} is over {max_index_frames} frames, capping it')
+        capacity = max_index_frames
+
+    added = {}
+
+    def insert(value):
+        index = decode_index(value)
+        # keep the index sorted even if frames arrive out of order, frames of the same millisecond go last
+        first, last = np.searchsorted(index, [timestamp_ms * seq_limit, (timestamp_ms + 1) * seq_limit])
+        seq = int(index[last - 1]) % seq_limit + 1 if last > first else 0
+        if seq >= seq_limit:
+            raise RuntimeError(f'Too many history frames of {thing_name} at {timestamp_ms}')
+        frame_id = timestamp_ms * seq_limit + seq
+        index = np.insert(index, last, frame_id)
+        added['frame_id'] = frame_id
+        added['evicted'] = index[:-capacity] if len(index) > capacity else index[:0]
+        return encode_index(index[len(added['evicted']):])
+
+    # the id is claimed in the index before the frame is stored so concurrent frames never share a key
+    state_store.update(index_key(thing_name), insert)
+    frame_id = added['frame_id']
+    try:
+        s3.put_object(Bucket=bucket, Key=frame_key(thing_name, frame_id), Body=data, ContentType='image/jpeg')
+    except Exception:
+        state_store.update(index_key(thing_name), lambda value: remove_frame(value, frame_id))
+        raise
+    delete_frames(s3, bucket, thing_name, added['evicted'])
+    return frame_id
+
+
+def remove_frame(value: Optional[str], frame_id: int) -> str:
+    index = decode_index(value)
+    return encode_index(index[index != frame_id])
+
+
+def delete_frames(s3, bucket: str, thing_name: str, frame_ids: np.ndarray):
+    for i in range(0, len(frame_ids), delete_batch_size):
+        s3.delete_objects(Bucket=bucket, Delete={
+            'Objects': [{'Key': frame_key(thing_name, frame_id)} for frame_id in frame_ids[i:i + delete_batch_size]],
+            'Quiet': True,
+        })
+
+
+def query(index: np.ndarray, start_ms: int, end_ms: int, limit: int) -> List[int]:
+    """Returns up to limit frame ids between start_ms and end_ms (inclusive)
+
+    If there are more frames in the range than limit, frames are picked evenly across the range."""
+    frames = index[np.searchsorted(index, start_ms * seq_limit, 'left'):
+                   np.searchsorted(index, (end_ms + 1) * seq_limit, 'left')]
+    if len(frames) > limit:
+        frames = frames[np.linspace(0, len(frames) - 1, limit).round().astype(int)]
+    return [int(frame_id) for frame_id in frames]
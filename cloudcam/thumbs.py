@@ -0,0 +1,51 @@
+"""S3 key layout of thing thumbnails
+
+Things upload to upload/{thing}.jpg, which is only promoted to thumb/{thing}.jpg (and its derivatives) when the
+frame differs from the current thumbnail, see s3_thumb_derivatives."""
+
+from datetime import datetime, timezone
+from typing import Optional
+
+# derivative sizes generated from uploaded thumbnails (bounding boxes, aspect ratio is preserved)
+thumb_sizes = {
+    'small': (160, 120),
+    'medium': (480, 360),
+}
+
+thumb_formats = {
+    'jpg': 'image/jpeg',
+    'webp': 'image/webp',
+}
+
+
+def thumb_key(thing_name: str, size: Optional[str] = None, fmt: str = 'jpg') -> str:
+    """Returns the S3 key of the full-size thumbnail of a thing, or of one of its derivatives"""
+    if size is None:
+        if fmt != 'jpg':
+            raise ValueError(f'Full size thumbnails are only available as jpg, not {fmt}')
+        return f'thumb/{thing_name}.jpg'
+    if size not in thumb_sizes:
+        raise ValueError(f'Unknown thumbnail size {size}')
+    if fmt not in thumb_formats:
+        raise ValueError(f'Unknown thumbnail format {fmt}')
+    return f'thumb-{size}/{thing_name}.{fmt}'
+
+
+def upload_key(thing_name: str) -> str:
+    """Returns the S3 key things upload new thumbnails to"""
+    return f'upload/{thing_name}.jpg'
+
+
+def thing_name_from_upload_key(key: str) -> Optional[str]:
+    """Returns the thing name of an upload key (None for any other key)"""
+    if key.startswith('upload/') and key.endswith('.jpg'):
+        return key[len('upload/'):-len('.jpg')]
+    return None
+
+
+def history_key(thing_name: str, timestamp_ms: int, seq: int = 0) -> str:
+    """Returns the S3 key of a thumbnail history frame, partitioned by UTC day
+
+    seq tells apart frames sharing the same millisecond timestamp."""
+    day = datetime.fromtimestamp(timestamp_ms / 1000, timezone.utc).strftime('%Y/%m/%d')
+    return f'history/{thing_name}/{day}/{timestamp_ms}-{seq}.jpg'
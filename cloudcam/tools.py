@@ -1,12 +1,230 @@
 import logging
+import os
 import string
 import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import lru_cache, partial
 
 from botocore.exceptions import ClientError
 
 # log = logging.getLogger("cloudcam")
 # log.setLevel(logging.DEBUG)
 
+_session = None
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def session():
+    """Returns the boto3 session shared by all handlers in this container, creating it on first use"""
+    global _session
+    if _session is None:
+        with _clients_lock:
+            if _session is None:
+                import boto3  # importing boto3 is a noticeable part of cold start time, so defer it
+                _session = boto3.session.Session()
+    return _session
+
+
+def client(service_name, **kwargs):
+    """Returns a shared boto3 client, creating it on first use
+
+    Clients are cached per service name and client arguments (e.g. region_name, config)."""
+    key = (service_name, repr(sorted(kwargs.items())))
+    c = _clients.get(key)
+    if c is None:
+        s = session()
+        with _clients_lock:
+            c = _clients.get(key)
+            if c is None:
+                c = s.client(service_name, **kwargs)
+                if service_name in rate_limited_services:
+                    c.meta.events.register('before-send', _before_send)
+                    c.meta.events.register('needs-retry', _observe_response)
+                _clients[key] = c
+    return c
+
+
+class LazyClient:
+    """Stands in for a boto3 client at module level, creating the shared client on first use
+
+    Usage: iot = tools.LazyClient('iot'), then iot.describe_endpoint() as with a regular client."""
+
+    def __init__(self, service_name, **kwargs):
+        self._service_name = service_name
+        self._kwargs = kwargs
+
+    @property
+    def client(self):
+        return client(self._service_name, **self._kwargs)
+
+    def __getattr__(self, name):
+        if name in ('_service_name', '_kwargs'):
+            raise AttributeError(name)
+        c = self.client
+        attr = getattr(c, name)
+        if self._service_name in rate_limited_services and name in c.meta.method_to_api_mapping:
+            return partial(call_with_backoff, attr)
+        return attr
+
+
+# Rate limiting of AWS control plane calls
+#
+# Every request sent by a client of one of the rate_limited_services first takes a token from the bucket of its
+# API (e.g. "iot.CreateThing"), shared by all handlers and threads of the container. Buckets adapt to the
+# account limits: the rate is halved (at most once per second) whenever a request is throttled and grows again
+# slowly with every successful one. Throttling errors which botocore's own retries didn't absorb are retried by
+# LazyClient calls with jittered exponential backoff, see call_with_backoff.
+
+rate_limited_services = set(filter(None, os.getenv('RATE_LIMITED_SERVICES', 'iot,lightsail,route53').split(',')))
+
+throttling_error_codes = {'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                          'TooManyRequestsException', 'RequestLimitExceeded', 'SlowDown'}
+
+# requests per second per API
+rate_limit_initial = float(os.getenv('RATE_LIMIT_INITIAL', 25))
+rate_limit_min = 0.5
+rate_limit_max = 200
+rate_limit_increase = 0.25
+
+# retries of throttled LazyClient calls on top of botocore's, with backoff of up to base * 2^attempt seconds
+throttle_retries = 5
+throttle_backoff_base = 0.25
+throttle_backoff_max = 20
+
+
+class RateLimiter:
+    """Adaptive token bucket of a single API"""
+
+    def __init__(self, rate=rate_limit_initial):
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.last_decrease = 0.0
+        self.calls = 0
+        self.throttled = 0
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token, sleeping until one is available; returns the number of seconds waited"""
+        with self.lock:
+            now = time.monotonic()
+            # allow bursts of up to one second worth of requests
+            self.tokens = min(max(1.0, self.rate), self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            self.calls += 1
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += wait_time
+        if wait_time:
+            time.sleep(wait_time)
+        return wait_time
+
+    def throttle(self):
+        with self.lock:
+            self.throttled += 1
+            now = time.monotonic()
+            if now - self.last_decrease >= 1:
+                self.rate = max(rate_limit_min, self.rate / 2)
+                self.last_decrease = now
+
+    def success(self):
+        with self.lock:
+            self.rate = min(rate_limit_max, self.rate + rate_limit_increase)
+
+    def stats(self):
+        return {'calls': self.calls, 'throttled': self.throttled, 'waited': self.waited, 'rate': self.rate}
+
+
+_rate_limiters = {}
+
+
+def rate_limiter(api):
+    limiter = _rate_limiters.get(api)
+    if limiter is None:
+        with _clients_lock:
+            limiter = _rate_limiters.setdefault(api, RateLimiter())
+    return limiter
+
+
+def rate_limit_stats():
+    """Returns {api: {calls, throttled, waited (seconds), rate (per second)}} of all rate limited APIs"""
+    return {api: limiter.stats() for api, limiter in list(_rate_limiters.items())}
+
+
+def rate_limit_waited():
+    """Returns the total number of seconds spent waiting for rate limiters"""
+    return sum(limiter.waited for limiter in list(_rate_limiters.values()))
+
+
+def _api_name(event_name):
+    # e.g. before-send.iot.CreateThing
+    return event_name.split('.', 1)[1]
+
+
+def _before_send(event_name, **kwargs):
+    waited = rate_limiter(_api_name(event_name)).acquire()
+    if waited > 1:
+        logging.getLogger().info(f'rate limited {_api_name(event_name)} for {waited:.1f}s')
+
+
+def _observe_response(event_name, response=None, **kwargs):
+    if response is None:
+        return
+    code = response[1].get('Error', {}).get('Code')
+    limiter = rate_limiter(_api_name(event_name))
+    if code in throttling_error_codes:
+        limiter.throttle()
+    elif not code:
+        limiter.success()
+
+
+def throttling_error_p(e):
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') in throttling_error_codes
+
+
+def call_with_backoff(method, *args, **kwargs):
+    """Calls a client method, retrying throttled calls with jittered exponential backoff"""
+    for attempt in range(throttle_retries + 1):
+        try:
+            return method(*args, **kwargs)
+        except ClientError as e:
+            if not throttling_error_p(e) or attempt == throttle_retries:
+                raise
+            time.sleep(random.uniform(0, min(throttle_backoff_max, throttle_backoff_base * 2 ** attempt)))
+
+
+# Environment context - resolved once per container. Each value can also be supplied at deploy time via
+# environment variables (IOT_ENDPOINT, ACCOUNT_ID) to skip the lookup altogether.
+
+@lru_cache(maxsize=None)
+def iot_endpoint():
+    """Returns the address of the ATS IoT data endpoint of the account"""
+    # "We recommend that all customers create an Amazon Trust Services (ATS) endpoint..."
+    return os.getenv('IOT_ENDPOINT') or client('iot').describe_endpoint(endpointType='iot:Data-ATS')['endpointAddress']
+
+
+@lru_cache(maxsize=None)
+def aws_region():
+    """Returns the region we're running in"""
+    return os.getenv('AWS_REGION') or session().region_name or iot_endpoint().split('.')[2]
+
+
+@lru_cache(maxsize=None)
+def aws_account_id():
+    """Returns the AWS account id we're running under"""
+    return os.getenv('ACCOUNT_ID') or client('sts').get_caller_identity()['Account']
+
+
+@lru_cache(maxsize=None)
+def root_ca_pem():
+    """Returns the Amazon Root CA 1 certificate IoT endpoints are signed with (bundled with the package)"""
+    with open(os.path.join(os.path.dirname(__file__), 'AmazonRootCA1.pem')) as f:
+        return f.read()
+
 
 def ignore_resource_already_exists(method, **kwargs):
     try:
@@ -37,3 +255,46 @@ def ignore_all(method, **kwargs):
 
 def rand_string(size=12, chars=string.ascii_uppercase + string.ascii_uppercase + string.digits):
     return ''.join(random.choice(chars) for _ in range(size))
+
+
+def iter_fan_out(method, items, max_workers=16):
+    """Calls method(item) for each of the items using a bounded pool of threads
+
+    Yields (item, result, exception) tuples as soon as each call completes. Items are consumed lazily, so at
+    most max_workers calls are in flight and items can be a generator of any length. max_workers below 1 is
+    treated as 1."""
+    max_workers = max(1, max_workers)
+    items = iter(items)
+    pending = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def submit_next():
+            for item in items:
+                pending[executor.submit(method, item)] = item
+                return True
+            return False
+
+        for _ in range(max_workers):
+            if not submit_next():
+                break
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                submit_next()
+                error = future.exception()
+                yield item, (None if error else future.result()), error
+
+
+def fan_out(method, items, max_workers=16):
+    """Calls method(item) for each of the items using a bounded pool of threads
+
+    Returns a tuple of ({item: result}, {item: exception}) so that a single failing or slow call
+    doesn't prevent the rest from completing."""
+    results = {}
+    errors = {}
+    for item, result, error in iter_fan_out(method, items, max_workers=max_workers):
+        if error is not None:
+            errors[item] = error
+        else:
+            results[item] = result
+    return results, errors
@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""Measures Lambda cold start cost of the cloudcam handlers
+
+Each handler module is imported in a fresh interpreter (like a new Lambda container) and timed in two phases:
+  import - importing the handler module
+  init   - creating the AWS clients the module uses (what the first invocation pays for)
+
+No AWS calls are made; dummy credentials and environment are used where none are configured.
+
+Usage: script/cold_start_benchmark.py [-n RUNS] [module ...]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+repo_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+handler_modules = [
+    'cloudcam.cognito_presignup',
+    'cloudcam.iot_attach_camera_policy',
+    'cloudcam.iot_attach_user_policy',
+    'cloudcam.iot_list_things',
+    'cloudcam.iot_provision_thing',
+    'cloudcam.iot_deprovision_thing',
+    'cloudcam.iot_owner_relay',
+    'cloudcam.iot_request_thumb',
+    'cloudcam.iot_thumb_history',
+    'cloudcam.iot_thumb_sprite',
+    'cloudcam.s3_thumb_derivatives',
+    'cloudcam.janus_start_stream',
+    'cloudcam.janus_stop_stream',
+    'cloudcam.janus_scale_lightsail',
+]
+
+dummy_env = {
+    'AWS_DEFAULT_REGION': 'eu-central-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'CAMERA_IOT_POLICY_NAME': 'benchmark',
+    'USER_IOT_POLICY_NAME': 'benchmark',
+    'S3_THUMB_BUCKET_NAME': 'benchmark',
+    'JANUS_HOSTED_ZONE_ID': 'benchmark',
+    'JANUS_HOSTED_ZONE_DOMAIN': 'benchmark',
+    'JANUS_INSTANCE_NAME_PREFIX': 'benchmark',
+    'LIGHTSAIL_AZS': 'eu-central-1a',
+    'LIGHTSAIL_BLUEPRINT_ID': 'benchmark',
+    'LIGHTSAIL_BUNDLE_ID': 'benchmark',
+    'LIGHTSAIL_JANUS_IMAGE': 'benchmark',
+}
+
+# runs in the child interpreter, prints {"import": seconds, "init": seconds}
+child_script = """
+import importlib, json, sys, time
+start = time.perf_counter()
+module = importlib.import_module(sys.argv[1])
+imported = time.perf_counter()
+from cloudcam import tools
+for value in list(vars(module).values()):
+    if isinstance(value, tools.LazyClient):
+        value.client
+initialized = time.perf_counter()
+print(json.dumps({'import': imported - start, 'init': initialized - imported}))
+"""
+
+
+def measure(module, runs):
+    env = dict(dummy_env, **os.environ)
+    env['PYTHONPATH'] = repo_root + os.pathsep + env.get('PYTHONPATH', '')
+    samples = []
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, '-c', child_script, module], env=env, cwd=repo_root,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if out.returncode != 0:
+            return None, out.stderr.strip().splitlines()[-1]
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return {phase: statistics.median(s[phase] for s in samples) for phase in ('import', 'init')}, None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--runs', type=int, default=5, help='runs per module (the median is reported)')
+    parser.add_argument('modules', nargs='*', default=handler_modules)
+    args = parser.parse_args()
+
+    print(f'{"module":<36} {"import ms":>10} {"init ms":>10} {"total ms":>10}')
+    for module in args.modules:
+        timing, error = measure(module, args.runs)
+        if error:
+            print(f'{module:<36} failed: {error}')
+            continue
+        print(f'{module:<36} {timing["import"] * 1000:>10.1f} {timing["init"] * 1000:>10.1f} '
+              f'{(timing["import"] + timing["init"]) * 1000:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""In-memory fakes of the AWS clients the cloudcam modules use, shared by the tests as fixtures
+
+Each fake implements only the calls (and arguments) the modules make, and records what it was asked for so tests
+can assert on it. Tests monkeypatch them over the clients of the module under test."""
+
+import datetime
+import hashlib
+import io
+import itertools
+import json
+import re
+
+import pytest
+from botocore.exceptions import ClientError
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from cloudcam.iot_shadow import merge
+
+_ca_key = None
+
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': ''}}, operation)
+
+
+def ca_key():
+    """Returns the key fake certificates are signed with (generated on first use)"""
+    global _ca_key
+    if _ca_key is None:
+        _ca_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return _ca_key
+
+
+class FakeS3:
+    """A single bucket of objects (bytes)
+
+    HEAD of a missing key is answered with 404 (the roles have s3:ListBucket), any HEAD with 403 once denied."""
+
+    def __init__(self):
+        self.objects = {}
+        self.metadata = {}
+        self.gets = []
+        self.denied = False
+
+    def head_object(self, Bucket, Key):
+        if self.denied:
+            raise client_error('403', 'HeadObject')
+        if Key not in self.objects:
+            raise client_error('404', 'HeadObject')
+        return {'ETag': hashlib.md5(self.objects[Key]).hexdigest(), 'Metadata': self.metadata[Key]}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise client_error('NoSuchKey', 'GetObject')
+        self.gets.append(Key)
+        return {'Body': io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, Metadata=None, **kwargs):
+        self.objects[Key] = Body.encode() if isinstance(Body, str) else Body
+        self.metadata[Key] = Metadata or {}
+
+    def delete_objects(self, Bucket, Delete):
+        for obj in Delete['Objects']:
+            self.objects.pop(obj['Key'], None)
+            self.metadata.pop(obj['Key'], None)
+
+
+class FakeIoT:
+    """Thing registry (with an eventually consistent fleet index) and certificates
+
+    things are thing names, or {thing name: attributes}. indexed are the things in the fleet index (all by default),
+    search_errors are the error codes the next search_index calls fail with, in order."""
+
+    def __init__(self, things=(), search_errors=(), indexed=None):
+        self.things = dict(things) if isinstance(things, dict) else {name: {} for name in things}
+        self.indexed = set(self.things) if indexed is None else set(indexed)
+        self.search_errors = list(search_errors)
+        self.queries = []
+        self.described = []
+        self.updates = []
+        self.certificates = {}
+        self.certificate_ids = itertools.count()
+        self.certificates_listed = 0
+        self.certificates_described = 0
+
+    def search_index(self, queryString, maxResults):
+        self.queries.append(queryString)
+        if self.search_errors:
+            raise client_error(self.search_errors.pop(0), 'SearchIndex')
+        terms = re.fullmatch(r'thingName:\((.*)\)', queryString).group(1).split(' OR ')
+        names = [re.sub(r'\\(.)', r'\1', term) for term in terms]
+        return {'things': [{'thingName': name} for name in names if name in self.indexed]}
+
+    def describe_thing(self, thingName):
+        self.described.append(thingName)
+        if thingName not in self.things:
+            raise client_error('ResourceNotFoundException', 'DescribeThing')
+        return {'thingName': thingName, 'attributes': self.things[thingName]}
+
+    def update_thing(self, thingName, attributePayload):
+        self.updates.append((thingName, attributePayload))
+
+    def create_certificate_from_csr(self, certificateSigningRequest, setAsActive):
+        csr = x509.load_pem_x509_csr(certificateSigningRequest.encode('ascii'))
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = x509.CertificateBuilder().subject_name(csr.subject).issuer_name(csr.subject) \
+            .public_key(csr.public_key()).serial_number(x509.random_serial_number()) \
+            .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1)) \
+            .sign(ca_key(), hashes.SHA256())
+        certificate_id = f'cert{next(self.certificate_ids)}'
+        pem = cert.public_bytes(serialization.Encoding.PEM).decode('ascii')
+        self.certificates[certificate_id] = {'status': 'ACTIVE' if setAsActive else 'INACTIVE', 'pem': pem,
+                                             'created': now}
+        return {'certificateId': certificate_id, 'certificateArn': f'arn:{certificate_id}', 'certificatePem': pem}
+
+    def update_certificate(self, certificateId, newStatus):
+        self.certificates[certificateId]['status'] = newStatus
+
+    def delete_certificate(self, certificateId):
+        if self.certificates[certificateId]['status'] != 'INACTIVE':
+            raise Exception('certificate is active')
+        del self.certificates[certificateId]
+
+    def list_certificates(self, pageSize, ascendingOrder=False, marker=None):
+        ids = sorted(self.certificates, key=lambda certificate_id: self.certificates[certificate_id]['created'],
+                     reverse=not ascendingOrder)
+        self.certificates_listed += 1
+        start = int(marker or 0)
+        page = ids[start:start + pageSize]
+        return {'certificates': [{'certificateId': certificate_id,
+                                  'status': self.certificates[certificate_id]['status'],
+                                  'creationDate': self.certificates[certificate_id]['created']}
+                                 for certificate_id in page],
+                'nextMarker': str(start + pageSize) if start + pageSize < len(ids) else None}
+
+    def describe_certificate(self, certificateId):
+        self.certificates_described += 1
+        return {'certificateDescription': {'certificatePem': self.certificates[certificateId]['pem']}}
+
+
+class FakeIoTData:
+    """A versioned shadow (the same one for every thing) and a message broker
+
+    before_update are functions run right before each shadow update is applied (to simulate other writers)."""
+
+    def __init__(self, state=None):
+        self.state = state or {}
+        self.version = 1
+        self.before_update = []
+        self.shadow_updates = []
+        self.published = []
+
+    def write(self, changes):
+        self.state = merge(self.state, changes)
+        self.version += 1
+
+    def get_thing_shadow(self, thingName):
+        return {'payload': io.BytesIO(json.dumps({'state': self.state, 'version': self.version}).encode())}
+
+    def update_thing_shadow(self, thingName, payload):
+        self.shadow_updates.append((thingName, payload))
+        if self.before_update:
+            self.before_update.pop(0)(self)
+        update = json.loads(payload.decode())
+        if update.get('version') not in (None, self.version):
+            raise client_error('ConflictException', 'UpdateThingShadow')
+        self.write(update['state'])
+        return {'payload': io.BytesIO(json.dumps({'version': self.version}).encode())}
+
+    def publish(self, topic, qos, payload):
+        self.published.append((topic, payload))
+
+
+@pytest.fixture
+def fake_s3():
+    return FakeS3()
+
+
+@pytest.fixture
+def fake_iot():
+    """Returns a factory of FakeIoT"""
+    return FakeIoT
+
+
+@pytest.fixture
+def fake_iot_data():
+    """Returns a factory of FakeIoTData"""
+    return FakeIoTData
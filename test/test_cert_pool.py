@@ -0,0 +1,79 @@
+"""Certificate pool against a fake IoT control plane"""
+
+import datetime
+import time
+
+from cloudcam import iot_cert_pool
+from cloudcam.iot_cert_pool import CertificatePool
+
+
+def test_pooled_certificates_are_activated_on_claim(fake_iot):
+    iot = fake_iot()
+    pool = CertificatePool(iot, size=2, low_watermark=0, key_workers=1)
+    pool.refill()
+    assert len(pool) == 2
+    assert {cert['status'] for cert in iot.certificates.values()} == {'INACTIVE'}
+
+    keys_and_cert = pool.claim()
+    assert iot.certificates[keys_and_cert['certificateId']]['status'] == 'ACTIVE'
+    assert 'PRIVATE KEY' in keys_and_cert['keyPair']['PrivateKey']
+    assert len(pool) == 1
+
+
+def test_expired_certificates_are_deleted_not_claimed(fake_iot):
+    iot = fake_iot()
+    pool = CertificatePool(iot, size=1, low_watermark=0, max_age=0, key_workers=1)
+    pool.refill()
+    assert pool.claim() is None
+    assert not iot.certificates
+
+
+def test_sweep_deletes_only_stale_inactive_pooled_certificates(fake_iot):
+    iot = fake_iot()
+    # left behind by a recycled container
+    CertificatePool(iot, size=2, low_watermark=0, key_workers=1).refill()
+    # a camera's certificate, and a deactivated certificate not minted by the pool
+    private_key, public_key, csr = iot_cert_pool.generate_key_and_csr()
+    camera = iot.create_certificate_from_csr(csr, setAsActive=True)['certificateId']
+    other = iot.create_certificate_from_csr(csr, setAsActive=False)['certificateId']
+    for cert in iot.certificates.values():
+        cert['created'] -= datetime.timedelta(days=2)
+
+    assert sorted(iot_cert_pool.sweep_stale_certificates(iot, max_age=24 * 3600)) == ['cert0', 'cert1']
+    assert sorted(iot.certificates) == sorted([camera, other])
+
+
+def test_sweep_is_bounded(fake_iot):
+    iot = fake_iot()
+    CertificatePool(iot, size=5, low_watermark=0, key_workers=1).refill()
+    for i, cert in enumerate(iot.certificates.values()):
+        cert['created'] -= datetime.timedelta(days=2, seconds=-i)
+    # younger ones are never looked at
+    for _ in range(3):
+        csr = iot_cert_pool.generate_key_and_csr(iot_cert_pool.pool_common_name)[2]
+        iot.create_certificate_from_csr(csr, setAsActive=False)
+
+    assert len(iot_cert_pool.sweep_stale_certificates(iot, max_age=24 * 3600, max_describes=3)) == 3
+    assert iot.certificates_described == 3
+    assert len(iot_cert_pool.sweep_stale_certificates(iot, max_age=24 * 3600)) == 2
+    assert len(iot.certificates) == 3
+
+
+def test_foreground_pool_refills_when_asked(fake_iot):
+    iot = fake_iot()
+    pool = CertificatePool(iot, size=4, low_watermark=2, key_workers=1, background_refill=False)
+    assert pool.claim() is None
+    assert pool._refill_thread is None
+    pool.refill_if_low()
+    assert len(pool) == 4
+    pool.claim()
+    pool.claim()
+    # at the low watermark, not below
+    pool.refill_if_low()
+    assert len(pool) == 2
+    pool.claim()
+    # out of time, nothing is minted
+    pool.refill_if_low(deadline=time.time() - 1)
+    assert len(pool) == 1
+    pool.refill_if_low()
+    assert len(pool) == 4
@@ -0,0 +1,33 @@
+import json
+import os
+import stat
+
+from cloudcam import cli
+
+
+def test_thing_configs_are_private(tmp_path):
+    path = str(tmp_path / 'cam1.json')
+    cli.write_json_atomic(path, {'certificatePrivateKey': 'secret'})
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    with open(path) as f:
+        assert json.load(f) == {'certificatePrivateKey': 'secret'}
+
+
+def test_journal_tracks_certificates_of_unfinished_things(tmp_path):
+    path = str(tmp_path / 'journal.jsonl')
+    entries = [
+        {'thingName': 'cam1', 'status': 'certificate', 'certificateArn': 'arn:cert/1'},
+        {'thingName': 'cam2', 'status': 'certificate', 'certificateArn': 'arn:cert/2'},
+        {'thingName': 'cam3', 'status': 'certificate', 'certificateArn': 'arn:cert/3'},
+        {'thingName': 'cam1', 'status': 'done'},
+        {'thingName': 'cam3', 'status': 'certificate-deleted', 'certificateArn': 'arn:cert/3'},
+        {'thingName': 'cam3', 'status': 'certificate', 'certificateArn': 'arn:cert/4'},
+    ]
+    with open(path, 'w') as f:
+        f.writelines(json.dumps(entry) + '\n' for entry in entries)
+        # killed while writing the last line
+        f.write('{"thingName": "cam4", "sta')
+
+    done, unfinished = cli.load_journal(path)
+    assert done == {'cam1'}
+    assert unfinished == {'cam2': ['arn:cert/2'], 'cam3': ['arn:cert/4']}
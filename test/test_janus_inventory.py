@@ -0,0 +1,56 @@
+"""Janus gateway inventory: caching, and gateways which are still starting up"""
+
+import pytest
+
+from cloudcam import janus_inventory, store
+from cloudcam.janus_inventory import GatewayInventory
+
+
+class FakeLightsail:
+    def __init__(self, states):
+        self.states = states
+        self.calls = 0
+
+    def get_instances(self, **kwargs):
+        self.calls += 1
+        return {'instances': [{'name': name, 'bundleId': 'micro_2_0', 'hardware': {'cpuCount': 1},
+                               'state': {'name': state}} for name, state in self.states.items()]}
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(janus_inventory, 'time', lambda: now[0])
+    return now
+
+
+def names(records):
+    return [record['name'] for record in records]
+
+
+def test_pending_instances_are_listed_but_not_ready(clock):
+    lightsail = FakeLightsail({'janus-a': 'running', 'janus-b': 'pending', 'janus-c': 'stopping', 'other': 'running'})
+    inventory = GatewayInventory(lightsail, 'janus', store.MemoryStore())
+    # as the scaler does right after creating janus-b and deleting janus-a
+    assert names(inventory.refresh(exclude=['janus-a'])) == ['janus-b']
+    assert inventory.instances() == []
+
+    # picked up from the shared record by other containers soon after it's running
+    lightsail.states['janus-b'] = 'running'
+    other = GatewayInventory(lightsail, 'janus', inventory.store)
+    assert other.instances() == []
+    clock[0] += janus_inventory.pending_ttl + 1
+    assert names(other.instances()) == ['janus-a', 'janus-b']
+
+
+def test_ready_inventory_is_cached_for_the_ttl(clock):
+    lightsail = FakeLightsail({'janus-a': 'running'})
+    inventory = GatewayInventory(lightsail, 'janus', store.MemoryStore())
+    assert names(inventory.instances()) == ['janus-a']
+    lightsail.states['janus-b'] = 'running'
+    clock[0] += janus_inventory.pending_ttl + 1
+    assert names(inventory.instances()) == ['janus-a']
+    assert lightsail.calls == 1
+    clock[0] += janus_inventory.inventory_ttl
+    assert names(inventory.instances()) == ['janus-a', 'janus-b']
+    assert lightsail.calls == 2
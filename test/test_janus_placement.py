@@ -0,0 +1,163 @@
+"""Simulation harness for Janus gateway placement
+
+Streams are started and stopped on a simulated fleet of gateways of different Lightsail bundles, the gateway load
+is read from the simulated fleet instead of the Janus streaming plugin. Balance is measured as the spread between
+the most and the least utilized gateway."""
+
+import logging
+import random
+import statistics
+import threading
+
+import pytest
+
+from cloudcam import janus_placement
+from cloudcam.janus_placement import GatewayLoadCache, LeastLoadedScheduler, NoGatewayCapacity, Placement, \
+    RandomScheduler, Scheduler
+
+log = logging.getLogger('cloudcam.test')
+
+
+class SimulatedFleet:
+    def __init__(self, cpu_counts):
+        self.gateways = [{'instance_id': f'janus-{i}',
+                          'public_dns_name': f'janus-{i}.example.com',
+                          'bundle_id': f'sim_{cpu_count}_0',
+                          'cpu_count': cpu_count} for i, cpu_count in enumerate(cpu_counts)]
+        self.streams = {gateway['public_dns_name']: [] for gateway in self.gateways}
+        self.dead = set()
+        self.next_stream_id = 0
+
+    def stream_count(self, gateway):
+        dns_name = gateway['public_dns_name']
+        if dns_name in self.dead:
+            raise RuntimeError(f'{dns_name} is not responding')
+        return len(self.streams[dns_name])
+
+    def start_stream(self, placement):
+        # the way janus_start_stream places a stream: the best ranked gateway, its load counted right away
+        ranked = placement.rank(self.gateways)
+        if not ranked:
+            raise NoGatewayCapacity("No Janus gateway has capacity for another stream")
+        gateway = ranked[0]
+        placement.load_cache.add_stream(gateway['public_dns_name'])
+        self.next_stream_id += 1
+        self.streams[gateway['public_dns_name']].append(self.next_stream_id)
+        return gateway
+
+    def stop_random_stream(self, rnd):
+        dns_name = rnd.choice([dns_name for dns_name, streams in self.streams.items() if streams])
+        streams = self.streams[dns_name]
+        streams.pop(rnd.randrange(len(streams)))
+
+    def utilizations(self):
+        loads = []
+        for gateway in self.gateways:
+            streams = len(self.streams[gateway['public_dns_name']])
+            loads.append(janus_placement.GatewayLoad(gateway, streams, streams * janus_placement.stream_bitrate_kbps,
+                                                     *janus_placement.gateway_capacity(gateway)))
+        return [load.utilization() for load in loads]
+
+
+def synchronous_load_cache(fleet, max_age=0):
+    """Fetches stale loads before placing, so each placement sees the fleet as it is"""
+    return GatewayLoadCache(fleet.stream_count, max_age=max_age, background_refresh=False)
+
+
+def simulate(scheduler, cpu_counts=(1, 1, 2, 2, 4), steps=2000, load_max_age=0, seed=1):
+    """Runs a random mix of stream starts and stops, returns (fleet, utilization spread at each step)"""
+    rnd = random.Random(seed)
+    fleet = SimulatedFleet(cpu_counts)
+    placement = Placement(scheduler, synchronous_load_cache(fleet, load_max_age))
+    spreads = []
+    for step in range(steps):
+        # the fleet fills up to about half of its capacity, then streams come and go
+        if rnd.random() < 0.6 or not any(fleet.streams.values()):
+            fleet.start_stream(placement)
+        else:
+            fleet.stop_random_stream(rnd)
+            placement.load_cache.invalidate()
+        utilizations = fleet.utilizations()
+        spreads.append(max(utilizations) - min(utilizations))
+    return fleet, spreads
+
+
+def report(name, spreads):
+    log.info(f'{name}: mean spread {statistics.mean(spreads):.3f}, max spread {max(spreads):.3f}')
+
+
+def test_least_loaded_balances_better_than_random():
+    _, least_loaded = simulate(LeastLoadedScheduler())
+    _, rnd = simulate(RandomScheduler())
+    report('least-loaded', least_loaded)
+    report('random', rnd)
+    assert statistics.mean(least_loaded) < statistics.mean(rnd) / 10
+    # stops can unbalance the fleet for a while, starts go to the gateways with the fewest streams though
+    assert statistics.mean(least_loaded) <= 1 / janus_placement.streams_per_cpu
+    assert max(least_loaded) <= 5 / janus_placement.streams_per_cpu
+
+
+def test_cached_load_accounts_for_placed_streams():
+    # the load is never fetched again, placements have to account for the streams they place
+    _, spreads = simulate(LeastLoadedScheduler(), steps=300, load_max_age=3600)
+    report('least-loaded, cached load', spreads)
+    assert statistics.mean(spreads) <= 1 / janus_placement.streams_per_cpu
+    assert max(spreads) <= 5 / janus_placement.streams_per_cpu
+
+
+def test_saturated_gateways_are_refused():
+    fleet = SimulatedFleet([1, 2])
+    placement = Placement(LeastLoadedScheduler(), synchronous_load_cache(fleet))
+    with pytest.raises(NoGatewayCapacity):
+        for _ in range(10000):
+            fleet.start_stream(placement)
+    assert max(fleet.utilizations()) <= janus_placement.max_utilization
+    total_capacity = 3 * janus_placement.streams_per_cpu * janus_placement.max_utilization
+    assert sum(map(len, fleet.streams.values())) >= int(total_capacity) - 2
+
+
+def test_unreachable_gateways_are_skipped():
+    fleet = SimulatedFleet([4, 1])
+    fleet.dead.add('janus-0.example.com')
+    placement = Placement(LeastLoadedScheduler(), synchronous_load_cache(fleet))
+    for _ in range(10):
+        assert fleet.start_stream(placement)['public_dns_name'] == 'janus-1.example.com'
+
+
+def test_pluggable_scheduler():
+    class FirstGatewayScheduler(Scheduler):
+        def rank(self, loads):
+            return sorted(filter(janus_placement.GatewayLoad.headroom_p, loads),
+                          key=lambda load: load.gateway['instance_id'])
+
+    fleet = SimulatedFleet([1, 1, 1])
+    placement = Placement(FirstGatewayScheduler(), synchronous_load_cache(fleet))
+    for _ in range(5):
+        fleet.start_stream(placement)
+    assert len(fleet.streams['janus-0.example.com']) == 5
+    assert placement.rank(fleet.gateways, exclude=['janus-0.example.com'])[0]['instance_id'] == 'janus-1'
+
+
+def test_stale_loads_are_refreshed_in_the_background():
+    fleet = SimulatedFleet([1])
+    gateway = fleet.gateways[0]
+    fetching = threading.Event()
+    release = threading.Event()
+
+    def slow_stream_count(gateway):
+        fetching.set()
+        assert release.wait(5)
+        return fleet.stream_count(gateway)
+
+    load_cache = GatewayLoadCache(fleet.stream_count, max_age=0)
+    assert load_cache.loads([gateway])[0].streams == 0
+    fleet.streams[gateway['public_dns_name']].extend([1, 2])
+    load_cache.stream_count = slow_stream_count
+
+    # the stale load is returned right away while it's being refreshed
+    assert load_cache.loads([gateway])[0].streams == 0
+    assert fetching.wait(5)
+    assert load_cache.loads([gateway])[0].streams == 0
+    release.set()
+    load_cache._refresh_executor.shutdown(wait=True)
+    assert load_cache._streams[gateway['public_dns_name']][0] == 2
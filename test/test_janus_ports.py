@@ -0,0 +1,88 @@
+"""RTP port allocation bitmaps: concurrent allocation, exhaustion and reconciliation with the gateway"""
+
+import threading
+
+import pytest
+
+from cloudcam import janus_ports, store
+from cloudcam.janus_ports import PortAllocator
+
+gateway = 'janus-1.example.com'
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(janus_ports, 'time', lambda: now[0])
+    return now
+
+
+def test_lowest_clear_bit():
+    assert janus_ports.lowest_clear_bit(0) == 0
+    assert janus_ports.lowest_clear_bit(0b1011) == 2
+    assert janus_ports.lowest_clear_bit(0b1111) == 4
+
+
+def test_ports_are_allocated_lowest_first(tmp_path):
+    ports = PortAllocator(store.SQLiteStore(str(tmp_path / 'state.db')), range(20000, 20010, 2))
+    assert [ports.allocate(gateway) for _ in range(5)] == [20000, 20002, 20004, 20006, 20008]
+    with pytest.raises(RuntimeError, match='Unable to allocate RTP port'):
+        ports.allocate(gateway)
+    # gateways have separate bitmaps
+    assert ports.allocate('janus-2.example.com') == 20000
+
+
+def test_concurrent_allocations_get_distinct_ports():
+    ports = PortAllocator(store.MemoryStore(), range(20000, 20200, 2))
+    allocated = []
+    lock = threading.Lock()
+
+    def allocate():
+        for _ in range(10):
+            port = ports.allocate(gateway)
+            with lock:
+                allocated.append(port)
+
+    threads = [threading.Thread(target=allocate) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(allocated) == list(range(20000, 20160, 2))
+
+
+def test_reconciliation_frees_ports_of_gone_streams(clock):
+    ports = PortAllocator(store.MemoryStore(), range(20000, 20010, 2))
+    ports.reconcile(gateway, [20002])
+    assert ports.allocate(gateway) == 20000
+    assert ports.allocate(gateway) == 20004
+
+    # the gateway restarted, only a stream created elsewhere is left; recent allocations are kept
+    clock[0] += 10
+    ports.reconcile(gateway, [20008, 30000])
+    assert ports.allocate(gateway) == 20002
+    clock[0] += janus_ports.allocation_grace + 1
+    ports.reconcile(gateway, [20008])
+    assert ports.allocate(gateway) == 20000
+
+
+def test_allocation_reconciles_when_due(clock):
+    ports = PortAllocator(store.MemoryStore(), range(20000, 20010, 2))
+    calls = []
+
+    def used_ports():
+        calls.append(clock[0])
+        return [20000]
+
+    assert ports.allocate(gateway, used_ports) == 20002
+    assert ports.allocate(gateway, used_ports) == 20004
+    assert len(calls) == 1
+    clock[0] += janus_ports.reconcile_interval + 1
+    assert ports.allocate(gateway, used_ports) == 20002
+    assert len(calls) == 2
+
+
+def test_ports_outside_the_range_are_rejected():
+    ports = PortAllocator(store.MemoryStore(), range(20000, 20010, 2))
+    with pytest.raises(ValueError):
+        ports._index(20010)
@@ -0,0 +1,164 @@
+"""Recording stream allocations in the thing shadow while the thing and concurrent starts update it"""
+
+import os
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+os.environ.setdefault('JANUS_HOSTED_ZONE_DOMAIN', 'janus.example.com')
+os.environ.setdefault('JANUS_INSTANCE_NAME_PREFIX', 'janus')
+
+from cloudcam import janus_api, janus_start_stream  # noqa: E402
+from cloudcam.iot_shadow import ShadowCache  # noqa: E402
+
+
+def stream(gateway, stream_id):
+    return {'gateway_instance': gateway, 'stream_id': stream_id, 'stream_name': f'rtp-h264-{stream_id}'}
+
+
+@pytest.fixture
+def start(monkeypatch):
+    allocated = []
+    released = []
+
+    def allocate_streams(janus_instances, primary, standby):
+        allocated.append((primary, standby))
+        # existing streams are kept, missing ones get created
+        return primary or stream('a', 20000 + len(allocated)), standby or stream('b', 21000 + len(allocated))
+
+    def run(iot_data, shadows=None):
+        monkeypatch.setattr(janus_start_stream, 'shadows', shadows or ShadowCache(iot_data))
+        monkeypatch.setattr(janus_start_stream, 'get_janus_instances', lambda: [])
+        monkeypatch.setattr(janus_start_stream, 'allocate_streams', allocate_streams)
+        monkeypatch.setattr(janus_start_stream, 'release_streams', lambda streams: released.extend(streams))
+        return janus_start_stream.handler({'thingName': 'cam1'}, None)
+
+    run.allocated = allocated
+    run.released = released
+    return run
+
+
+def test_reports_of_the_thing_do_not_reallocate(start, fake_iot_data):
+    iot_data = fake_iot_data({'desired': {}, 'reported': {'online': True}})
+    # the thing reports twice while the streams are being allocated
+    iot_data.before_update = [lambda shadow: shadow.write({'reported': {'seq': 1}}),
+                              lambda shadow: shadow.write({'reported': {'seq': 2}})]
+    streams = start(iot_data)
+    assert len(start.allocated) == 1
+    assert iot_data.state['desired']['streams'] == streams
+    assert iot_data.state['reported'] == {'online': True, 'seq': 2}
+    assert not start.released
+
+
+def test_concurrent_start_wins(start, fake_iot_data):
+    iot_data = fake_iot_data({'desired': {}})
+    other = {'primary': stream('c', 20500), 'standby': stream('d', 20600), 'current': 'primary'}
+    iot_data.before_update = [lambda shadow: shadow.write({'desired': {'streams': other}})]
+    streams = start(iot_data)
+    # allocated again from the streams of the other start, which are kept
+    assert start.allocated == [(None, None), (other['primary'], other['standby'])]
+    assert streams == other
+    assert iot_data.state['desired']['streams'] == other
+    assert start.released == [stream('a', 20001), stream('b', 21001)]
+
+
+def test_shadow_is_read_fresh(start, fake_iot_data):
+    iot_data = fake_iot_data({'desired': {}})
+    shadows = ShadowCache(iot_data)
+    shadows.get('cam1')
+    # started by another container after this one cached the shadow
+    existing = {'primary': stream('c', 20500), 'standby': None, 'current': 'primary'}
+    iot_data.write({'desired': {'streams': existing}})
+    start(iot_data, shadows)
+    assert start.allocated == [(existing['primary'], None)]
+
+
+def test_streams_created_after_a_timeout_are_destroyed(monkeypatch):
+    created = threading.Event()
+    released = []
+    destroyed = threading.Event()
+
+    def janus_allocate_stream(dns_name, stream, deadline):
+        if dns_name == 'slow.example.com':
+            time.sleep(0.3)
+            created.set()
+        return {'gateway_instance': dns_name, 'stream_id': 20000, 'stream_name': 'rtp-h264-20000'}
+
+    def release_streams(streams):
+        released.extend(streams)
+        destroyed.set()
+
+    gateways = [{'instance_id': name, 'public_dns_name': f'{name}.example.com'} for name in ['slow', 'fast']]
+    monkeypatch.setattr(janus_start_stream, 'janus_allocate_timeout', 0.1)
+    monkeypatch.setattr(janus_start_stream, 'janus_allocate_stream', janus_allocate_stream)
+    monkeypatch.setattr(janus_start_stream, 'release_streams', release_streams)
+    monkeypatch.setattr(janus_start_stream.placement, 'rank', lambda gateways: gateways)
+
+    primary, standby = janus_start_stream.allocate_streams(gateways, None, None)
+    # the primary timed out with no gateway left to fail over to, the standby took its place
+    assert primary['gateway_instance'] == 'fast.example.com' and standby is None
+    assert created.wait(5) and destroyed.wait(5)
+    assert released == [{'gateway_instance': 'slow.example.com', 'stream_id': 20000, 'stream_name': 'rtp-h264-20000'}]
+
+
+def test_janus_requests_are_bounded_by_the_deadline():
+    session = janus_api.JanusSession('https://janus.example.com:8089/janus')
+    with pytest.raises(TimeoutError):
+        session.message({'request': 'list'}, deadline=time.time() - 1)
+    with session.lock:
+        started = time.time()
+        with pytest.raises(TimeoutError):
+            session.message({'request': 'list'}, deadline=time.time() + 0.1)
+        assert time.time() - started < 1
+    assert janus_api.request_timeout(time.time() + 100) == janus_api.janus_connect_timeout
+    assert janus_api.request_timeout(time.time() + 1) <= 1
+
+
+def test_streams_are_released_when_they_cannot_be_recorded(start, fake_iot_data):
+    iot_data = fake_iot_data({'desired': {}})
+    # the thing keeps reporting until the update gives up
+    iot_data.before_update = [lambda shadow: shadow.write({'reported': {'seq': 1}})] * 11
+    with pytest.raises(ClientError):
+        start(iot_data)
+    assert len(start.allocated) == 1
+    assert start.released == [stream('a', 20001), stream('b', 21001)]
+    assert 'streams' not in iot_data.state['desired']
+
+
+def test_failed_gateway_fails_over_to_the_next_ranked(monkeypatch):
+    attempts = []
+
+    def janus_allocate_stream(dns_name, stream, deadline):
+        attempts.append(dns_name)
+        if dns_name == 'first.example.com':
+            raise RuntimeError('Janus error 456: Missing element')
+        return {'gateway_instance': dns_name, 'stream_id': 20000, 'stream_name': 'rtp-h264-20000'}
+
+    gateways = [{'instance_id': name, 'public_dns_name': f'{name}.example.com'}
+                for name in ['first', 'second', 'third']]
+    monkeypatch.setattr(janus_start_stream, 'janus_allocate_stream', janus_allocate_stream)
+    monkeypatch.setattr(janus_start_stream.placement, 'rank', lambda gateways: gateways)
+
+    primary, standby = janus_start_stream.allocate_streams(gateways, None, None)
+    assert primary['gateway_instance'] == 'third.example.com'
+    assert standby['gateway_instance'] == 'second.example.com'
+    assert sorted(attempts) == ['first.example.com', 'second.example.com', 'third.example.com']
+
+
+def test_sessions_of_gateways_gone_from_the_inventory_are_dropped(monkeypatch):
+    class FakeInventory:
+        def instances(self):
+            return [{'name': 'janus-1', 'bundleId': 'small_2_0', 'hardware': {'cpuCount': 1}}]
+
+    pool = janus_api.JanusSessionPool()
+    pool._keepalive_thread = threading.Thread()  # not started, the sessions are never used
+    pool.session(janus_start_stream.get_lightsail_public_dns_name({'name': 'janus-1'}))
+    pool.session(janus_start_stream.get_lightsail_public_dns_name({'name': 'janus-0'}))
+    monkeypatch.setattr(janus_api, 'pool', pool)
+    monkeypatch.setattr(janus_start_stream, 'inventory', FakeInventory())
+
+    instances = janus_start_stream.get_janus_instances()
+    assert [instance['instance_id'] for instance in instances] == ['janus-1']
+    assert pool.gateways() == [instances[0]['public_dns_name']]
@@ -0,0 +1,62 @@
+"""Batched thing existence checks against a fake IoT registry"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from cloudcam import iot_deprovision_thing, iot_list_things, owner_index, store
+
+
+@pytest.fixture(autouse=True)
+def search_index_available(monkeypatch):
+    monkeypatch.setattr(iot_list_things, '_search_index_unavailable', False)
+
+
+def test_hyphenated_names_are_escaped(monkeypatch, fake_iot):
+    iot = fake_iot(['cam-1', 'front-door_2', 'cam3'])
+    monkeypatch.setattr(iot_list_things, 'iot', iot)
+    names = ['cam-1', 'front-door_2', 'cam3', 'back-door', '-leading']
+    assert iot_list_things.things_exist(names) == {'cam-1': True, 'front-door_2': True, 'cam3': True,
+                                                   'back-door': False, '-leading': False}
+    assert iot.queries == [r'thingName:(cam\-1 OR front\-door_2 OR cam3 OR back\-door OR \-leading)']
+    # only names the index didn't return are described
+    assert sorted(iot.described) == ['-leading', 'back-door']
+
+
+def test_things_missing_from_the_index_are_confirmed(monkeypatch, fake_iot):
+    # cam2 was just provisioned and isn't indexed yet
+    iot = fake_iot(['cam1', 'cam2'], indexed=['cam1'])
+    monkeypatch.setattr(iot_list_things, 'iot', iot)
+    assert iot_list_things.things_exist(['cam1', 'cam2', 'cam3']) == {'cam1': True, 'cam2': True, 'cam3': False}
+    assert sorted(iot.described) == ['cam2', 'cam3']
+
+
+def test_failed_query_falls_back_for_its_batch_only(monkeypatch, fake_iot):
+    monkeypatch.setattr(iot_list_things, 'search_batch_size', 2)
+    iot = fake_iot(['cam1', 'cam2', 'cam3', 'cam4'], search_errors=['InvalidRequestException'])
+    monkeypatch.setattr(iot_list_things, 'iot', iot)
+    assert iot_list_things.things_exist(['cam1', 'cam2', 'cam3', 'cam4']) == dict.fromkeys(
+        ['cam1', 'cam2', 'cam3', 'cam4'], True)
+    assert sorted(iot.described) == ['cam1', 'cam2']
+    assert len(iot.queries) == 2
+    assert not iot_list_things._search_index_unavailable
+
+
+def test_denied_search_falls_back_to_describe_thing(monkeypatch, fake_iot):
+    iot = fake_iot(['cam-1'], search_errors=['AccessDeniedException'])
+    monkeypatch.setattr(iot_list_things, 'iot', iot)
+    assert iot_list_things.things_exist(['cam-1', 'cam2']) == {'cam-1': True, 'cam2': False}
+    assert sorted(iot.described) == ['cam-1', 'cam2']
+
+
+def test_deprovision_reports_missing_things(monkeypatch, fake_iot):
+    state_store = store.MemoryStore()
+    monkeypatch.setattr(store, 'default_store', lambda: state_store)
+    owner_index.backfill_owner_things('eu-central-1:alice', ['cam-1', 'cam-2'])
+    monkeypatch.setattr(iot_list_things, 'iot', fake_iot(['cam-1']))
+    monkeypatch.setattr(iot_deprovision_thing, 'deprovision_thing', lambda thing_name: None)
+
+    context = SimpleNamespace(identity=SimpleNamespace(cognito_identity_id='eu-central-1:alice'))
+    result = iot_deprovision_thing.handler({'thingNames': ['cam-1', 'cam-2']}, context)
+    assert result == {'deprovisioned': ['cam-1'], 'missing': ['cam-2'], 'errors': {}}
+    assert owner_index.owner_things('eu-central-1:alice') == ['cam-1']
@@ -0,0 +1,55 @@
+"""Shared identity policy mode: owner namespace relay and camera takeover protection"""
+
+import base64
+from types import SimpleNamespace
+
+import pytest
+
+from cloudcam import iot_attach_camera_policy, iot_owner_relay
+
+
+def message(topic, payload=b''):
+    return {'topic': topic, 'payload': base64.b64encode(payload).decode()}
+
+
+@pytest.fixture
+def relay(monkeypatch, fake_iot, fake_iot_data):
+    iot = fake_iot({'cam1': {'owner': 'eu-central-1:alice', 'access:eu-central-1:alice': 'owner'},
+                   'cam2': {'access:': 'owner'}})
+    iot_data = fake_iot_data()
+    monkeypatch.setattr(iot_owner_relay, 'iot', iot)
+    monkeypatch.setattr(iot_owner_relay, 'iot_data', iot_data)
+    monkeypatch.setattr(iot_owner_relay, '_owners', {})
+    return iot_data
+
+
+def test_requests_of_the_owner_are_relayed(relay):
+    iot_owner_relay.handler(message('cloudcam/owner/eu-central-1:alice/cam1/shadow/update', b'{"state": {}}'), None)
+    iot_owner_relay.handler(message('cloudcam/owner/eu-central-1:alice/cam1/shadow/get'), None)
+    iot_owner_relay.handler(message('cloudcam/owner/eu-central-1:alice/cam1/webrtc/setup', b'{"sdp": ""}'), None)
+    assert relay.shadow_updates == [('cam1', b'{"state": {}}')]
+    shadow = relay.get_thing_shadow(thingName='cam1')['payload'].read()
+    assert relay.published == [('cloudcam/owner/eu-central-1:alice/cam1/shadow/get/accepted', shadow),
+                               ('cloudcam/cam1/webrtc/setup', b'{"sdp": ""}')]
+
+
+def test_requests_for_other_things_are_dropped(relay):
+    for thing_name in ['cam1', 'cam2', 'missing']:
+        iot_owner_relay.handler(message(f'cloudcam/owner/eu-central-1:mallory/{thing_name}/shadow/update', b'{}'),
+                                None)
+    assert not relay.shadow_updates
+
+
+def test_shadow_updates_are_relayed_to_the_owner(relay):
+    iot_owner_relay.handler(message('$aws/things/cam1/shadow/update/accepted', b'{"state": {}}'), None)
+    iot_owner_relay.handler(message('$aws/things/cam2/shadow/update/accepted', b'{"state": {}}'), None)
+    assert relay.published == [('cloudcam/owner/eu-central-1:alice/cam1/shadow/update/accepted', b'{"state": {}}')]
+
+
+def test_cameras_of_other_identities_cannot_be_taken_over(monkeypatch, fake_iot):
+    iot = fake_iot({'cam1': {'access:eu-central-1:alice': 'owner'}})
+    monkeypatch.setattr(iot_attach_camera_policy, 'iot', iot)
+    context = SimpleNamespace(identity=SimpleNamespace(cognito_identity_id='eu-central-1:mallory'))
+    with pytest.raises(Exception, match='owned by another identity'):
+        iot_attach_camera_policy.handler({'thingName': 'cam1'}, context)
+    assert not iot.updates
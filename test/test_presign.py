@@ -0,0 +1,52 @@
+"""Checks the local SigV4 URL signer against botocore's presigned URLs"""
+
+from datetime import datetime, timezone
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+import boto3
+import pytest
+from botocore.config import Config
+
+from cloudcam import presign
+from cloudcam.presign import PresignedUrlCache, S3UrlSigner
+
+now = datetime(2020, 5, 17, 12, 30, 45, tzinfo=timezone.utc)
+region = 'eu-central-1'
+
+
+def session(token=None):
+    return boto3.session.Session(aws_access_key_id='AKIDEXAMPLE', aws_secret_access_key='wJalrXUtnFEMI/K7MDENG',
+                                 aws_session_token=token, region_name=region)
+
+
+def botocore_url(session, bucket, key, method, expires_in):
+    s3 = session.client('s3', config=Config(signature_version='s3v4', s3={'addressing_style': 'virtual'}))
+    with mock.patch('botocore.auth.get_current_datetime', return_value=now.replace(tzinfo=None)):
+        return s3.generate_presigned_url({'GET': 'get_object', 'PUT': 'put_object'}[method],
+                                         Params={'Bucket': bucket, 'Key': key},
+                                         ExpiresIn=expires_in, HttpMethod=method)
+
+
+def split(url):
+    parts = urlsplit(url)
+    return parts.netloc, parts.path, parse_qs(parts.query)
+
+
+@pytest.mark.parametrize('token', [None, 'session/token+=='])
+@pytest.mark.parametrize('method', ['GET', 'PUT'])
+@pytest.mark.parametrize('key', ['thumb/cam1.jpg', 'upload/cam 1+x~(2).jpg', 'history/cam-1/2020/05/17/1589718645000.jpg'])
+def test_signer_matches_botocore(token, method, key):
+    s = session(token)
+    credentials = s.get_credentials().get_frozen_credentials()
+    signer = S3UrlSigner(credentials.access_key, credentials.secret_key, credentials.token, region, now=now)
+    assert split(signer.sign('cloudcam-thumbs', key, method, 3600)) == \
+        split(botocore_url(s, 'cloudcam-thumbs', key, method, 3600))
+
+
+def test_presigned_urls_are_cached():
+    cache = PresignedUrlCache()
+    url_keys = [('cloudcam-thumbs', 'thumb/cam1.jpg', 'GET'), ('cloudcam-thumbs', 'upload/cam1.jpg', 'PUT')]
+    urls = presign.presigned_urls(session(), region, cache, url_keys)
+    assert presign.presigned_urls(session(), region, cache, url_keys) == urls
+    assert cache.get(url_keys[0]) == urls[0]
@@ -0,0 +1,121 @@
+"""Adaptive rate limiting and backoff of AWS control plane calls, on a simulated clock"""
+
+import pytest
+from botocore.exceptions import ClientError
+
+from cloudcam import tools
+from cloudcam.tools import RateLimiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(tools.time, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(tools.time, 'sleep', clock.sleep)
+    return clock
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': ''}}, 'CreateThing')
+
+
+def test_bursts_up_to_one_second_then_paces(clock):
+    limiter = RateLimiter(rate=10)
+    clock.now += 5
+    # the bucket holds at most one second worth of tokens, however long it was idle
+    assert [limiter.acquire() for _ in range(10)] == [0.0] * 10
+    assert limiter.acquire() == pytest.approx(0.1)
+    assert limiter.acquire() == pytest.approx(0.1)
+    assert limiter.stats()['calls'] == 12
+    assert limiter.stats()['waited'] == pytest.approx(0.2)
+
+
+def test_sustained_rate(clock):
+    limiter = RateLimiter(rate=20)
+    start = clock.now
+    for _ in range(201):
+        limiter.acquire()
+    assert clock.now - start == pytest.approx(10, abs=0.1)
+
+
+def test_throttling_halves_rate_once_per_second(clock):
+    limiter = RateLimiter(rate=16)
+    limiter.throttle()
+    limiter.throttle()
+    assert limiter.rate == 8
+    clock.now += 1
+    limiter.throttle()
+    assert limiter.rate == 4
+    assert limiter.stats()['throttled'] == 3
+
+    limiter.success()
+    assert limiter.rate == 4 + tools.rate_limit_increase
+
+
+def test_rate_stays_within_bounds(clock):
+    limiter = RateLimiter(rate=1)
+    for _ in range(10):
+        clock.now += 1
+        limiter.throttle()
+    assert limiter.rate == tools.rate_limit_min
+    for _ in range(10000):
+        limiter.success()
+    assert limiter.rate == tools.rate_limit_max
+
+
+def test_responses_adapt_the_limiter_of_their_api(clock, monkeypatch):
+    monkeypatch.setattr(tools, '_rate_limiters', {})
+    tools._before_send('before-send.iot.CreateThing')
+    tools._observe_response('needs-retry.iot.CreateThing', response=(None, {'Error': {'Code': 'ThrottlingException'}}))
+    tools._observe_response('needs-retry.iot.DescribeThing', response=(None, {}))
+    stats = tools.rate_limit_stats()
+    assert stats['iot.CreateThing']['rate'] == tools.rate_limit_initial / 2
+    assert stats['iot.DescribeThing']['rate'] == tools.rate_limit_initial + tools.rate_limit_increase
+
+
+def test_backoff_retries_throttled_calls(clock):
+    responses = [client_error('ThrottlingException'), client_error('TooManyRequestsException'), 'ok']
+
+    def method():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    assert tools.call_with_backoff(method) == 'ok'
+    assert len(clock.slept) == 2
+    assert all(0 <= s <= tools.throttle_backoff_base * 2 ** i for i, s in enumerate(clock.slept))
+
+
+def test_backoff_gives_up(clock):
+    calls = []
+
+    def throttled():
+        calls.append(1)
+        raise client_error('ThrottlingException')
+
+    with pytest.raises(ClientError):
+        tools.call_with_backoff(throttled)
+    assert len(calls) == tools.throttle_retries + 1
+
+    def failing():
+        calls.append(1)
+        raise client_error('ResourceNotFoundException')
+
+    calls.clear()
+    with pytest.raises(ClientError):
+        tools.call_with_backoff(failing)
+    assert len(calls) == 1
@@ -0,0 +1,99 @@
+"""Versioned state stores, optimistic locking and the owner -> things index on top of them"""
+
+import threading
+
+import pytest
+
+from cloudcam import owner_index, store
+
+
+@pytest.fixture(params=['memory', 'sqlite'])
+def state_store(request, tmp_path):
+    if request.param == 'sqlite':
+        return store.SQLiteStore(str(tmp_path / 'state.db'))
+    return store.MemoryStore()
+
+
+@pytest.fixture
+def default_store(monkeypatch, state_store):
+    monkeypatch.setattr(store, 'default_store', lambda: state_store)
+    return state_store
+
+
+def test_store_is_abstract():
+    with pytest.raises(TypeError):
+        store.Store()
+
+
+def test_versions(state_store):
+    assert state_store.get('k') == (None, 0)
+    assert state_store.put('k', {'a': 1}, expected_version=0) == 1
+    assert state_store.put('k', {'a': 2}) == 2
+    assert state_store.get('k') == ({'a': 2}, 2)
+
+    with pytest.raises(store.VersionConflict):
+        state_store.put('k', {'a': 3}, expected_version=0)
+    with pytest.raises(store.VersionConflict):
+        state_store.put('k', {'a': 3}, expected_version=1)
+    with pytest.raises(store.VersionConflict):
+        state_store.delete('k', expected_version=1)
+    assert state_store.get('k') == ({'a': 2}, 2)
+
+    state_store.delete('k', expected_version=2)
+    assert state_store.get('k') == (None, 0)
+
+
+def test_update_retries_conflicts(state_store):
+    state_store.put('k', 0)
+    calls = []
+
+    def increment(value):
+        calls.append(value)
+        if len(calls) == 1:
+            # a concurrent writer gets in between the read and the write
+            state_store.put('k', 10)
+        return value + 1
+
+    assert state_store.update('k', increment) == 11
+    assert calls == [0, 10]
+    assert state_store.update('k', lambda value: None) is None
+    assert state_store.get('k') == (None, 0)
+
+
+def test_concurrent_updates_are_not_lost(state_store):
+    threads = [threading.Thread(target=lambda: state_store.update('k', lambda v: (v or 0) + 1, retries=100))
+               for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert state_store.get('k')[0] == 16
+
+
+def test_owner_index_is_used_once_synced(default_store):
+    owner_index.add_thing('alice', 'cam1')
+    # only knows about cam1, the registry may have more
+    assert owner_index.owner_things('alice') is None
+    owner_index.backfill_owner_things('alice', ['cam1', 'cam2'])
+    owner_index.remove_thing('alice', 'cam2')
+    assert owner_index.owner_things('alice') == ['cam1']
+
+
+def test_backfill_keeps_things_added_while_listing(default_store, monkeypatch):
+    monkeypatch.setattr(owner_index, 'time', lambda: 100.0)
+    owner_index.backfill_owner_things('alice', ['cam1', 'old'], listed_at=50.0)
+
+    # a sync starts listing the registry at 200, cam2 is provisioned at 210 before the stale listing is written
+    monkeypatch.setattr(owner_index, 'time', lambda: 210.0)
+    owner_index.add_thing('alice', 'cam2')
+    owner_index.backfill_owner_things('alice', ['cam1'], listed_at=200.0)
+    # old was removed from the registry outside the index, cam2 was added concurrently
+    assert owner_index.owner_things('alice') == ['cam1', 'cam2']
+
+
+def test_stale_index_is_resynced(default_store, monkeypatch):
+    monkeypatch.setattr(owner_index, 'time', lambda: 100.0)
+    owner_index.backfill_owner_things('alice', ['cam1'])
+    assert owner_index.owner_things('alice') == ['cam1']
+    monkeypatch.setattr(owner_index, 'time', lambda: 101.0 + owner_index.owner_index_max_age)
+    assert owner_index.owner_things('alice') is None
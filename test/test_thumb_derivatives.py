@@ -0,0 +1,45 @@
+"""Upload promotion against an in-memory S3 bucket"""
+
+from io import BytesIO
+
+import numpy as np
+import pytest
+from botocore.exceptions import ClientError
+from PIL import Image
+
+from cloudcam import s3_thumb_derivatives
+from cloudcam.thumbs import thumb_key
+
+
+def jpeg(seed, size=(640, 480)):
+    pixels = np.random.RandomState(seed).randint(0, 256, (size[1], size[0], 3), dtype=np.uint8)
+    out = BytesIO()
+    Image.fromarray(pixels).save(out, 'JPEG')
+    return out.getvalue()
+
+
+@pytest.fixture
+def s3(monkeypatch, fake_s3):
+    monkeypatch.setattr(s3_thumb_derivatives, 's3', fake_s3)
+    monkeypatch.setattr(s3_thumb_derivatives, 'thumb_history_size', 0)
+    return fake_s3
+
+
+def test_first_upload_is_promoted(s3):
+    frame = jpeg(0)
+    assert s3_thumb_derivatives.process_upload('bucket', 'cam1', frame, uploaded_ms=1000)
+    assert s3.objects[thumb_key('cam1')] == frame
+    assert thumb_key('cam1', 'small') in s3.objects
+
+
+def test_duplicates_are_dropped(s3):
+    assert s3_thumb_derivatives.process_upload('bucket', 'cam1', jpeg(0), uploaded_ms=1000)
+    assert not s3_thumb_derivatives.process_upload('bucket', 'cam1', jpeg(0), uploaded_ms=2000)
+    assert s3_thumb_derivatives.process_upload('bucket', 'cam1', jpeg(1), uploaded_ms=3000)
+
+
+def test_permission_errors_are_not_taken_for_missing_thumbnails(s3):
+    assert s3_thumb_derivatives.process_upload('bucket', 'cam1', jpeg(0), uploaded_ms=1000)
+    s3.denied = True
+    with pytest.raises(ClientError):
+        s3_thumb_derivatives.process_upload('bucket', 'cam1', jpeg(0), uploaded_ms=2000)
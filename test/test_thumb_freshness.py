@@ -0,0 +1,37 @@
+from cloudcam import iot_request_thumb, store, thumb_freshness, tools
+from cloudcam.thumb_freshness import FreshnessIndex
+
+
+def test_uploads_recorded_from_events():
+    state_store = store.MemoryStore()
+    freshness = FreshnessIndex(state_store)
+    assert freshness.last_upload('cam1', now=1000) is None
+    assert not freshness.is_fresh('cam1', 60, now=1000)
+
+    thumb_freshness.record_upload('cam1', 990, state_store)
+    # an older upload event arriving late doesn't move the upload time back
+    thumb_freshness.record_upload('cam1', 900, state_store)
+    assert freshness.last_upload('cam1', now=1000) == 990
+    assert freshness.is_fresh('cam1', 60, now=1000)
+    assert not freshness.is_fresh('cam1', 60, now=1100)
+
+
+def test_requests_are_coalesced():
+    freshness = FreshnessIndex(store.MemoryStore())
+    freshness.record_request('cam1', requested=1000)
+    assert freshness.is_fresh('cam1', 60, now=1030)
+    assert not freshness.is_fresh('cam1', 60, now=1061)
+    assert not freshness.is_fresh('cam1', 0, now=1030)
+
+
+def test_thumb_requests_clamp_concurrency(monkeypatch):
+    freshness = FreshnessIndex(store.MemoryStore())
+    freshness.record_request('cam1')
+    monkeypatch.setattr(iot_request_thumb, 'freshness', freshness)
+    for concurrency in [0, -3]:
+        result = iot_request_thumb.handler({'thingNames': ['cam1'], 'concurrency': concurrency}, None)
+        assert result == {'results': {'cam1': {'success': True, 'skipped': True}}}
+
+
+def test_fan_out_runs_with_at_least_one_worker():
+    assert tools.fan_out(lambda x: x * 2, [1, 2], max_workers=0) == ({1: 2, 2: 4}, {})
@@ -0,0 +1,75 @@
+"""Thumbnail history index kept in the state store, frames in an in-memory S3 bucket"""
+
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from cloudcam import iot_thumb_history, store, thumb_history
+
+
+@pytest.fixture
+def state_store():
+    return store.MemoryStore()
+
+
+def test_ring_buffer(state_store, fake_s3):
+    for ts in [5000, 1000, 3000, 2000, 4000]:
+        thumb_history.append_frame(fake_s3, 'bucket', 'cam1', ts, str(ts).encode(), capacity=3, state_store=state_store)
+    index = thumb_history.load_index('cam1', state_store)
+    assert [thumb_history.frame_timestamp_ms(frame_id) for frame_id in index] == [3000, 4000, 5000]
+    assert sorted(fake_s3.objects) == sorted(thumb_history.frame_key('cam1', frame_id) for frame_id in index)
+
+
+def test_frames_of_the_same_millisecond_are_kept(state_store, fake_s3):
+    frame_ids = [thumb_history.append_frame(fake_s3, 'bucket', 'cam1', 1000, bytes([i]), capacity=10,
+                                            state_store=state_store) for i in range(3)]
+    assert len(set(frame_ids)) == 3
+    assert len(fake_s3.objects) == 3
+    assert thumb_history.query(thumb_history.load_index('cam1', state_store), 1000, 1000, 10) == frame_ids
+
+
+def test_concurrent_appends_lose_no_frames(state_store, fake_s3):
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda ts: thumb_history.append_frame(fake_s3, 'bucket', 'cam1', ts, b'', capacity=1000,
+                                                                state_store=state_store),
+                          [1000 + ts % 20 for ts in range(100)]))
+    index = thumb_history.load_index('cam1', state_store)
+    assert len(index) == 100
+    assert len(set(index)) == 100
+    assert list(index) == sorted(index)
+
+
+def test_failed_frame_upload_is_removed_from_index(state_store, fake_s3):
+    def put_object(**kwargs):
+        raise RuntimeError('upload failed')
+
+    fake_s3.put_object = put_object
+    with pytest.raises(RuntimeError):
+        thumb_history.append_frame(fake_s3, 'bucket', 'cam1', 1000, b'', capacity=10, state_store=state_store)
+    assert len(thumb_history.load_index('cam1', state_store)) == 0
+
+
+def test_query_spreads_frames_across_range(state_store, fake_s3):
+    for ts in range(0, 100000, 1000):
+        thumb_history.append_frame(fake_s3, 'bucket', 'cam1', ts, b'', capacity=1000, state_store=state_store)
+    index = thumb_history.load_index('cam1', state_store)
+    frames = [thumb_history.frame_timestamp_ms(frame_id) for frame_id in thumb_history.query(index, 10000, 20000, 3)]
+    assert frames == [10000, 15000, 20000]
+    assert thumb_history.query(index, 500, 900, 10) == []
+
+
+def test_index_size_is_capped(state_store, monkeypatch, fake_s3):
+    monkeypatch.setattr(thumb_history, 'max_index_frames', 2)
+    for ts in [1000, 2000, 3000]:
+        thumb_history.append_frame(fake_s3, 'bucket', 'cam1', ts, b'', capacity=10, state_store=state_store)
+    assert len(thumb_history.load_index('cam1', state_store)) == 2
+    assert len(fake_s3.objects) == 2
+
+
+def test_history_requires_an_identity():
+    with pytest.raises(Exception, match='Cognito identity not present'):
+        iot_thumb_history.handler({'thingName': 'cam1'}, None)
+    with pytest.raises(Exception, match='Cognito identity not present'):
+        iot_thumb_history.handler({'thingName': 'cam1'},
+                                  SimpleNamespace(identity=SimpleNamespace(cognito_identity_id=None)))
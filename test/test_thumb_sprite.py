@@ -0,0 +1,79 @@
+"""Sprite rebuilds against an in-memory S3 bucket"""
+
+import json
+from io import BytesIO
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from botocore.exceptions import ClientError
+from PIL import Image
+
+from cloudcam import iot_thumb_sprite
+from cloudcam.thumbs import thumb_key, thumb_sizes
+
+
+def jpeg(seed):
+    pixels = np.random.RandomState(seed).randint(0, 256, (*reversed(thumb_sizes['small']), 3), dtype=np.uint8)
+    out = BytesIO()
+    Image.fromarray(pixels).save(out, 'JPEG')
+    return out.getvalue()
+
+
+def tile(s3, sprite_map, thing_name, ext='png'):
+    t = sprite_map['tiles'][thing_name]
+    sprite = Image.open(BytesIO(s3.objects[iot_thumb_sprite.sprite_key('id', ext)])).convert('RGB')
+    return np.asarray(sprite.crop((t['x'], t['y'], t['x'] + t['w'], t['y'] + t['h'])))
+
+
+@pytest.fixture
+def s3(monkeypatch, fake_s3):
+    monkeypatch.setattr(iot_thumb_sprite, 's3', fake_s3)
+    return fake_s3
+
+
+def test_unchanged_tiles_are_copied_losslessly(s3):
+    for i, thing_name in enumerate(['cam1', 'cam2', 'cam3']):
+        s3.put_object('', thumb_key(thing_name, 'small'), jpeg(i))
+    # cam4 has no thumbnail yet, the 404 of its HEAD must not break the sprite
+    sprite_map = iot_thumb_sprite.update_sprite('id', ['cam1', 'cam2', 'cam3', 'cam4'])
+    assert sorted(sprite_map['tiles']) == ['cam1', 'cam2', 'cam3']
+    first = tile(s3, sprite_map, 'cam1')
+
+    for rebuild in range(5):
+        s3.put_object('', thumb_key('cam2', 'small'), jpeg(10 + rebuild))
+        s3.gets.clear()
+        sprite_map = iot_thumb_sprite.update_sprite('id', ['cam1', 'cam2', 'cam3', 'cam4'])
+        assert thumb_key('cam1', 'small') not in s3.gets
+        assert thumb_key('cam2', 'small') in s3.gets
+
+    assert np.array_equal(tile(s3, sprite_map, 'cam1'), first)
+
+
+def test_up_to_date_sprite_is_not_rebuilt(s3):
+    s3.put_object('', thumb_key('cam1', 'small'), jpeg(0))
+    sprite_map = iot_thumb_sprite.update_sprite('id', ['cam1'])
+    s3.gets.clear()
+    assert iot_thumb_sprite.update_sprite('id', ['cam1']) == sprite_map
+    assert s3.gets == [iot_thumb_sprite.sprite_key('id', 'json')]
+
+
+def test_identity_from_api_gateway_event():
+    event = {'requestContext': {'identity': {'cognitoIdentityId': 'eu-central-1:abc'}}}
+    assert iot_thumb_sprite.request_identity_id(event, SimpleNamespace()) == 'eu-central-1:abc'
+    context = SimpleNamespace(identity=SimpleNamespace(cognito_identity_id='eu-central-1:def'))
+    assert iot_thumb_sprite.request_identity_id({}, context) == 'eu-central-1:def'
+
+
+def test_sprite_map_matches_png(s3):
+    s3.put_object('', thumb_key('cam1', 'small'), jpeg(0))
+    sprite_map = iot_thumb_sprite.update_sprite('id', ['cam1'])
+    png = Image.open(BytesIO(s3.objects[iot_thumb_sprite.sprite_key('id', 'png')]))
+    assert json.loads(png.info['tiles']) == sprite_map['tiles']
+
+
+def test_permission_errors_do_not_drop_tiles(s3):
+    s3.put_object('', thumb_key('cam1', 'small'), jpeg(0))
+    s3.denied = True
+    with pytest.raises(ClientError):
+        iot_thumb_sprite.update_sprite('id', ['cam1'])
@@ -15,6 +15,9 @@ export class IoTClient {
   private mqttClient: MQTT.Client | undefined
   private ccAws = ccAWS
   private sdpHandler?: SDPHandler
+  // set in the shared identity policy mode, things are then reached through cloudcam/owner/{identity id}/
+  // (relayed by the iot_owner_relay lambda) instead of their own topics
+  private ownerTopicPrefix?: string
 
   public static get shared(): IoTClient {
     if (!sharedClient) sharedClient = new IoTClient()
@@ -70,6 +73,12 @@ export class IoTClient {
     })
   }
 
+  // topic of a thing's shadow (e.g. shadow/update), in the owner namespace if there is one
+  private shadowTopic(thingName: string, action: string): string {
+    if (this.ownerTopicPrefix) return `${this.ownerTopicPrefix}/${thingName}/shadow/${action}`
+    return `$aws/things/${thingName}/shadow/${action}`
+  }
+
   private async handleMQTTMessage(message: MQTT.Message, payload) {
     let thingName = message.destinationName.match(/\$aws\/things\/([^\\]+)\/shadow\/get\/accepted/)
     if (thingName && thingName[1]) {
@@ -81,6 +90,11 @@ export class IoTClient {
       this.shadowUpdateHandler(thingName[1], payload)
     }
 
+    thingName = message.destinationName.match(/^cloudcam\/owner\/[^/]+\/([^/]+)\/shadow\/(get|update)\/accepted$/)
+    if (thingName && thingName[1]) {
+      this.shadowUpdateHandler(thingName[1], payload)
+    }
+
     // WebRTC signalling
     thingName = message.destinationName.match(/cloudcam\/webrtc\/setup\/([^\\]+)/)
     if (thingName && thingName[1]) {
@@ -94,7 +108,9 @@ export class IoTClient {
     }
 
     let mqttMessage = new MQTT.Message(JSON.stringify(msg))
-    mqttMessage.destinationName = `cloudcam/${thingName}/webrtc/setup`
+    mqttMessage.destinationName = this.ownerTopicPrefix
+      ? `${this.ownerTopicPrefix}/${thingName}/webrtc/setup`
+      : `cloudcam/${thingName}/webrtc/setup`
     this.mqttClient.send(mqttMessage)
     console.log('sent MQTT setup message: ', mqttMessage, 'to:', mqttMessage.destinationName)
   }
@@ -127,7 +143,7 @@ export class IoTClient {
   // subscibe to mqtt topics where thing shadow updates are published
   subscribeToShadowUpdates(thingName) {
     return new Promise((resolve, reject) => {
-      this.mqttClient.subscribe('$aws/things/' + thingName + '/shadow/update/accepted', {
+      this.mqttClient.subscribe(this.shadowTopic(thingName, 'update/accepted'), {
         onSuccess: function() {
           console.log('mqtt subscription to ' + thingName + ' shadow updates succeeded')
           resolve()
@@ -141,7 +157,7 @@ export class IoTClient {
   }
   subscribeToShadowGet(thingName) {
     return new Promise((resolve, reject) => {
-      this.mqttClient.subscribe('$aws/things/' + thingName + '/shadow/get/accepted', {
+      this.mqttClient.subscribe(this.shadowTopic(thingName, 'get/accepted'), {
         onSuccess: function() {
           console.log('mqtt subscription to ' + thingName + ' shadow get succeeded')
           resolve()
@@ -191,14 +207,14 @@ export class IoTClient {
   // updates the specified thing shadow
   updateShadow(thingName, doc) {
     let message = new MQTT.Message(JSON.stringify(doc))
-    message.destinationName = '$aws/things/' + thingName + '/shadow/update'
+    message.destinationName = this.shadowTopic(thingName, 'update')
     this.mqttClient.send(message)
   }
 
   // updates the specified thing shadow
   getShadow(thingName) {
     let message = new MQTT.Message('')
-    message.destinationName = '$aws/things/' + thingName + '/shadow/get'
+    message.destinationName = this.shadowTopic(thingName, 'get')
     console.log('getting shadow', message.destinationName)
     this.mqttClient.send(message)
   }
@@ -247,6 +263,7 @@ export class IoTClient {
     })
     console.log('refreshed things: ', res)
     let result = JSON.parse(res.Payload as string)
+    this.ownerTopicPrefix = result.ownerTopicPrefix
     store.dispatch({
       type: 'iot/things',
       thingNames: result.thingNames,